@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+sacloud agent
+=============
+
+Runs the sacloud_server, sacloud_disk, sacloud_router, sacloud_lb,
+sacloud_facts, sacloud_wait, sacloud, sacloud_stack,
+sacloud_rolling_restart and sacloud_server_group modules on behalf of
+Ansible tasks, so a task no longer pays for importing saklient,
+authorizing and opening API connections:
+
+    $ ./agent/sacloud_agent.py &
+    $ ansible-playbook site.yml
+
+The modules look for the agent's unix socket at agent_socket, then
+SACLOUD_AGENT_SOCKET, then ~/.cache/ansible-sacloud/agent.sock, and do
+the work themselves when nobody listens there. Tasks must run on the
+controller, as the sacloud modules usually do.
+
+The agent keeps one authorized session with pooled keep-alive connections
+per account, zone and API settings, and runs the modules of this checkout;
+restart it after updating them.
+'''
+
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+try:
+    import saklient
+except ImportError:
+    sys.exit('saklient is required: pip install saklient')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules running here import ansible.module_utils.sacloud from this checkout
+import ansible.module_utils
+ansible.module_utils.__path__.insert(0, os.path.join(ROOT, 'module_utils'))
+
+from ansible.module_utils.sacloud import sacloud_argument_spec
+from ansible.module_utils.sacloud.agent import DEFAULT_AGENT_SOCKET, recv_message
+from ansible.module_utils.sacloud.batch import batch_argument_spec, run_batch
+from ansible.module_utils.sacloud.client import clone_api, sacloud_client
+from ansible.module_utils.sacloud.group import run_server_group, server_group_argument_spec
+from ansible.module_utils.sacloud.metrics import Metrics
+from ansible.module_utils.sacloud.operations import OPERATIONS, Operation, OperationExit, OperationModule, run_operation
+from ansible.module_utils.sacloud.rolling import rolling_restart_argument_spec, run_rolling_restart
+from ansible.module_utils.sacloud.stack import run_stack, stack_argument_spec
+
+MODULES = dict(OPERATIONS)
+MODULES['sacloud'] = Operation('sacloud', batch_argument_spec, run_batch)
+MODULES['sacloud_stack'] = Operation('sacloud_stack', stack_argument_spec, run_stack)
+MODULES['sacloud_rolling_restart'] = Operation('sacloud_rolling_restart',
+                                                rolling_restart_argument_spec,
+                                                run_rolling_restart)
+MODULES['sacloud_server_group'] = Operation('sacloud_server_group',
+                                            server_group_argument_spec,
+                                            run_server_group)
+
+# Requests with the same connection params share a session
+SESSION_PARAMS = [k for k in sacloud_argument_spec()
+                    if k not in ['metrics', 'agent', 'agent_socket']]
+
+
+class Agent():
+
+    def __init__(self, modules, verbose=False):
+        self._modules = modules
+        self._verbose = verbose
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.stats = dict(requests=0, sessions=0)
+        self.last_request = time.time()
+
+    def handle(self, request):
+        started = time.time()
+        with self._lock:
+            self.stats['requests'] += 1
+            self.last_request = started
+
+        response = self._run(request)
+        if self._verbose:
+            sys.stderr.write('%s %s in %.3fs\n'
+                                % (request.get('module'),
+                                    'failed' if response['failed'] else 'ok',
+                                    time.time() - started))
+        return response
+
+    def _run(self, request):
+        module = OperationModule(request['params'], request.get('check_mode', False))
+        operation = self._modules.get(request['module'])
+        if operation is None:
+            return dict(failed=True,
+                        result=dict(failed=True,
+                                    msg='Unsupported module: %s' % request['module']))
+        try:
+            saklient = clone_api(self._get_session(module), Metrics())
+            failed, result = run_operation(operation, module, saklient)
+            return dict(failed=failed, result=result)
+        except OperationExit, e:
+            # sacloud_client could not authorize
+            return dict(failed=e.failed, result=e.result)
+        except Exception, e:
+            return dict(failed=True,
+                        result=dict(failed=True,
+                                    msg='sacloud agent error: %s' % e,
+                                    exception=traceback.format_exc()))
+
+    def _get_session(self, module):
+        key = json.dumps(dict((k, v) for k, v in module.params.items()
+                                if k in SESSION_PARAMS),
+                            sort_keys=True)
+        with self._lock:
+            if key not in self._sessions:
+                # sacloud_client fails the request itself when it cannot
+                self._sessions[key] = sacloud_client(module)
+                self.stats['sessions'] += 1
+            return self._sessions[key]
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = recv_message(self.connection)
+        except ValueError, e:
+            response = dict(failed=True,
+                            result=dict(failed=True, msg='Bad request: %s' % e))
+        else:
+            response = self.server.agent.handle(request)
+        self.connection.sendall(json.dumps(response).encode('utf-8'))
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, agent):
+        socketserver.UnixStreamServer.__init__(self, path, AgentHandler)
+        self.agent = agent
+
+
+def prepare_socket(path):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0700)
+    if os.path.exists(path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except socket.error:
+            # left behind by an agent that is gone
+            os.unlink(path)
+        else:
+            sys.exit('An agent is already listening on %s' % path)
+        finally:
+            sock.close()
+
+
+def watch_idle(server, idle_timeout):
+    while True:
+        time.sleep(min(idle_timeout, 10))
+        if time.time() - server.agent.last_request > idle_timeout:
+            server.shutdown()
+            return
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run sacloud modules for Ansible tasks')
+    parser.add_argument('--socket',
+                        default=os.environ.get('SACLOUD_AGENT_SOCKET', DEFAULT_AGENT_SOCKET),
+                        help='Unix socket to listen on')
+    parser.add_argument('--idle-timeout', type=int, default=0,
+                        help='Exit after this many seconds without requests, 0 for never')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Log every request to stderr')
+    args = parser.parse_args()
+
+    path = os.path.expanduser(args.socket)
+    prepare_socket(path)
+
+    # tasks send their API secrets, so only the owner may connect
+    os.umask(0077)
+    server = AgentServer(path, Agent(MODULES, args.verbose))
+    if args.idle_timeout > 0:
+        watcher = threading.Thread(target=watch_idle,
+                                    args=(server, args.idle_timeout))
+        watcher.daemon = True
+        watcher.start()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+        stats = server.agent.stats
+        sys.stderr.write('sacloud agent served %d requests in %d sessions\n'
+                            % (stats['requests'], stats['sessions']))
+
+
+if __name__ == '__main__':
+    main()
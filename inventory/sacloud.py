@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+sacloud external inventory script
+=================================
+
+Lists the servers of all configured zones concurrently and groups them by:
+
+  - zone:    zone_is1a
+  - tag:     tag_web
+  - plan:    plan_2core_4gb
+  - switch:  switch_<switch id>, and router_<router id> for router switches
+
+Every host carries its sacloud_* variables and ansible_host in
+_meta.hostvars, so Ansible never calls --host. Servers sharing a name are
+told apart by their zone (web1.is1a), or by their id within one zone.
+
+Settings are read from sacloud.ini next to this script, or from the file
+named by SACLOUD_INI_PATH.
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import ConfigParser as configparser
+except ImportError:
+    import configparser
+
+try:
+    from saklient.cloud.api import API
+except ImportError:
+    sys.exit('saklient is required: pip install saklient')
+
+
+class SacloudInventory():
+
+    def __init__(self):
+        self._args = self._parse_args()
+        self._read_settings()
+
+    def run(self):
+        if self._args.refresh or not self._cache_is_valid():
+            inventory = self._fetch_inventory()
+            self._write_cache(inventory)
+        else:
+            inventory = self._read_cache()
+
+        if self._args.host:
+            return inventory['_meta']['hostvars'].get(self._args.host, {})
+        return inventory
+
+    def _parse_args(self):
+        parser = argparse.ArgumentParser(
+                description='Produce an Ansible inventory from sacloud')
+        parser.add_argument('--list', action='store_true', default=True,
+                            help='List servers (default: True)')
+        parser.add_argument('--host',
+                            help='Get all the variables about a server')
+        parser.add_argument('--refresh', '--refresh-cache', action='store_true',
+                            default=False,
+                            help='Fetch the servers again and rewrite the cache')
+        return parser.parse_args()
+
+    def _read_settings(self):
+        path = os.environ.get('SACLOUD_INI_PATH',
+                os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'sacloud.ini'))
+        config = configparser.SafeConfigParser(dict(
+            access_token=os.environ.get('ACCESS_TOKEN', ''),
+            access_token_secret=os.environ.get('ACCESS_TOKEN_SECRET', ''),
+            api_root=os.environ.get('SACLOUD_API_ROOT', ''),
+            zones='is1a, is1b, tk1a, tk1v',
+            page_size='100',
+            hostname='name',
+            cache_path='~/.cache/ansible-sacloud',
+            cache_max_age='300',
+            ))
+        config.read(path)
+        if not config.has_section('sacloud'):
+            config.add_section('sacloud')
+
+        self._access_token = config.get('sacloud', 'access_token')
+        self._access_token_secret = config.get('sacloud', 'access_token_secret')
+        self._api_root = config.get('sacloud', 'api_root')
+        self._zones = [x.strip() for x in config.get('sacloud', 'zones').split(',')
+                        if x.strip()]
+        self._page_size = config.getint('sacloud', 'page_size')
+        self._hostname = config.get('sacloud', 'hostname')
+        self._cache_max_age = config.getint('sacloud', 'cache_max_age')
+        # the listing depends on the account, the API and what is listed
+        account = hashlib.sha1(self._access_token.encode('utf-8')).hexdigest()[:12]
+        listing = hashlib.sha1(json.dumps([self._api_root, self._zones,
+                                            self._hostname, self._page_size])
+                                .encode('utf-8')).hexdigest()[:12]
+        self._cache_file = os.path.join(
+                os.path.expanduser(config.get('sacloud', 'cache_path')),
+                'inventory-%s-%s.json' % (account, listing))
+
+        if not self._access_token or not self._access_token_secret:
+            sys.exit('ACCESS_TOKEN and ACCESS_TOKEN_SECRET are required')
+
+    def _cache_is_valid(self):
+        if self._cache_max_age <= 0 or not os.path.isfile(self._cache_file):
+            return False
+        return os.path.getmtime(self._cache_file) + self._cache_max_age > time.time()
+
+    def _read_cache(self):
+        with open(self._cache_file) as f:
+            return json.load(f)
+
+    def _write_cache(self, inventory):
+        if self._cache_max_age <= 0:
+            return
+        directory = os.path.dirname(self._cache_file)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(inventory, f)
+        os.rename(tmp, self._cache_file)
+
+    def _fetch_inventory(self):
+        results = {}
+        errors = []
+
+        def fetch(zone):
+            try:
+                results[zone] = self._fetch_zone(zone)
+            except Exception, e:
+                errors.append('%s: %s' % (zone, e))
+
+        threads = [threading.Thread(target=fetch, args=(zone,))
+                    for zone in self._zones]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            sys.exit('Failed to list sacloud servers: %s' % ', '.join(errors))
+
+        inventory = dict(_meta=dict(hostvars={}))
+        hostnames = self._get_hostnames(results)
+        for zone in self._zones:
+            servers, routers = results[zone]
+            for server in servers:
+                self._add_host(inventory, hostnames[(zone, server.id)],
+                                zone, server, routers)
+        return inventory
+
+    def _get_hostnames(self, results):
+        if self._hostname != 'name':
+            return dict(((zone, x.id), x.id) for zone in self._zones
+                        for x in results[zone][0])
+
+        zones_of = {}
+        count = {}
+        for zone in self._zones:
+            for server in results[zone][0]:
+                zones_of.setdefault(server.name, set()).add(zone)
+                count[(zone, server.name)] = count.get((zone, server.name), 0) + 1
+
+        hostnames = {}
+        for zone in self._zones:
+            for server in results[zone][0]:
+                if count[(zone, server.name)] > 1:
+                    hostname = '%s.%s' % (server.name, server.id)
+                elif len(zones_of[server.name]) > 1:
+                    hostname = '%s.%s' % (server.name, zone)
+                else:
+                    hostname = server.name
+                hostnames[(zone, server.id)] = hostname
+        return hostnames
+
+    def _fetch_zone(self, zone):
+        api = API.authorize(self._access_token, self._access_token_secret, zone)
+        if self._api_root:
+            # authorize() resets the API root, so it is set afterwards
+            api.client.set_api_root(self._api_root.rstrip('/') + '/')
+        servers = self._find_all(api.server)
+        routers = dict((x.swytch_id, x.id) for x in self._find_all(api.router)
+                        if x.swytch_id)
+        return servers, routers
+
+    def _find_all(self, model):
+        resources = []
+        while True:
+            page = model.offset(len(resources)).limit(self._page_size).find()
+            resources.extend(page)
+            if len(page) < self._page_size \
+                    or (model.total is not None and len(resources) >= model.total):
+                return resources
+
+    def _add_host(self, inventory, hostname, zone, server, routers):
+        hostvars = self._get_hostvars(zone, server)
+        inventory['_meta']['hostvars'][hostname] = hostvars
+
+        groups = ['zone_%s' % zone]
+        groups.extend(['tag_%s' % x.lstrip('@') for x in hostvars['sacloud_tags']])
+        if hostvars['sacloud_plan']:
+            groups.append('plan_%s' % hostvars['sacloud_plan'])
+        for swytch_id in hostvars['sacloud_switch_ids']:
+            groups.append('switch_%s' % swytch_id)
+            if swytch_id in routers:
+                groups.append('router_%s' % routers[swytch_id])
+
+        for group in groups:
+            hosts = inventory.setdefault(self._to_safe(group), [])
+            if hostname not in hosts:
+                hosts.append(hostname)
+
+    def _get_hostvars(self, zone, server):
+        ifaces = server.ifaces or []
+        ip_addresses = [x.ip_address or x.user_ip_address for x in ifaces
+                        if x.ip_address or x.user_ip_address]
+        plan = server.plan
+
+        hostvars = dict(
+            sacloud_id=server.id,
+            sacloud_name=server.name,
+            sacloud_description=server.description,
+            sacloud_zone=zone,
+            sacloud_tags=server.tags or [],
+            sacloud_status=server.instance.status if server.instance else None,
+            sacloud_cpu=plan.cpu if plan else None,
+            sacloud_mem=plan.memory_gib if plan else None,
+            sacloud_plan='%dcore_%dgb' % (plan.cpu, plan.memory_gib) if plan else None,
+            sacloud_ip_addresses=ip_addresses,
+            sacloud_switch_ids=[x.swytch_id for x in ifaces if x.swytch_id],
+            )
+        if ip_addresses:
+            hostvars['ansible_host'] = ip_addresses[0]
+        return hostvars
+
+    def _to_safe(self, word):
+        return re.sub(r'[^A-Za-z0-9_]', '_', word)
+
+
+def main():
+    print json.dumps(SacloudInventory().run(), sort_keys=True, indent=2)
+
+
+if __name__ == '__main__':
+    main()
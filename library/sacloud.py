@@ -0,0 +1,241 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: sacloud
+short_description: Run a batch of sacloud operations in one process.
+description:
+  - Run a list of steps, each written like a task of sacloud_server,
+    sacloud_disk, sacloud_router, sacloud_lb, sacloud_wait or
+    sacloud_facts, one after the other in a single module run. All steps
+    share one API client, connection pool and lookup cache.
+  - A step can use what an earlier step returned. C(${web.sacloud_server_resource_id})
+    stands for the value C(sacloud_server_resource_id) returned by the step
+    registered as C(web), looked up in its result and then in its facts.
+    A string that is a single reference keeps the type of the value.
+  - The batch stops at the first failed step unless the step sets
+    C(ignore_errors). Facts returned by the steps are set when the batch
+    succeeds.
+  - In check mode, steps referring to resources that earlier steps would
+    have created are skipped.
+author:
+  - "Koji Nakayama (@knakayama)"
+requirements:
+  - "python >= 2.6"
+  - saklient
+options:
+  access_token:
+    description:
+      - The sacloud access token to use.
+    required: true
+    default: false
+    aliases: ['token']
+  access_token_secret:
+    description:
+      - The sacloud secret access token to use.
+    required: true
+    default: false
+    aliases: ['token_secret']
+  zone:
+    description:
+      - The sacloud zone to use.
+    required: false
+    default: is1a
+    choices: ['is1a', 'is1b', 'tk1a', 'tk1v']
+  http_pool_size:
+    description:
+      - Maximum number of keep-alive connections to the API.
+    required: false
+    default: 4
+  http_timeout:
+    description:
+      - Timeout in seconds for a single API request.
+    required: false
+    default: 60
+  http_retries:
+    description:
+      - Times to send a request again after the API answered 429 or 503,
+        or 500, 502 or 504 to a request without side effects. Waits grow
+        exponentially with jitter and honor C(Retry-After).
+    required: false
+    default: 5
+  http_rate_limit:
+    description:
+      - Requests per second allowed for the account. The budget is kept in
+        a locked file in the cache directory, so every fork and module run on
+        the controller shares it. C(0) disables the limit.
+    required: false
+    default: 10
+  http_burst:
+    description:
+      - Requests allowed at once before C(http_rate_limit) applies.
+        Defaults to C(http_rate_limit).
+    required: false
+    default: null
+  api_root:
+    description:
+      - Base URL of the API, such as a local fake for tests. Falls back to
+        the C(SACLOUD_API_ROOT) environment variable, then to the sacloud
+        endpoint.
+    required: false
+    default: null
+  agent:
+    description:
+      - Let a running sacloud agent (C(agent/sacloud_agent.py)) do the work
+        when one listens on C(agent_socket). The task then skips importing
+        saklient, authorizing and connecting to the API.
+    required: false
+    default: true
+  agent_socket:
+    description:
+      - Unix socket of the sacloud agent. Falls back to the
+        C(SACLOUD_AGENT_SOCKET) environment variable, then to
+        C(~/.cache/ansible-sacloud/agent.sock).
+    required: false
+    default: null
+  metrics:
+    description:
+      - Return C(sacloud_metrics) with the wall-clock time of each phase of
+        the run, API requests by method and endpoint, bytes transferred,
+        retries and wait poll counts.
+    required: false
+    default: false
+  cache_dir:
+    description:
+      - Directory for the local lookup cache shared by parallel runs.
+    required: false
+    default: ~/.cache/ansible-sacloud
+  cache_ttl:
+    description:
+      - Seconds cached icon and plan lookups stay valid. C(0) disables the cache.
+    required: false
+    default: 86400
+  cache_refresh:
+    description:
+      - Discard the cached lookups for this account and zone before running.
+      - Also fetch the unused router switch addresses again, which are
+        otherwise trusted for five minutes.
+    required: false
+    default: false
+  state_file:
+    description:
+      - Passed to every step of C(sacloud_server), C(sacloud_disk),
+        C(sacloud_router) and C(sacloud_lb). Their C(present) runs return
+        the result kept there when nothing changed since, after checking
+        the resource still exists.
+    required: false
+    default: null
+  state_refresh:
+    description:
+      - List every resource type in C(state_file) once before the first
+        step and drop the entries of resources that are gone.
+    required: false
+    default: false
+  dry_run:
+    description:
+      - Run every step in check mode against one listing of servers,
+        disks, routers, switches, appliances and archives, and report the
+        C(diff) of what each step would change.
+    required: false
+    default: false
+  steps:
+    description:
+      - List of steps. Each step has one key naming the module, such as
+        C(sacloud_server), with the module's parameters as its value.
+      - The connection and cache parameters above apply to every step and
+        cannot be set in a step.
+      - A step may also have C(name), C(register) to refer to its result
+        from later steps, and C(ignore_errors).
+    required: true
+'''
+
+EXAMPLES = '''
+# Create a router, a server and its disk, connect them and boot the server
+- sacloud:
+    access_token: _YOUR_ACCESS_TOKEN_HERE_
+    access_token_secret: _YOUR_ACCESS_TOKEN_SECRET_HERE_
+    steps:
+      - name: create router
+        sacloud_router:
+          name: router
+          band_width_mbps: 100
+          network_mask_len: 28
+        register: router
+      - name: create server
+        sacloud_server:
+          name: web1
+          cpu: 1
+          mem: 1
+        register: web
+      - name: create disk
+        sacloud_disk:
+          name: web1 disk
+          archive_resource_id: _ARCHIVE_RESOURCE_ID_HERE_
+          router_resource_id: ${router.sacloud_router_resource_id}
+          config_ipv4_address: auto
+          config_ssh_key: "{{ lookup('file', 'keys/id_rsa.pub') }}"
+        register: disk
+      - sacloud_disk:
+          disk_resource_id: ${disk.sacloud_disk_resource_id}
+          server_resource_id: ${web.sacloud_server_resource_id}
+          state: connected
+      - sacloud_router:
+          router_resource_id: ${router.sacloud_router_resource_id}
+          server_resource_ids:
+            - ${web.sacloud_server_resource_id}
+          state: connected
+      - sacloud_server:
+          server_resource_id: ${web.sacloud_server_resource_id}
+          state: running
+  register: result
+
+- debug: msg="{{ item.step }} took {{ item.elapsed }}s"
+  with_items: "{{ result.steps }}"
+'''
+
+try:
+    from saklient.cloud.api import API
+    HAS_SAKLIENT = True
+except ImportError:
+    HAS_SAKLIENT = False
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=batch_argument_spec(),
+        supports_check_mode=True
+    )
+
+    # an agent on the controller does the work with a warm session
+    sacloud_agent_call(module, 'sacloud')
+
+    if not HAS_SAKLIENT:
+        module.fail_json(msg='Required module saklient not found')
+
+    run_batch(module, sacloud_client(module))
+
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.sacloud.agent import sacloud_agent_call
+from ansible.module_utils.sacloud.batch import batch_argument_spec, run_batch
+from ansible.module_utils.sacloud.client import sacloud_client
+if __name__ == '__main__':
+    main()
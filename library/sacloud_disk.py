@@ -24,6 +24,10 @@ module: sacloud_disk
 short_description: Manage sacloud disk.
 description:
   - Create, update and remove sacloud disks.
+  - With C(state=present) an existing disk, given by C(disk_resource_id) or
+    found by its exact name, is compared with the options and only the
+    differences are written. The plan and size of an existing disk cannot
+    be changed.
 author:
   - "Koji Nakayama (@knakayama)"
 requirements:
@@ -48,6 +52,105 @@ options:
     required: false
     default: is1a
     choices: ['is1a', 'is1b', 'tk1a', 'tk1v']
+  http_pool_size:
+    description:
+      - Maximum number of keep-alive connections to the API.
+    required: false
+    default: 4
+  http_timeout:
+    description:
+      - Timeout in seconds for a single API request.
+    required: false
+    default: 60
+  http_retries:
+    description:
+      - Times to send a request again after the API answered 429 or 503,
+        or 500, 502 or 504 to a request without side effects. Waits grow
+        exponentially with jitter and honor C(Retry-After).
+    required: false
+    default: 5
+  http_rate_limit:
+    description:
+      - Requests per second allowed for the account. The budget is kept in
+        a locked file in the cache directory, so every fork and module run on
+        the controller shares it. C(0) disables the limit.
+    required: false
+    default: 10
+  http_burst:
+    description:
+      - Requests allowed at once before C(http_rate_limit) applies.
+        Defaults to C(http_rate_limit).
+    required: false
+    default: null
+  api_root:
+    description:
+      - Base URL of the API, such as a local fake for tests. Falls back to
+        the C(SACLOUD_API_ROOT) environment variable, then to the sacloud
+        endpoint.
+    required: false
+    default: null
+  agent:
+    description:
+      - Let a running sacloud agent (C(agent/sacloud_agent.py)) do the work
+        when one listens on C(agent_socket). The task then skips importing
+        saklient, authorizing and connecting to the API.
+    required: false
+    default: true
+  agent_socket:
+    description:
+      - Unix socket of the sacloud agent. Falls back to the
+        C(SACLOUD_AGENT_SOCKET) environment variable, then to
+        C(~/.cache/ansible-sacloud/agent.sock).
+    required: false
+    default: null
+  metrics:
+    description:
+      - Return C(sacloud_metrics) with the wall-clock time of each phase of
+        the run, API requests by method and endpoint, bytes transferred,
+        retries and wait poll counts.
+    required: false
+    default: false
+  cache_dir:
+    description:
+      - Directory for the local lookup cache shared by parallel runs.
+    required: false
+    default: ~/.cache/ansible-sacloud
+  cache_ttl:
+    description:
+      - Seconds cached icon and plan lookups stay valid. C(0) disables the cache.
+    required: false
+    default: 86400
+  cache_refresh:
+    description:
+      - Discard the cached lookups for this account and zone before running.
+      - Also fetch the unused router switch addresses again, which are
+        otherwise trusted for five minutes.
+    required: false
+    default: false
+  state_file:
+    description:
+      - File keeping the result of C(present) runs, by a fingerprint of the
+        module, zone and name or id of the task. A run with the same
+        params as the last one applied returns that result, without looking
+        up and comparing the resource, once a single request has shown the
+        resource still exists. Nothing is kept when not set.
+    required: false
+    default: null
+  state_refresh:
+    description:
+      - List every resource type in C(state_file) once, drop the entries
+        of resources that are gone, and run the task in full.
+    required: false
+    default: false
+  dry_run:
+    description:
+      - Run in check mode and report the C(diff) of what the task would
+        change. Servers, disks, routers, switches, appliances and archives
+        are listed once and cached for the tasks after, so a dry run of
+        many tasks costs a constant number of requests. Tasks that change
+        something drop the cached listing.
+    required: false
+    default: false
   name:
     description:
       - The disk name
@@ -110,6 +213,10 @@ options:
   config_ipv4_address:
     description:
       - The disk ipv4 address
+      - C(auto) leases a free address of the switch of C(router_resource_id)
+        from the local address table, and fills in C(config_network_mask_len)
+        and C(config_default_route) when they are not given. The address is
+        kept for the disk name and released when the disk is removed.
     required: false
     default: false
   config_ssh_key:
@@ -127,6 +234,37 @@ options:
       - The disk default route
     required: false
     default: false
+  router_resource_id:
+    description:
+      - The router whose switch C(config_ipv4_address=auto) leases from
+    required: false
+    default: false
+    aliases: ['router_id']
+  disks:
+    description:
+      - List of disks to copy from C(archive_resource_id) at once.
+      - Each item needs C(name) and accepts C(desc), C(tags), C(icon), C(plan),
+        C(size_gib) and the C(config_*) options, falling back to the module
+        options for missing keys.
+      - The config of each disk is written as soon as its own copy has
+        finished. The copy time of every disk is returned in C(copy_seconds).
+    required: false
+    default: false
+  copy_concurrency:
+    description:
+      - Maximum number of disks copied at the same time with C(disks).
+      - Keep it low to spare the storage backend.
+    required: false
+    default: 4
+  wait:
+    description:
+      - Wait until the disk has been copied from the archive.
+      - Set to C(false) to return as soon as the API accepts the request,
+        and use M(sacloud_wait) to wait for many disks at once.
+      - The C(config_*) options need the copy to finish, so they cannot be
+        used with C(wait=false).
+    required: false
+    default: true
   state:
     description:
       - On C(present), it will create if disk does not exist.
@@ -165,6 +303,41 @@ EXAMPLES = '''
     config_default_route: _YOUR_DEFAULT_ROUTE_HERE_
     state: present
 
+# Copy an archive onto three disks, two at a time
+- sacloud_disk:
+    access_token: _YOUR_ACCESS_TOKEN_HERE_
+    access_token_secret: _YOUR_ACCESS_TOKEN_SECRET_HERE_
+    archive_resource_id: __ARCHIVE_RESOURCE_ID_HERE_
+    size_gib: 20
+    config_ssh_key: _YOUR_SSH_KEY_HERE_
+    config_network_mask_len: 28
+    config_default_route: _YOUR_DEFAULT_ROUTE_HERE_
+    disks:
+      - name: web01 disk
+        config_host_name: web01.example.com
+        config_ipv4_address: _YOUR_IP_ADDRESS_HERE_
+      - name: web02 disk
+        config_host_name: web02.example.com
+        config_ipv4_address: _YOUR_IP_ADDRESS_HERE_
+      - name: web03 disk
+        config_host_name: web03.example.com
+        config_ipv4_address: _YOUR_IP_ADDRESS_HERE_
+    copy_concurrency: 2
+    state: present
+
+# Copy an archive onto two disks with addresses of the router's switch
+- sacloud_disk:
+    access_token: _YOUR_ACCESS_TOKEN_HERE_
+    access_token_secret: _YOUR_ACCESS_TOKEN_SECRET_HERE_
+    archive_resource_id: __ARCHIVE_RESOURCE_ID_HERE_
+    router_resource_id: _ROUTER_RESOURCE_ID_HERE_
+    config_ssh_key: _YOUR_SSH_KEY_HERE_
+    config_ipv4_address: auto
+    disks:
+      - name: web01 disk
+      - name: web02 disk
+    state: present
+
 # Destroy a disk
 - sacloud_disk:
     access_token: _YOUR_ACCESS_TOKEN_HERE_
@@ -180,255 +353,24 @@ except ImportError:
     HAS_SAKLIENT = False
 
 
-class Disk():
-
-    def __init__(self, module, saklient):
-        self._module = module
-        self._saklient = saklient
-
-    def _get_desc(self, desc):
-        if desc:
-            return self._str2triple_quoted_str(desc)
-        else:
-            return desc
-
-    def _str2triple_quoted_str(self, desc):
-        return '''%s''' % desc
-
-    # FIXME: don't work
-    def _get_tags(self, tags):
-        if tags:
-            return self._parse_tags(tags)
-        else:
-            return tags
-
-    def _parse_tags(self, tags):
-        return [''.join(['@', x]) for x in tags]
-
-    def _get_icon(self, icon):
-        if icon:
-            return self._get_icon_with_name_like(icon)
-        else:
-            return icon
-
-    def _get_icon_with_name_like(self, icon):
-        try:
-            return self._saklient.icon \
-                    .with_name_like(icon) \
-                    .limit(1) \
-                    .find()[0]
-        except Exception, e:
-            self._fail(msg='Failed to find disk icon: %s' % e)
-
-    def _get_disk_by_id(self, disk_resource_id):
-        try:
-            return self._saklient.disk.get_by_id(str(disk_resource_id))
-        except Exception:
-            self._fail(msg='Failed to find disk: %d' % disk_resource_id)
-
-    def destroy(self, disk_resource_id):
-        _disk = self._get_disk_by_id(disk_resource_id)
-
-        if self._module.check_mode:
-            self._success()
-
-        try:
-            _disk.destroy()
-        except Exception, e:
-            self._fail(msg='Failed to destroy disk: %s' % e)
-        self._success(msg='Successfully destroy disk: %d' % int(_disk.id))
-
-    def _get_plan(self, plan):
-        if plan == 'ssd':
-            return self._saklient.product.disk.ssd
-        else:
-            # FIXME: hdd plan does not work
-            return self._saklient.product.disk.hdd
-
-    def _get_archive_by_id(self, archive_resource_id):
-        try:
-            return self._saklient.archive.get_by_id(str(archive_resource_id))
-        except Exception:
-            self._fail(msg='Failed to find disk source archive: %d'
-                        % archive_resource_id)
-
-    def create(self):
-        _disk = self._saklient.disk.create()
-        self._set_params(_disk)
-
-        if self._module.check_mode:
-            self._success()
-
-        try:
-            _disk.save()
-            _disk.sleep_while_copying()
-        except Exception, e:
-            self._fail(msg='Failed to create disk: %s' % e)
-
-        if self._config_param_exist():
-            self._set_config(_disk)
-
-        self._success(result='Successfully add disk: %d' % int(_disk.id),
-                            ansible_facts=dict(sacloud_disk_resource_id=_disk.id))
-
-    def disconnect(self, disk_resource_id):
-        _disk = self._get_disk_by_id(disk_resource_id)
-
-        if self._module.check_mode:
-            self._success(changed=False)
-
-        try:
-            _disk.disconnect()
-        except Exception, e:
-            self._fail(msg='Failed to disconnect disk from server: %s' % e)
-        self._success(result='Successfully disconnect disk')
-
-    def connect(self, disk_resource_id, server_resource_id):
-        _server = self._get_server_by_id(server_resource_id)
-        _disk = self._get_disk_by_id(disk_resource_id)
-
-        if self._module.check_mode:
-            self._success(changed=False)
-
-        try:
-            _disk.connect_to(_server)
-        except Exception, e:
-            self._fail(msg='Failed to connect disk to server: %s' % e)
-        self._success(result='Successfully connect to server')
-
-    def _get_server_by_id(self, server_resource_id):
-        try:
-            return self._saklient.server.get_by_id(str(server_resource_id))
-        except Exception:
-            # FIXME: UnicodeEncodeError
-            #self._fail('Failed to find server: %s' % e)
-            self._fail(msg='Failed to find server: %d' % server_resource_id)
-
-    def _set_params(self, _disk):
-        _disk.name = self._module.params['name']
-        _disk.plan = self._get_plan(self._module.params['plan'])
-        _disk.size_gib = self._module.params['size_gib']
-
-        if self._module.params['desc']:
-            _disk.description = self._get_desc(self._module.params['desc'])
-        if self._module.params['tags']:
-            _disk.tags = self._get_tags(self._module.params['tags'])
-        if self._module.params['icon']:
-            _disk.icon = self._get_icon(self._module.params['icon'])
-        if self._module.params['archive_resource_id']:
-            _disk.source = self._get_archive_by_id(self._module.params['archive_resource_id'])
-
-    def _config_param_exist(self):
-        # FIXME: very ugly
-        return ([self._module.params['config_host_name'],
-                self._module.params['config_password'],
-                self._module.params['config_ipv4_address'],
-                self._module.params['config_ssh_key'],
-                self._module.params['config_network_mask_len'],
-                self._module.params['config_default_route']])
-
-    def _set_config(self, _disk):
-        _disk_config = _disk.create_config()
-
-        if self._module.params['config_host_name']:
-            _disk_config.host_name = self._module.params['config_host_name']
-        if self._module.params['config_password']:
-            _disk_config.password = self._module.params['config_password']
-        if self._module.params['config_ipv4_address']:
-            _disk_config.ip_address = self._module.params['config_ipv4_address']
-        if self._module.params['config_ssh_key']:
-            _disk_config.ssh_key = self._module.params['config_ssh_key']
-        if self._module.params['config_network_mask_len']:
-            _disk_config.network_mask_len = \
-                    self._module.params['config_network_mask_len']
-        if self._module.params['config_default_route']:
-            _disk_config.default_route = \
-                    self._module.params['config_default_route']
-
-        try:
-            _disk_config.write()
-        except Exception, e:
-            self._fail(msg='Failed to modify disk: %s' % e)
-
-    def _fail(self, msg):
-        self._module.fail_json(msg=msg)
-
-    def _success(self, changed=True, **kwargs):
-        self._module.exit_json(changed=changed, **kwargs)
-
-
 def main():
     module = AnsibleModule(
-        argument_spec=dict(
-            access_token=dict(required=True, aliases=['token']),
-            access_token_secret=dict(required=True, aliases=['token_secret']),
-            zone=dict(required=False, default='is1a',
-                            choices=['is1a', 'is1b', 'tk1a', 'tk1v']),
-            disk_resource_id=dict(required=False, type='int', aliases=['disk_id']),
-            name=dict(required=False, default='default'),
-            desc=dict(required=False),
-            tags=dict(required=False, type='list'),
-            icon=dict(required=False),
-            size_gib=dict(required=False, default=20,
-                                type='int', aliases=['disk_size']),
-            archive_resource_id=dict(required=False, type='int',
-                                        aliases=['archive_id']),
-            server_resource_id=dict(required=False, type='int',
-                                        aliases=['server_id']),
-            plan=dict(required=False, default='ssd',
-                            choices=['ssd', 'hdd']),
-            config_host_name=dict(required=False),
-            config_password=dict(required=False),
-            config_ipv4_address=dict(required=False),
-            config_ssh_key=dict(required=False),
-            config_network_mask_len=dict(required=False, type='int'),
-            config_default_route=dict(required=False),
-            state=dict(required=False, default='present',
-                        choices=['present', 'absent', 'connected', 'disconnected'])
-        ),
+        argument_spec=disk_argument_spec(),
         supports_check_mode=True
     )
 
+    # an agent on the controller does the work with a warm session
+    sacloud_agent_call(module, 'sacloud_disk')
+
     if not HAS_SAKLIENT:
         module.fail_json(msg='Required module saklient not found')
 
-    try:
-        saklient = API.authorize(module.params['access_token'],
-                                module.params['access_token_secret'],
-                                module.params['zone'])
-    except Exception, e:
-        module.fail_json(msg='Failed to access sacloud: %s' % e)
-
-    disk = Disk(module, saklient)
-
-    if module.params['state'] == 'connected':
-        if not module.params['disk_resource_id']:
-            module.fail_json(msg='missing required arguments: disk_resource_id')
-        elif not module.params['server_resource_id']:
-            module.fail_json(msg='missing required arguments: server_resource_id')
-        else:
-            disk.connect(module.params['disk_resource_id'], module.params['server_resource_id'])
-    elif module.params['state'] == 'disconnected':
-        if module.params['disk_resource_id']:
-            disk.disconnect(module.params['disk_resource_id'])
-        else:
-            module.fail_json(msg='missing required arguments: disk_resource_id')
-    elif module.params['state'] == 'absent':
-        if module.params['disk_resource_id']:
-            disk.destroy(module.params['disk_resource_id'])
-        else:
-            module.fail_json(msg='missing required arguments: disk_resource_id')
-    else:
-        if module.params['archive_resource_id']:
-            disk.create()
-        elif not module.params['disk_resource_id']:
-            module.fail_json(msg='missing required arguments: disk_resource_id')
-        else:
-            # TODO: implement update
-            #disk.update(module.params['disk_resource_id'])
-            module.exit_json(changed=False)
+    run_disk(module, sacloud_client(module))
 
 
 from ansible.module_utils.basic import *
+from ansible.module_utils.sacloud.agent import sacloud_agent_call
+from ansible.module_utils.sacloud.client import sacloud_client
+from ansible.module_utils.sacloud.disk import disk_argument_spec, run_disk
 if __name__ == '__main__':
     main()
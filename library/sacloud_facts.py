@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: sacloud_facts
+short_description: Gather facts about the resources of a sacloud zone.
+description:
+  - List servers, disks, routers, switches, appliances and archives of a
+    zone in bulk and return them as facts indexed by ID, name and tag.
+  - Later tasks can look resources up in C(sacloud_facts) instead of
+    fetching them from the API one at a time.
+author:
+  - "Koji Nakayama (@knakayama)"
+requirements:
+  - "python >= 2.6"
+  - saklient
+options:
+  access_token:
+    description:
+      - The sacloud access token to use.
+    required: true
+    default: false
+    aliases: ['token']
+  access_token_secret:
+    description:
+      - The sacloud secret access token to use.
+    required: true
+    default: false
+    aliases: ['token_secret']
+  zone:
+    description:
+      - The sacloud zone to use.
+    required: false
+    default: is1a
+    choices: ['is1a', 'is1b', 'tk1a', 'tk1v']
+  http_pool_size:
+    description:
+      - Maximum number of keep-alive connections to the API.
+      - The resource types are listed concurrently over these connections.
+    required: false
+    default: 4
+  http_timeout:
+    description:
+      - Timeout in seconds for a single API request.
+    required: false
+    default: 60
+  http_retries:
+    description:
+      - Times to send a request again after the API answered 429 or 503,
+        or 500, 502 or 504 to a request without side effects. Waits grow
+        exponentially with jitter and honor C(Retry-After).
+    required: false
+    default: 5
+  http_rate_limit:
+    description:
+      - Requests per second allowed for the account. The budget is kept in
+        a locked file in the cache directory, so every fork and module run on
+        the controller shares it. C(0) disables the limit.
+    required: false
+    default: 10
+  http_burst:
+    description:
+      - Requests allowed at once before C(http_rate_limit) applies.
+        Defaults to C(http_rate_limit).
+    required: false
+    default: null
+  api_root:
+    description:
+      - Base URL of the API, such as a local fake for tests. Falls back to
+        the C(SACLOUD_API_ROOT) environment variable, then to the sacloud
+        endpoint.
+    required: false
+    default: null
+  agent:
+    description:
+      - Let a running sacloud agent (C(agent/sacloud_agent.py)) do the work
+        when one listens on C(agent_socket). The task then skips importing
+        saklient, authorizing and connecting to the API.
+    required: false
+    default: true
+  agent_socket:
+    description:
+      - Unix socket of the sacloud agent. Falls back to the
+        C(SACLOUD_AGENT_SOCKET) environment variable, then to
+        C(~/.cache/ansible-sacloud/agent.sock).
+    required: false
+    default: null
+  metrics:
+    description:
+      - Return C(sacloud_metrics) with the wall-clock time of each phase of
+        the run, API requests by method and endpoint, bytes transferred,
+        retries and wait poll counts.
+    required: false
+    default: false
+  resources:
+    description:
+      - Resource types to fetch. All types are fetched by default.
+    required: false
+    default: ['appliances', 'archives', 'disks', 'routers', 'servers', 'switches']
+    choices: ['appliances', 'archives', 'disks', 'routers', 'servers', 'switches']
+  page_size:
+    description:
+      - Number of resources requested per API call.
+    required: false
+    default: 100
+'''
+
+EXAMPLES = '''
+# Gather all resources of a zone
+- sacloud_facts:
+    access_token: _YOUR_ACCESS_TOKEN_HERE_
+    access_token_secret: _YOUR_ACCESS_TOKEN_SECRET_HERE_
+
+- debug:
+    msg: "{{ sacloud_facts.servers.ids[item].Name }}"
+  with_items: "{{ sacloud_facts.servers.tags['@web'] }}"
+
+# Only fetch servers and disks
+- sacloud_facts:
+    access_token: _YOUR_ACCESS_TOKEN_HERE_
+    access_token_secret: _YOUR_ACCESS_TOKEN_SECRET_HERE_
+    resources:
+      - servers
+      - disks
+
+- debug:
+    msg: "{{ sacloud_facts.disks.names['web01 disk'] }}"
+'''
+
+try:
+    from saklient.cloud.api import API
+    HAS_SAKLIENT = True
+except ImportError:
+    HAS_SAKLIENT = False
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=facts_argument_spec(),
+        supports_check_mode=True
+    )
+
+    # an agent on the controller does the work with a warm session
+    sacloud_agent_call(module, 'sacloud_facts')
+
+    if not HAS_SAKLIENT:
+        module.fail_json(msg='Required module saklient not found')
+
+    run_facts(module, sacloud_client(module))
+
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.sacloud.agent import sacloud_agent_call
+from ansible.module_utils.sacloud.client import sacloud_client
+from ansible.module_utils.sacloud.facts import facts_argument_spec, run_facts
+if __name__ == '__main__':
+    main()
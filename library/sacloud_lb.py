@@ -24,6 +24,9 @@ module: sacloud_lb
 short_description: Manage sacloud load balancer.
 description:
   - Create, update and remove sacloud load balancers.
+  - With C(state=present) an existing load balancer, given by
+    C(lb_resource_id) or found by its exact name, is compared with the
+    options and only the name, description, tags and icon are updated.
 author:
   - "Koji Nakayama (@knakayama)"
 requirements:
@@ -48,6 +51,105 @@ options:
     required: false
     default: 'is1a'
     choices: ['is1a', 'is1b', 'tk1a', 'tk1v']
+  http_pool_size:
+    description:
+      - Maximum number of keep-alive connections to the API.
+    required: false
+    default: 4
+  http_timeout:
+    description:
+      - Timeout in seconds for a single API request.
+    required: false
+    default: 60
+  http_retries:
+    description:
+      - Times to send a request again after the API answered 429 or 503,
+        or 500, 502 or 504 to a request without side effects. Waits grow
+        exponentially with jitter and honor C(Retry-After).
+    required: false
+    default: 5
+  http_rate_limit:
+    description:
+      - Requests per second allowed for the account. The budget is kept in
+        a locked file in the cache directory, so every fork and module run on
+        the controller shares it. C(0) disables the limit.
+    required: false
+    default: 10
+  http_burst:
+    description:
+      - Requests allowed at once before C(http_rate_limit) applies.
+        Defaults to C(http_rate_limit).
+    required: false
+    default: null
+  api_root:
+    description:
+      - Base URL of the API, such as a local fake for tests. Falls back to
+        the C(SACLOUD_API_ROOT) environment variable, then to the sacloud
+        endpoint.
+    required: false
+    default: null
+  agent:
+    description:
+      - Let a running sacloud agent (C(agent/sacloud_agent.py)) do the work
+        when one listens on C(agent_socket). The task then skips importing
+        saklient, authorizing and connecting to the API.
+    required: false
+    default: true
+  agent_socket:
+    description:
+      - Unix socket of the sacloud agent. Falls back to the
+        C(SACLOUD_AGENT_SOCKET) environment variable, then to
+        C(~/.cache/ansible-sacloud/agent.sock).
+    required: false
+    default: null
+  metrics:
+    description:
+      - Return C(sacloud_metrics) with the wall-clock time of each phase of
+        the run, API requests by method and endpoint, bytes transferred,
+        retries and wait poll counts.
+    required: false
+    default: false
+  cache_dir:
+    description:
+      - Directory for the local lookup cache shared by parallel runs.
+    required: false
+    default: ~/.cache/ansible-sacloud
+  cache_ttl:
+    description:
+      - Seconds cached icon and plan lookups stay valid. C(0) disables the cache.
+    required: false
+    default: 86400
+  cache_refresh:
+    description:
+      - Discard the cached lookups for this account and zone before running.
+      - Also fetch the unused router switch addresses again, which are
+        otherwise trusted for five minutes.
+    required: false
+    default: false
+  state_file:
+    description:
+      - File keeping the result of C(present) runs, by a fingerprint of the
+        module, zone and name or id of the task. A run with the same
+        params as the last one applied returns that result, without looking
+        up and comparing the resource, once a single request has shown the
+        resource still exists. Nothing is kept when not set.
+    required: false
+    default: null
+  state_refresh:
+    description:
+      - List every resource type in C(state_file) once, drop the entries
+        of resources that are gone, and run the task in full.
+    required: false
+    default: false
+  dry_run:
+    description:
+      - Run in check mode and report the C(diff) of what the task would
+        change. Servers, disks, routers, switches, appliances and archives
+        are listed once and cached for the tasks after, so a dry run of
+        many tasks costs a constant number of requests. Tasks that change
+        something drop the cached listing.
+    required: false
+    default: false
   name:
     description:
       - The router name
@@ -76,6 +178,8 @@ options:
   real_ips:
     description:
       - ipv4 address range
+      - Items set to C(auto) lease free addresses of the switch of
+        C(router_resource_id), see C(virtual_ip).
     required: false
     default: false
   high_spec:
@@ -91,6 +195,10 @@ options:
   virtual_ip:
     description:
       - The virtual ip to use
+      - C(auto) leases a free address of the switch of C(router_resource_id)
+        from the local address table. Leased addresses are kept for the load
+        balancer name, returned as C(sacloud_lb_virtual_ip) and
+        C(sacloud_lb_real_ips), and released when it is removed.
     required: false
     default: false
   port:
@@ -129,6 +237,50 @@ options:
       - The lbserver response code to expect
     required: false
     default: 200
+  virtual_ips:
+    description:
+      - List of virtual IPs with their real servers. Replaces C(virtual_ip)
+        and C(lbserver_ips).
+      - Each item needs C(virtual_ip) and accepts C(port), C(delay_loop) and
+        C(servers). Each server is an IP address or a dict with C(ip),
+        C(port), C(protocol), C(path), C(response) and C(enabled).
+        Missing values fall back to C(port), C(delay_loop) and the
+        C(lbserver_*) options.
+      - On an existing load balancer the list is compared with the current
+        settings. Only the virtual IPs and servers that differ are changed,
+        VIPs missing from the list are removed, and the settings are saved
+        and applied once.
+    required: false
+    default: false
+  lbserver_state:
+    description:
+      - Change only the real servers in C(lbserver_ips) and keep the rest of
+        the settings.
+      - C(present) adds or updates them with the C(lbserver_*) health check,
+        C(absent) removes them, C(enabled) and C(disabled) switch existing
+        ones on or off.
+      - They are changed in every virtual IP, or only in C(virtual_ip) if
+        it is given.
+    required: false
+    default: false
+    choices: ['present', 'absent', 'enabled', 'disabled']
+  defer:
+    description:
+      - Record the virtual IP and real server changes in a local journal
+        under C(cache_dir) instead of writing them. Needs C(lb_resource_id)
+        and makes no API call.
+      - Run C(state=flushed) afterwards to merge all recorded changes and
+        save and apply each load balancer once, however many tasks or
+        hosts recorded changes.
+    required: false
+    default: false
+  wait:
+    description:
+      - Wait until the load balancer has been created, booted or stopped.
+      - Set to C(false) to return as soon as the API accepts the request,
+        and use M(sacloud_wait) to wait for many resources at once.
+    required: false
+    default: true
   state:
     description:
       - On C(present), it will create if load balancer does not exist.
@@ -136,8 +288,10 @@ options:
       - On C(stopped) will stop a load balancer if it exists.
       - On C(running) check if a load balancer exists and is running.
       - On C(applied) apply settings.
+      - On C(flushed) write the changes recorded with C(defer) for
+        C(lb_resource_id), or for all load balancers if it is not given.
     required: false
-    choices: ['present', 'absent', 'stopped', 'running', 'applied']
+    choices: ['present', 'absent', 'stopped', 'running', 'applied', 'flushed']
     default: 'present'
 '''
 
@@ -173,6 +327,44 @@ sacloud_lb:
   lbserver_response: 200
   state: present
 
+# Serve two ports and add a real server to an existing load balancer
+- sacloud_lb:
+    access_token: _YOUR_ACCESS_TOKEN_HERE_
+    access_token_secret: _YOUR_ACCESS_TOKEN_SECRET_HERE_
+    lb_resource_id: _YOUR_LB_RESOURCE_ID_HERE_
+    virtual_ips:
+      - virtual_ip: _YOUR_VIRTUAL_IP_HERE_
+        port: 80
+        servers:
+          - _YOUR_LBSERVER_IP_HERE_
+          - _YOUR_OTHER_LBSERVER_IP_HERE_
+      - virtual_ip: _YOUR_VIRTUAL_IP_HERE_
+        port: 443
+        servers:
+          - ip: _YOUR_LBSERVER_IP_HERE_
+            protocol: tcp
+    state: present
+
+# Take every web server out of the load balancer while it is updated,
+# then reload the load balancer once
+- sacloud_lb:
+    access_token: _YOUR_ACCESS_TOKEN_HERE_
+    access_token_secret: _YOUR_ACCESS_TOKEN_SECRET_HERE_
+    lb_resource_id: _YOUR_LB_RESOURCE_ID_HERE_
+    lbserver_ips:
+      - "{{ ansible_default_ipv4.address }}"
+    lbserver_state: disabled
+    defer: true
+  delegate_to: localhost
+
+- sacloud_lb:
+    access_token: _YOUR_ACCESS_TOKEN_HERE_
+    access_token_secret: _YOUR_ACCESS_TOKEN_SECRET_HERE_
+    lb_resource_id: _YOUR_LB_RESOURCE_ID_HERE_
+    state: flushed
+  delegate_to: localhost
+  run_once: true
+
 # Destroy a load balancer
 - sacloud_lb:
     access_token: _YOUR_ACCESS_TOKEN_HERE_
@@ -188,262 +380,25 @@ except ImportError:
     HAS_SAKLIENT = False
 
 
-class LoadBalancer():
-
-    def __init__(self, module, saklient):
-        self._module = module
-        self._saklient = saklient
-
-    def _get_desc(self, desc):
-        if desc:
-            return self._str2triple_quoted_str(desc)
-        else:
-            return desc
-
-    def _str2triple_quoted_str(self, desc):
-        return '''%s''' % desc
-
-    def _get_tags(self, tags):
-        if tags:
-            return self._parse_tags(tags)
-        else:
-            return tags
-
-    def _parse_tags(self, tags):
-        return [''.join(['@', x]) for x in tags]
-
-    def _get_icon(self, icon):
-        if icon:
-            return self._get_icon_with_name_like(icon)
-        else:
-            return icon
-
-    def _get_icon_with_name_like(self, icon):
-        try:
-            return self._saklient.icon \
-                    .with_name_like(icon) \
-                    .limit(1) \
-                    .find()[0]
-        except Exception, e:
-            self._fail(msg='Failed to find router icon: %s' % e)
-
-    def _get_swytch_by_id(self, router_resource_id):
-        return self._get_router_by_id(router_resource_id).get_swytch()
-
-    def _get_router_by_id(self, router_resource_id):
-        try:
-            return self._saklient.router.get_by_id(str(router_resource_id))
-        except Exception:
-            self._fail(msg='Failed to find router: %s' % router_resource_id)
-
-    def stop(self, lb_resource_id):
-        _lb = self._get_lb_by_id(lb_resource_id)
-
-        if _lb.status == 'down':
-            self._success(changed=False, result='The load balancer already stopped')
-        elif self._module.check_mode:
-            self._success()
-
-        try:
-            if self._module.params['force']:
-                _lb.stop()
-            else:
-                _lb.shutdown()
-            _lb.sleep_until_down()
-        except Exception, e:
-            self._fail(msg='Failed to stop load balancer: %s' % e)
-        self._success(result='Successfully stop load balancer')
-
-    def boot(self, lb_resource_id):
-        _lb = self._get_lb_by_id(lb_resource_id)
-
-        if _lb.status == 'up':
-            self._success(changed=False, result='The load balancer already running')
-        elif self._module.check_mode:
-            self._success()
-        try:
-            _lb.boot()
-            _lb.sleep_until_up()
-        except Exception, e:
-            self._fail(msg='Failed to boot load balancer: %s' % e)
-        self._success(result='Successfully boot load balancer')
-
-    def destroy(self, lb_resource_id):
-        _lb = self._get_lb_by_id(lb_resource_id)
-
-        if self._module.check_mode:
-            self._success()
-
-        try:
-            if _lb.status == 'up':
-                _lb.stop()
-            _lb.destroy()
-        except Exception, e:
-            self._fail(msg='Failed to destroy load balancer: %s' % e)
-        self._success(result='Successfully destroy load balancer: %d'
-                        % int(_lb.id))
-
-    def _get_lb_by_id(self, lb_resource_id):
-        try:
-            return self._saklient.appliance.get_by_id(str(lb_resource_id))
-        except Exception, e:
-            self._fail(msg='Failed to find load balancer: %s' % e)
-
-    def update(self, lb_resource_id):
-        # TODO: implement update
-        pass
-
-    def create(self, router_resource_id, vrid, real_ips, high_spec, virtual_ip, lbserver_ips):
-        swytch = self._get_swytch_by_id(router_resource_id)
-
-        if self._module.check_mode:
-            self._success()
-
-        try:
-            _lb = self._saklient.appliance.create_load_balancer(swytch, vrid, real_ips, high_spec)
-        except Exception, e:
-            self._fail(msg='Failed to create load balancer object: %s' % e)
-
-        self._set_params(_lb, swytch.id, vrid, virtual_ip, lbserver_ips)
-        try:
-            _lb.save()
-            _lb.sleep_while_creating()
-        except Exception, e:
-            self._fail(msg='Failed to create load balancer: %s' % e)
-        self._success(result='Successfully create load balancer: %s' % _lb.id,
-                            ansible_facts=dict(sacloud_lb_resource_id=_lb.id))
-
-    def _set_params(self, _lb, swytch_id, vrid, virtual_ip, lbserver_ips):
-        _lb.name = self._module.params['name']
-        _lb.vrid = vrid
-
-        if self._module.params['desc']:
-            _lb.description = self._get_desc(self._module.params['desc'])
-        if self._module.params['tags']:
-            _lb.tags = self._get_tags(self._module.params['tags'])
-        if self._module.params['icon']:
-            _lb.icon = self._get_icon(self._module.params['icon'])
-
-        self._add_lbservers(_lb, virtual_ip, lbserver_ips)
-
-    def _add_lbservers(self, _lb, virtual_ip, lbserver_ips):
-        vip = self._add_virtual_ip(_lb, virtual_ip)
-
-        for lbserver_ip in lbserver_ips:
-            lbserver = vip.add_server()
-            lbserver.ip_address = lbserver_ip
-            lbserver.port = self._module.params['lbserver_port']
-            lbserver.protocol = self._module.params['lbserver_protocol']
-            lbserver.path_to_check = self._module.params['lbserver_path']
-            lbserver.response_expected = self._module.params['lbserver_response']
-
-    def _add_virtual_ip(self, _lb, virtual_ip):
-        vip = _lb.add_virtual_ip()
-        vip.virtual_ip_address = virtual_ip
-        vip.port = self._module.params['port']
-        vip.delay_loop = self._module.params['delay_loop']
-
-        return vip
-
-    def apply(self, lb_resource_id):
-        _lb = self._get_lb_by_id(lb_resource_id)
-
-        if self._module.check_mode:
-            self._success()
-
-        try:
-            _lb.apply()
-        except Exception, e:
-            self._fail(msg='Failed to apply load balancer: %s' % e)
-        self._success(result='Successfully apply load balancer: %d'
-                        % int(_lb.id))
-
-    def _fail(self, msg):
-        self._module.fail_json(msg=msg)
-
-    def _success(self, changed=True, **kwargs):
-        self._module.exit_json(changed=changed, **kwargs)
-
-
 def main():
     module = AnsibleModule(
-        argument_spec=dict(
-            access_token=dict(required=True, aliases=['token']),
-            access_token_secret=dict(required=True, aliases=['token_secret']),
-            zone=dict(required=False, default='is1a',
-                            choices=['is1a', 'is1b', 'tk1a', 'tk1v']),
-            router_resource_id=dict(required=False, type='int'),
-            lb_resource_id=dict(required=False, type='int'),
-            name=dict(required=False, default='default'),
-            desc=dict(required=False),
-            tags=dict(required=False, type='list'),
-            icon=dict(required=False),
-            vrid=dict(required=False, type='int'),
-            real_ips=dict(required=False, type='list'),
-            high_spec=dict(required=False, default=False, type='bool'),
-            force=dict(required=False, default=False, type='bool'),
-            virtual_ip=dict(required=False),
-            port=dict(required=False, default=80, type='int'),
-            delay_loop=dict(required=False, default=10, type='int'),
-            lbserver_ips=dict(required=False, type='list'),
-            lbserver_port=dict(required=False, default=80, type='int'),
-            lbserver_protocol=dict(required=False, default='http',
-                                    choices=['http', 'https', 'tcp', 'ping']),
-            lbserver_path=dict(required=False, default='/index.html'),
-            lbserver_response=dict(required=False, default=200, type='int'),
-            state=dict(required=False, default='present',
-                        choices=['present', 'absent', 'stopped', 'running', 'applied'])
-        ),
+        argument_spec=lb_argument_spec(),
+        mutually_exclusive=LB_MUTUALLY_EXCLUSIVE,
         supports_check_mode=True
     )
 
+    # an agent on the controller does the work with a warm session
+    sacloud_agent_call(module, 'sacloud_lb')
+
     if not HAS_SAKLIENT:
         module.fail_json(msg='Required module saklient not found')
 
-    try:
-        saklient = API.authorize(module.params['access_token'],
-                                module.params['access_token_secret'],
-                                module.params['zone'])
-    except Exception, e:
-        module.fail_json(msg='Failed to access sacloud: %s' % e)
-
-    lb = LoadBalancer(module, saklient)
-
-    if module.params['state'] in ['absent', 'stopped', 'running', 'applied'] \
-            and not module.params['lb_resource_id']:
-        module.fail_json(msg='missing required arguments: lb_resource_id')
-
-    # TODO: more convinient way to handle args
-    if module.params['state'] == 'present':
-        if module.params['lb_resource_id']:
-            ## TODO: implement update
-            #lb.update(module.params['lb_resource_id'])
-            module.exit_json(changed=False)
-        elif not module.params['router_resource_id']:
-            module.fail_json(msg='missing required arguments: router_resource_id')
-        elif not module.params['vrid']:
-            module.fail_json(msg='missing required arguments: vrid')
-        elif not module.params['real_ips']:
-            module.fail_json(msg='missing required arguments: real_ips')
-        elif not module.params['lbserver_ips']:
-            module.fail_json(msg='missing required arguments: lbserver_ips')
-        else:
-            lb.create(module.params['router_resource_id'],
-                        module.params['vrid'],
-                        module.params['real_ips'],
-                        module.params['high_spec'],
-                        module.params['virtual_ip'],
-                        module.params['lbserver_ips'])
-    elif module.params['state'] == 'absent':
-        lb.destroy(module.params['lb_resource_id'])
-    elif module.params['state'] == 'stopped':
-        lb.stop(module.params['lb_resource_id'])
-    elif module.params['state'] == 'running':
-        lb.boot(module.params['lb_resource_id'])
-    else:
-        lb.apply(module.params['lb_resource_id'])
+    run_lb(module, sacloud_client(module))
 
 
 from ansible.module_utils.basic import *
+from ansible.module_utils.sacloud.agent import sacloud_agent_call
+from ansible.module_utils.sacloud.client import sacloud_client
+from ansible.module_utils.sacloud.lb import LB_MUTUALLY_EXCLUSIVE, lb_argument_spec, run_lb
 if __name__ == '__main__':
     main()
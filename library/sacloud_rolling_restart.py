@@ -0,0 +1,214 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: sacloud_rolling_restart
+short_description: Restart a tagged group of sacloud servers in batches.
+description:
+  - Restart every server carrying all of C(tags), a batch at a time.
+  - With C(lb_resource_id), the real servers of a batch are disabled on
+    the load balancer before its servers are stopped, enabled again once
+    they have booted, and the next batch starts when their health checks
+    pass.
+  - The servers of a batch are stopped and booted concurrently. Batches
+    are as large as C(batch_size) and C(min_in_service) allow; servers
+    that are already out of service are restarted first.
+  - Servers that are stopped are left stopped and returned as C(skipped).
+  - Servers on a router switch are matched with the real servers by the
+    addresses C(config_ipv4_address=auto) leased for their disks when
+    their interfaces show none. The task fails before restarting anything
+    when a server has no address to drain.
+  - In check mode, the batches are returned without restarting anything.
+author:
+  - "Koji Nakayama (@knakayama)"
+requirements:
+  - "python >= 2.6"
+  - saklient
+options:
+  access_token:
+    description:
+      - The sacloud access token to use.
+    required: true
+    default: false
+    aliases: ['token']
+  access_token_secret:
+    description:
+      - The sacloud secret access token to use.
+    required: true
+    default: false
+    aliases: ['token_secret']
+  zone:
+    description:
+      - The sacloud zone to use.
+    required: false
+    default: is1a
+    choices: ['is1a', 'is1b', 'tk1a', 'tk1v']
+  http_pool_size:
+    description:
+      - Maximum number of keep-alive connections to the API.
+    required: false
+    default: 4
+  http_timeout:
+    description:
+      - Timeout in seconds for a single API request.
+    required: false
+    default: 60
+  http_retries:
+    description:
+      - Times to send a request again after the API answered 429 or 503,
+        or 500, 502 or 504 to a request without side effects. Waits grow
+        exponentially with jitter and honor C(Retry-After).
+    required: false
+    default: 5
+  http_rate_limit:
+    description:
+      - Requests per second allowed for the account. The budget is kept in
+        a locked file in the cache directory, so every fork and module run on
+        the controller shares it. C(0) disables the limit.
+    required: false
+    default: 10
+  http_burst:
+    description:
+      - Requests allowed at once before C(http_rate_limit) applies.
+        Defaults to C(http_rate_limit).
+    required: false
+    default: null
+  api_root:
+    description:
+      - Base URL of the API, such as a local fake for tests. Falls back to
+        the C(SACLOUD_API_ROOT) environment variable, then to the sacloud
+        endpoint.
+    required: false
+    default: null
+  agent:
+    description:
+      - Let a running sacloud agent (C(agent/sacloud_agent.py)) do the work
+        when one listens on C(agent_socket). The task then skips importing
+        saklient, authorizing and connecting to the API.
+    required: false
+    default: true
+  agent_socket:
+    description:
+      - Unix socket of the sacloud agent. Falls back to the
+        C(SACLOUD_AGENT_SOCKET) environment variable, then to
+        C(~/.cache/ansible-sacloud/agent.sock).
+    required: false
+    default: null
+  metrics:
+    description:
+      - Return C(sacloud_metrics) with the wall-clock time of each phase of
+        the run, API requests by method and endpoint, bytes transferred,
+        retries and wait poll counts.
+    required: false
+    default: false
+  cache_dir:
+    description:
+      - Directory for the local lookup cache shared by parallel runs.
+    required: false
+    default: ~/.cache/ansible-sacloud
+  cache_ttl:
+    description:
+      - Seconds cached icon and plan lookups stay valid. C(0) disables the cache.
+    required: false
+    default: 86400
+  cache_refresh:
+    description:
+      - Discard the cached lookups for this account and zone before running.
+      - Also fetch the unused router switch addresses again, which are
+        otherwise trusted for five minutes.
+    required: false
+    default: false
+  tags:
+    description:
+      - Tags a server must all carry to be restarted, as given to
+        M(sacloud_server).
+    required: true
+  lb_resource_id:
+    description:
+      - The load balancer to drain the servers from. Its real servers are
+        matched with the addresses of the servers' interfaces.
+    required: false
+    default: null
+  batch_size:
+    description:
+      - Maximum number of servers restarted at once.
+      - Defaults to as many as C(min_in_service) allows, or 1 without it.
+    required: false
+    default: null
+  min_in_service:
+    description:
+      - Servers that must stay up and pass their health checks while a
+        batch restarts.
+    required: false
+    default: null
+  force:
+    description:
+      - Stop the servers instead of shutting them down.
+    required: false
+    default: false
+  health_timeout:
+    description:
+      - Seconds to wait for the health checks of a batch to pass.
+    required: false
+    default: 300
+'''
+
+EXAMPLES = '''
+# Restart the web servers two at a time, keeping three of them serving
+- sacloud_rolling_restart:
+    access_token: _YOUR_ACCESS_TOKEN_HERE_
+    access_token_secret: _YOUR_ACCESS_TOKEN_SECRET_HERE_
+    tags:
+      - web
+    lb_resource_id: _LB_RESOURCE_ID_HERE_
+    batch_size: 2
+    min_in_service: 3
+  register: result
+'''
+
+try:
+    from saklient.cloud.api import API
+    HAS_SAKLIENT = True
+except ImportError:
+    HAS_SAKLIENT = False
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=rolling_restart_argument_spec(),
+        supports_check_mode=True
+    )
+
+    # an agent on the controller does the work with a warm session
+    sacloud_agent_call(module, 'sacloud_rolling_restart')
+
+    if not HAS_SAKLIENT:
+        module.fail_json(msg='Required module saklient not found')
+
+    run_rolling_restart(module, sacloud_client(module))
+
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.sacloud.agent import sacloud_agent_call
+from ansible.module_utils.sacloud.client import sacloud_client
+from ansible.module_utils.sacloud.rolling import rolling_restart_argument_spec, run_rolling_restart
+if __name__ == '__main__':
+    main()
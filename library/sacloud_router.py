@@ -24,6 +24,10 @@ module: sacloud_router
 short_description: Manage sacloud router.
 description:
   - Create, update and remove sacloud routers.
+  - With C(state=present) an existing router, given by C(router_resource_id)
+    or found by its exact name, is compared with the options and only the
+    differences are written. The network mask length of an existing router
+    cannot be changed.
 author:
   - "Koji Nakayama (@knakayama)"
 requirements:
@@ -48,6 +52,105 @@ options:
     required: false
     default: 'is1a'
     choices: ['is1a', 'is1b', 'tk1a', 'tk1v']
+  http_pool_size:
+    description:
+      - Maximum number of keep-alive connections to the API.
+    required: false
+    default: 4
+  http_timeout:
+    description:
+      - Timeout in seconds for a single API request.
+    required: false
+    default: 60
+  http_retries:
+    description:
+      - Times to send a request again after the API answered 429 or 503,
+        or 500, 502 or 504 to a request without side effects. Waits grow
+        exponentially with jitter and honor C(Retry-After).
+    required: false
+    default: 5
+  http_rate_limit:
+    description:
+      - Requests per second allowed for the account. The budget is kept in
+        a locked file in the cache directory, so every fork and module run on
+        the controller shares it. C(0) disables the limit.
+    required: false
+    default: 10
+  http_burst:
+    description:
+      - Requests allowed at once before C(http_rate_limit) applies.
+        Defaults to C(http_rate_limit).
+    required: false
+    default: null
+  api_root:
+    description:
+      - Base URL of the API, such as a local fake for tests. Falls back to
+        the C(SACLOUD_API_ROOT) environment variable, then to the sacloud
+        endpoint.
+    required: false
+    default: null
+  agent:
+    description:
+      - Let a running sacloud agent (C(agent/sacloud_agent.py)) do the work
+        when one listens on C(agent_socket). The task then skips importing
+        saklient, authorizing and connecting to the API.
+    required: false
+    default: true
+  agent_socket:
+    description:
+      - Unix socket of the sacloud agent. Falls back to the
+        C(SACLOUD_AGENT_SOCKET) environment variable, then to
+        C(~/.cache/ansible-sacloud/agent.sock).
+    required: false
+    default: null
+  metrics:
+    description:
+      - Return C(sacloud_metrics) with the wall-clock time of each phase of
+        the run, API requests by method and endpoint, bytes transferred,
+        retries and wait poll counts.
+    required: false
+    default: false
+  cache_dir:
+    description:
+      - Directory for the local lookup cache shared by parallel runs.
+    required: false
+    default: ~/.cache/ansible-sacloud
+  cache_ttl:
+    description:
+      - Seconds cached icon and plan lookups stay valid. C(0) disables the cache.
+    required: false
+    default: 86400
+  cache_refresh:
+    description:
+      - Discard the cached lookups for this account and zone before running.
+      - Also fetch the unused router switch addresses again, which are
+        otherwise trusted for five minutes.
+    required: false
+    default: false
+  state_file:
+    description:
+      - File keeping the result of C(present) runs, by a fingerprint of the
+        module, zone and name or id of the task. A run with the same
+        params as the last one applied returns that result, without looking
+        up and comparing the resource, once a single request has shown the
+        resource still exists. Nothing is kept when not set.
+    required: false
+    default: null
+  state_refresh:
+    description:
+      - List every resource type in C(state_file) once, drop the entries
+        of resources that are gone, and run the task in full.
+    required: false
+    default: false
+  dry_run:
+    description:
+      - Run in check mode and report the C(diff) of what the task would
+        change. Servers, disks, routers, switches, appliances and archives
+        are listed once and cached for the tasks after, so a dry run of
+        many tasks costs a constant number of requests. Tasks that change
+        something drop the cached listing.
+    required: false
+    default: false
   name:
     description:
       - The router name
@@ -80,6 +183,19 @@ options:
       - The router icon
     required: false
     default: false
+  wait:
+    description:
+      - Wait until the router has been created.
+      - Set to C(false) to return as soon as the API accepts the request,
+        and use M(sacloud_wait) to wait for many resources at once.
+      - The switch facts (C(sacloud_default_route), C(sacloud_ipv4_addresses))
+        are only returned when waiting.
+      - C(sacloud_ipv4_addresses) lists the addresses of the switch that are
+        neither used nor leased by C(config_ipv4_address=auto) of
+        M(sacloud_disk) or C(virtual_ip=auto) of M(sacloud_lb), as the API
+        lists them when the task runs. The leases are kept in C(cache_dir).
+    required: false
+    default: true
   state:
     description:
       - On C(present), it will create if router does not exist.
@@ -94,11 +210,27 @@ options:
       - The resource id for the server
     required: false
     default: false
+  server_resource_ids:
+    description:
+      - List of servers to connect to or disconnect from the switch of
+        C(router_resource_id) in one call, instead of C(server_resource_id).
+      - A server that already has an iface on the switch is left as it is on
+        C(connected). On C(disconnected) every iface of the server on the
+        switch is disconnected.
+      - Returns the iface of every server in C(sacloud_iface_resource_ids).
+    required: false
+    default: false
   iface_resource_id:
     description:
       - The resource id for the server iface
     required: false
     default: false
+  concurrency:
+    description:
+      - Maximum number of servers handled at the same time with
+        C(server_resource_ids).
+    required: false
+    default: 4
 '''
 
 EXAMPLES = '''
@@ -121,6 +253,17 @@ EXAMPLES = '''
       - boot-network
     state: present
 
+# Connect three servers to a router
+- sacloud_router:
+    access_token: _YOUR_ACCESS_TOKEN_HERE_
+    access_token_secret: _YOUR_ACCESS_TOKEN_SECRET_HERE_
+    router_resource_id: _ROUTER_RESOURCE_ID_HERE_
+    server_resource_ids:
+      - _SERVER_RESOURCE_ID_HERE_
+      - _SERVER_RESOURCE_ID_HERE_
+      - _SERVER_RESOURCE_ID_HERE_
+    state: connected
+
 # Destroy a router
 - sacloud_router:
     access_token: _YOUR_ACCESS_TOKEN_HERE_
@@ -136,274 +279,25 @@ except ImportError:
     HAS_SAKLIENT = False
 
 
-class Router():
-
-    def __init__(self, module, saklient):
-        self._module = module
-        self._saklient = saklient
-
-    def _get_desc(self, desc):
-        if desc:
-            return self._str2triple_quoted_str(desc)
-        else:
-            return desc
-
-    def _str2triple_quoted_str(self, desc):
-        return '''%s''' % desc
-
-    # FIXME: don't work
-    def _get_tags(self, tags):
-        if tags:
-            return self._parse_tags(tags)
-        else:
-            return tags
-
-    def _parse_tags(self, tags):
-        return [''.join(['@', x]) for x in tags]
-
-    def _get_icon(self, icon):
-        if icon:
-            return self._get_icon_with_name_like(icon)
-        else:
-            return icon
-
-    def _get_icon_with_name_like(self, icon):
-        try:
-            return self._saklient.icon \
-                    .with_name_like(icon) \
-                    .limit(1) \
-                    .find()[0]
-        except Exception, e:
-            self._fail(msg='Failed to find router icon: %s' % e)
-
-    def _get_router_by_id(self, router_resource_id):
-        try:
-            return self._saklient.router.get_by_id(str(router_resource_id))
-        except Exception:
-            self._fail(msg='Failed to find router: %s' % router_resource_id)
-
-    def destroy(self):
-        _router = self._get_router_by_id(self._module.params['router_resource_id'])
-
-        if self._module.check_mode:
-            self._success()
-        try:
-            _router.destroy()
-        except Exception, e:
-            self._fail(msg='Failed to destroy router: %s' % e)
-        self._success(result='Successfully destroy router: %d'
-                        % int(_router.id))
-
-    def create(self):
-        _router = self._saklient.router.create()
-        self._set_params(_router)
-
-        if self._module.check_mode:
-            self._success()
-
-        try:
-            _router.save()
-            _router.sleep_while_creating()
-        except Exception, e:
-            self._fail(msg='Failed to create router: %s' % e)
-
-        self._success(result='Successfully create router: %s'
-                            % _router.id,
-                            ansible_facts=self._get_facts(_router))
-
-    def _get_facts(self, _router):
-        _swytch = _router.get_swytch()
-        default_route = _swytch.dump()['Subnets'][0]['DefaultRoute']
-
-        try:
-            ipv4_addresses = _swytch.collect_unused_ipv4_addresses()
-        except Exception, e:
-            self._fail(msg='Failed to collect unused ipv4 address: %s' % e)
-
-        return dict(
-                sacloud_router_resource_id=_router.id,
-                sacloud_default_route=default_route,
-                sacloud_ipv4_addresses=ipv4_addresses
-                )
-
-    # TODO: implement iface.destroy
-    def disconnect(self, server_resource_id, iface_resource_id):
-        _iface = self._get_iface_by_id(server_resource_id, iface_resource_id)
-
-        if self._module.check_mode:
-            self._success(changed=False)
-
-        try:
-            _iface.disconnect_from_swytch()
-        except Exception, e:
-            self._fail(msg='Failed to disconnect from sywitch: %s' % e)
-        self._success(result='Successfully disconnect from sywitch')
-
-    def _get_iface_by_id(self, server_resource_id, iface_resource_id):
-        for iface in self._get_ifaces_by_id(server_resource_id):
-            if iface.id == str(iface_resource_id):
-                return iface
-        self._fail(msg='Failed to find iface: %d' % iface_resource_id)
-
-    def _get_ifaces_by_id(self, server_resource_id):
-        _server = self._get_server_by_id(server_resource_id)
-
-        try:
-            return _server.get_ifaces()
-        except Exception:
-            # FIXME: UnicodeEncodeError
-            self._fail(msg='Failed to find server ifaces: %d' % server_resource_id)
-
-    def _get_server_by_id(self, server_resource_id):
-        try:
-            return self._saklient.server.get_by_id(str(server_resource_id))
-        except Exception:
-            # FIXME: UnicodeEncodeError
-            #self._fail('Failed to find server: %s' % e)
-            self._fail(msg='Failed to find server: %d' % server_resource_id)
-
-    # TODO: implement shared segment
-    def connect(self, router_resource_id, server_resource_id):
-        _router = self._get_router_by_id(router_resource_id)
-        _iface = self._add_iface_by_id(server_resource_id)
-
-        if self._module.check_mode:
-            self._success(changed=False)
-
-        try:
-            _iface.connect_to_swytch(_router.get_swytch())
-        except Exception, e:
-            self._fail(msg='Failed to connect to sywitch: %s' % e)
-        self._success(result='Successfully connect to router %d' % int(_iface.id),
-                        ansible_facts=dict(sacloud_iface_resource_id=_iface.id))
-
-    def _add_iface_by_id(self, server_resource_id):
-        _server = self._get_server_by_id(server_resource_id)
-
-        try:
-            return _server.add_iface()
-        except Exception, e:
-            # FIXME: UnicodeEncodeError
-            #self._fail(msg='Failed to find server iface: %s' % e)
-            self._fail(msg='Failed to add server iface: %d' % server_resource_id)
-
-    def update(self, router_resource_id):
-        _router = self._get_router_by_id(router_resource_id)
-
-        if self._module.check_mode:
-            self._success(changed=True)
-
-        self._set_params(_router, router_resource_id)
-        try:
-            _router.save()
-            _router.sleep_while_creating()
-        except Exception, e:
-            self._fail(msg='Failed to update router: %s' % e)
-        self._success(result='Successfully update router: %d'
-                        % int(_router.id),
-                        ansible_facts=dict(sacloud_router_resource_id=_router.id))
-
-    def _set_params(self, _router, router_resource_id=None):
-        _router.name = self._module.params['name']
-
-        if self._module.params['desc']:
-            _router.description = self._get_desc(self._module.params['desc'])
-        if self._module.params['tags']:
-            _router.tags = self._get_tags(self._module.params['tags'])
-        if self._module.params['icon']:
-            _router.icon = self._get_icon(self._module.params['icon'])
-
-        if router_resource_id:
-            if self._module.params['network_mask_len']:
-                # FIXME: Immutable fields cannot be modified after the resource creation
-                #_router.set_network_mask_len(self._module.params['network_mask_len'])
-                pass
-
-            if self._module.params['band_width_mbps']:
-                try:
-                    _router.change_plan(self._module.params['band_width_mbps'])
-                except Exception, e:
-                    self._fail(msg='Failed to change bandwidth: %s' % e)
-        else:
-            _router.network_mask_len = self._module.params['network_mask_len']
-            _router.band_width_mbps = self._module.params['band_width_mbps']
-
-    def _fail(self, msg):
-        self._module.fail_json(msg=msg)
-
-    def _success(self, changed=True, **kwargs):
-        self._module.exit_json(changed=changed, **kwargs)
-
-
 def main():
     module = AnsibleModule(
-        argument_spec=dict(
-            access_token=dict(required=True, aliases=['token']),
-            access_token_secret=dict(required=True, aliases=['token_secret']),
-            zone=dict(required=False, default='is1a',
-                            choices=['is1a', 'is1b', 'tk1a', 'tk1v']),
-            router_resource_id=dict(required=False, type='int'),
-            name=dict(required=False, default='default'),
-            desc=dict(required=False),
-            tags=dict(required=False, type='list'),
-            icon=dict(required=False),
-            band_width_mbps=dict(required=False,
-                                       default=100, type='int',
-                                       choices=[100, 500, 1000]),
-            network_mask_len=dict(required=False,
-                                        default=28, type='int',
-                                        choices=[26, 27, 28]),
-            state=dict(required=False, default='present',
-                        choices=['present', 'absent', 'connected', 'disconnected']),
-            server_resource_id=dict(required=False, type='int'),
-            iface_resource_id=dict(required=False, type='int')
-        ),
+        argument_spec=router_argument_spec(),
+        mutually_exclusive=ROUTER_MUTUALLY_EXCLUSIVE,
         supports_check_mode=True
     )
 
+    # an agent on the controller does the work with a warm session
+    sacloud_agent_call(module, 'sacloud_router')
+
     if not HAS_SAKLIENT:
         module.fail_json(msg='Required module saklient not found')
 
-    try:
-        saklient = API.authorize(module.params['access_token'],
-                                module.params['access_token_secret'],
-                                module.params['zone'])
-    except Exception, e:
-        module.fail_json(msg='Failed to access sacloud: %s' % e)
-
-    router = Router(module, saklient)
-
-    # TODO: more convinient way to handle args
-    if module.params['state'] == 'connected':
-        if not module.params['router_resource_id']:
-            module.fail_json(msg='missing required arguments: router_resource_id')
-        elif not module.params['server_resource_id']:
-            module.fail_json(msg='missing required arguments: server_resource_id')
-        else:
-            router.connect(module.params['router_resource_id'],
-                            module.params['server_resource_id'])
-    elif module.params['state'] == 'disconnected':
-        if not module.params['server_resource_id']:
-            module.fail_json(msg='missing required arguments: server_resource_id')
-        elif not module.params['iface_resource_id']:
-            module.fail_json(msg='missing required arguments: iface_resource_id')
-        else:
-            router.disconnect(module.params['server_resource_id'],
-                                module.params['iface_resource_id'])
-    elif module.params['state'] == 'absent':
-        if module.params['router_resource_id']:
-            router.destroy()
-        else:
-            module.fail_json(msg='missing required arguments: router_resource_id')
-    elif module.params['state'] == 'present':
-        if module.params['router_resource_id']:
-            ## TODO: only works with band_width_mbps
-            #router.update(module.params['router_resource_id'])
-            module.exit_json(changed=False)
-        else:
-            router.create()
+    run_router(module, sacloud_client(module))
 
 
 from ansible.module_utils.basic import *
+from ansible.module_utils.sacloud.agent import sacloud_agent_call
+from ansible.module_utils.sacloud.client import sacloud_client
+from ansible.module_utils.sacloud.router import ROUTER_MUTUALLY_EXCLUSIVE, router_argument_spec, run_router
 if __name__ == '__main__':
     main()
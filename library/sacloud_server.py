@@ -24,6 +24,9 @@ module: sacloud_server
 short_description: Manage sacloud server.
 description:
   - Create, update, remove sacloud servers.
+  - With C(state=present) an existing server, given by C(server_resource_id)
+    or found by its exact name, is compared with the options and only the
+    differences are written. Options that are not given are left as they are.
 author:
   - "Koji Nakayama (@knakayama)"
 requirements:
@@ -48,14 +51,128 @@ options:
     required: false
     default: is1a
     choices: [ 'is1a', is1b', 'tk1a', 'tk1v' ]
+  http_pool_size:
+    description:
+      - Maximum number of keep-alive connections to the API.
+    required: false
+    default: 4
+  http_timeout:
+    description:
+      - Timeout in seconds for a single API request.
+    required: false
+    default: 60
+  http_retries:
+    description:
+      - Times to send a request again after the API answered 429 or 503,
+        or 500, 502 or 504 to a request without side effects. Waits grow
+        exponentially with jitter and honor C(Retry-After).
+    required: false
+    default: 5
+  http_rate_limit:
+    description:
+      - Requests per second allowed for the account. The budget is kept in
+        a locked file in the cache directory, so every fork and module run on
+        the controller shares it. C(0) disables the limit.
+    required: false
+    default: 10
+  http_burst:
+    description:
+      - Requests allowed at once before C(http_rate_limit) applies.
+        Defaults to C(http_rate_limit).
+    required: false
+    default: null
+  api_root:
+    description:
+      - Base URL of the API, such as a local fake for tests. Falls back to
+        the C(SACLOUD_API_ROOT) environment variable, then to the sacloud
+        endpoint.
+    required: false
+    default: null
+  agent:
+    description:
+      - Let a running sacloud agent (C(agent/sacloud_agent.py)) do the work
+        when one listens on C(agent_socket). The task then skips importing
+        saklient, authorizing and connecting to the API.
+    required: false
+    default: true
+  agent_socket:
+    description:
+      - Unix socket of the sacloud agent. Falls back to the
+        C(SACLOUD_AGENT_SOCKET) environment variable, then to
+        C(~/.cache/ansible-sacloud/agent.sock).
+    required: false
+    default: null
+  metrics:
+    description:
+      - Return C(sacloud_metrics) with the wall-clock time of each phase of
+        the run, API requests by method and endpoint, bytes transferred,
+        retries and wait poll counts.
+    required: false
+    default: false
+  cache_dir:
+    description:
+      - Directory for the local lookup cache shared by parallel runs.
+    required: false
+    default: ~/.cache/ansible-sacloud
+  cache_ttl:
+    description:
+      - Seconds cached icon and plan lookups stay valid. C(0) disables the cache.
+    required: false
+    default: 86400
+  cache_refresh:
+    description:
+      - Discard the cached lookups for this account and zone before running.
+      - Also fetch the unused router switch addresses again, which are
+        otherwise trusted for five minutes.
+    required: false
+    default: false
+  state_file:
+    description:
+      - File keeping the result of C(present) runs, by a fingerprint of the
+        module, zone and name or id of the task. A run with the same
+        params as the last one applied returns that result, without looking
+        up and comparing the resource, once a single request has shown the
+        resource still exists. Nothing is kept when not set.
+    required: false
+    default: null
+  state_refresh:
+    description:
+      - List every resource type in C(state_file) once, drop the entries
+        of resources that are gone, and run the task in full.
+    required: false
+    default: false
+  dry_run:
+    description:
+      - Run in check mode and report the C(diff) of what the task would
+        change. Servers, disks, routers, switches, appliances and archives
+        are listed once and cached for the tasks after, so a dry run of
+        many tasks costs a constant number of requests. Tasks that change
+        something drop the cached listing.
+    required: false
+    default: false
   server_resource_id:
     description:
       - The resource id for the server
     required: false
     default: false
+  server_resource_ids:
+    description:
+      - The resource ids of servers to remove at once on C(absent).
+      - Running servers are stopped together, waited for with one poll per
+        interval and then removed in parallel.
+    required: false
+    default: null
+  with_disks:
+    description:
+      - On C(absent), remove the disks connected to the servers with them.
+      - Interfaces are always removed with their server.
+    required: false
+    default: false
   cpu:
     description:
       - Server cpu
+      - Changing the cpu or memory of an existing server changes its plan,
+        which requires the server to be stopped.
     required: false
     default: 1
   mem:
@@ -66,6 +183,9 @@ options:
   name:
     description:
       - Server name
+      - With C(count), C({index}) in the name is replaced by the instance number.
+      - Servers that already exist with the same name are updated instead of
+        created again.
     required: false
     default: default
   desc:
@@ -86,8 +206,40 @@ options:
   force:
     description:
       - force to stop server
+      - Also applies to running servers stopped to be removed.
     required: false
     default: false
+  instances:
+    description:
+      - List of server specs to create at once.
+      - Each item accepts C(name), C(cpu), C(mem), C(desc), C(tags) and C(icon),
+        and falls back to the module options for missing keys.
+    required: false
+    default: false
+  count:
+    description:
+      - Number of servers to create at once from the module options.
+    required: false
+    default: false
+  start_index:
+    description:
+      - First instance number used with C(count)
+    required: false
+    default: 1
+  concurrency:
+    description:
+      - Maximum number of servers created in parallel with C(instances) or
+        C(count), or stopped and removed in parallel on C(absent)
+    required: false
+    default: 4
+  wait:
+    description:
+      - Wait until the server has booted or stopped.
+      - Set to C(false) to return as soon as the API accepts the request,
+        and use M(sacloud_wait) to wait for many resources at once.
+      - A running server is always stopped before it is removed.
+    required: false
+    default: true
   state:
     description:
       - On C(present), it will create if server does not exist.
@@ -119,12 +271,55 @@ EXAMPLES = '''
       - keyboard-us
     state: present
 
+# Create 40 servers, 8 at a time
+- sacloud_server:
+    access_token: _YOUR_ACCESS_TOKEN_HERE_
+    access_token_secret: _YOUR_ACCESS_TOKEN_SECRET_HERE_
+    name: "web{index}.example.com"
+    count: 40
+    concurrency: 8
+    cpu: 2
+    mem: 2
+    icon: Ubuntu
+    state: present
+
+# Create servers from a list of specs
+- sacloud_server:
+    access_token: _YOUR_ACCESS_TOKEN_HERE_
+    access_token_secret: _YOUR_ACCESS_TOKEN_SECRET_HERE_
+    instances:
+      - name: web01.example.com
+      - name: db01.example.com
+        cpu: 4
+        mem: 8
+    icon: Ubuntu
+    state: present
+
 # Destroy a server
 - sacloud_server:
     access_token: _YOUR_ACCESS_TOKEN_HERE_
     access_token_secret: _YOUR_ACCESS_TOKEN_SECRET_HERE_
     server_resource_id: _SERVER_RESOURCE_ID_HERE_
     state: absent
+
+# Destroy servers with their disks
+- sacloud_server:
+    access_token: _YOUR_ACCESS_TOKEN_HERE_
+    access_token_secret: _YOUR_ACCESS_TOKEN_SECRET_HERE_
+    server_resource_ids: "{{ sacloud_server_resource_ids }}"
+    with_disks: true
+    force: true
+    state: absent
+
+# Show what the task would change without changing anything
+- sacloud_server:
+    access_token: _YOUR_ACCESS_TOKEN_HERE_
+    access_token_secret: _YOUR_ACCESS_TOKEN_SECRET_HERE_
+    name: web01.example.com
+    cpu: 2
+    mem: 4
+    dry_run: true
+  register: result
 '''
 
 try:
@@ -134,192 +329,25 @@ except ImportError:
     HAS_SAKLIENT = False
 
 
-class Server():
-
-    def __init__(self, module, saklient):
-        self._module = module
-        self._saklient = saklient
-
-    def _get_plan_by_spec(self, cpu, mem):
-        try:
-            return self._saklient.product.server \
-                    .get_by_spec(cpu, mem)
-        except Exception, e:
-            self._fail(msg='Failed to find plan: %s' % e)
-
-    def _get_tags(self, tags):
-        if tags:
-            return self._parse_tags(tags)
-        else:
-            return tags
-
-    def _parse_tags(self, tags):
-        return [''.join(['@', x]) for x in tags]
-
-    def _get_desc(self, desc):
-        if desc:
-            return self._str2triple_quoted_str(desc)
-        else:
-            return desc
-
-    def _str2triple_quoted_str(self, desc):
-        return '''%s''' % desc
-
-    def _get_icon(self, icon):
-        if icon:
-            return self._get_icon_with_name_like(icon)
-        else:
-            return icon
-
-    def _get_icon_with_name_like(self, icon):
-        try:
-            return self._saklient.icon \
-                    .with_name_like(icon) \
-                    .limit(1) \
-                    .find()[0]
-        except Exception, e:
-            self._fail(msg='Failed to find server icon: %s' % e)
-
-    def _get_server(self, server_resource_id):
-        try:
-            return self._saklient.server.get_by_id(str(server_resource_id))
-        except Exception:
-            self._fail(msg='Failed to find server: %d' % server_resource_id)
-
-    def destroy(self):
-        _server = self._get_server(self._module.params['server_resource_id'])
-
-        try:
-            if _server.is_up():
-                _server.stop()
-                _server.sleep_until_down()
-            _server.destroy()
-        except Exception, e:
-            self._fail(msg='Failed to destroy server: %s' % e)
-        self._success(msg='Successfully destroy server: %s' % int(_server.id))
-
-    def stop(self):
-        _server = self._get_server(self._module.params['server_resource_id'])
-
-        if _server.is_down():
-            self._success(changed=False,
-                            msg='The server already stopped: %d'
-                            % int(_server.id))
-
-        try:
-            if self._module.params['force']:
-                _server.stop()
-            else:
-                _server.shutdown()
-            _server.sleep_until_down()
-        except Exception, e:
-            self._success(msg='Failed to stop server: %s' % e)
-
-        self._success(msg='Successfully stop server: %d'
-                        % int(_server.id))
-
-    def boot(self):
-        _server = self._get_server(self._module.params['server_resource_id'])
-
-        if _server.is_up():
-            self._success(changed=False,
-                            msg='The server already booted: %d'
-                            % int(_server.id))
-
-        try:
-            _server.boot()
-            _server.sleep_until_up()
-        except Exception, e:
-            self._fail(msg='Failed to boot server: %s' % e)
-
-        self._success(msg='Successfully boot server: %d'
-                        % int(_server.id))
-
-    def create(self):
-        _server = self._saklient.server.create()
-        self._set_params(_server)
-
-        if self._module.check_mode:
-            self._success()
-
-        try:
-            _server.save()
-        except Exception, e:
-            self._fail(msg='Failed to create server: %s' % e)
-        self._success(result='Successfully add server: %d' % int(_server.id),
-                        ansible_facts=dict(sacloud_server_resource_id=_server.id))
-
-    def _set_params(self, _server):
-        _server.name = self._module.params['name']
-        _server.plan = self._get_plan_by_spec(self._module.params['cpu'],
-                                        self._module.params['mem'])
-
-        if self._module.params['desc']:
-            _server.description = self._get_desc(self._module.params['desc'])
-        if self._module.params['tags']:
-            _server.tags = self._get_tags(self._module.params['tags'])
-        if self._module.params['icon']:
-            _server.icon = self._get_icon(self._module.params['icon'])
-
-    def _fail(self, msg):
-        self._module.fail_json(msg=msg)
-
-    def _success(self, changed=True, **kwargs):
-        self._module.exit_json(changed=changed, **kwargs)
-
-
 def main():
     module = AnsibleModule(
-        argument_spec=dict(
-            access_token=dict(required=True, aliases=['token']),
-            access_token_secret=dict(required=True, aliases=['token_secret']),
-            zone=dict(required=False, default='is1a',
-                            choices=['is1a', 'is1b', 'tk1a', 'tk1v']),
-            server_resource_id=dict(required=False, type='int'),
-            cpu=dict(required=False, default='1', type='int'),
-            mem=dict(required=False, default='1', type='int'),
-            name=dict(required=False, default='default'),
-            desc=dict(required=False),
-            tags=dict(required=False, type='list'),
-            icon=dict(required=False),
-            force=dict(required=False, default=False, type='bool'),
-            state=dict(required=False, default='present',
-                        choices=['present', 'absent', 'stopped', 'running'])
-        ),
+        argument_spec=server_argument_spec(),
+        mutually_exclusive=SERVER_MUTUALLY_EXCLUSIVE,
         supports_check_mode=True
     )
 
+    # an agent on the controller does the work with a warm session
+    sacloud_agent_call(module, 'sacloud_server')
+
     if not HAS_SAKLIENT:
         module.fail_json(msg='Required module saklient not found')
 
-    try:
-        saklient = API.authorize(module.params['access_token'],
-                                module.params['access_token_secret'],
-                                module.params['zone'])
-    except Exception, e:
-        module.fail_json(msg='Failed to access sacloud: %s' % e)
-
-    server = Server(module, saklient)
-
-    if module.params['state'] in ['absent', 'stopped', 'running'] \
-            and not module.params['server_resource_id']:
-        module.fail_json(msg='missing required arguments: server_resource_id')
-
-    if module.params['state'] == 'absent':
-        server.destroy()
-    elif module.params['state'] == 'stopped':
-        server.stop()
-    elif module.params['state'] == 'running':
-        server.boot()
-    else:
-        if module.params['server_resource_id']:
-            # TODO: implement update
-            #server.update()
-            module.exit_json(changed=False)
-        else:
-            server.create()
+    run_server(module, sacloud_client(module))
 
 
 from ansible.module_utils.basic import *
+from ansible.module_utils.sacloud.agent import sacloud_agent_call
+from ansible.module_utils.sacloud.client import sacloud_client
+from ansible.module_utils.sacloud.server import SERVER_MUTUALLY_EXCLUSIVE, run_server, server_argument_spec
 if __name__ == '__main__':
     main()
@@ -0,0 +1,270 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: sacloud_server_group
+short_description: Scale a tagged group of sacloud servers to a count.
+description:
+  - Keep C(count) servers carrying C(tag). The members are listed with one
+    query, and the missing ones are created or the extra ones destroyed
+    concurrently.
+  - A new member takes the lowest free index in C(name). It is connected
+    to the switch of C(router_resource_id), gets a disk copied as C(disk)
+    describes, and is booted. The addresses of new members are then added
+    to the load balancer C(lb_resource_id) as real servers at once.
+  - A member failing to come up is removed with its disk again; the others
+    are still added to the load balancer before the task fails. The task
+    fails before creating anything when a server outside the group has
+    the name of a new member.
+  - Members with the highest index go first. Their real servers are
+    removed from the load balancer before they are destroyed with their
+    disks, matched by the addresses on their interfaces or leased for their
+    disks by C(config_ipv4_address=auto).
+  - In check mode, the members to create and destroy are returned without
+    changing anything.
+author:
+  - "Koji Nakayama (@knakayama)"
+requirements:
+  - "python >= 2.6"
+  - saklient
+options:
+  access_token:
+    description:
+      - The sacloud access token to use.
+    required: true
+    default: false
+    aliases: ['token']
+  access_token_secret:
+    description:
+      - The sacloud secret access token to use.
+    required: true
+    default: false
+    aliases: ['token_secret']
+  zone:
+    description:
+      - The sacloud zone to use.
+    required: false
+    default: is1a
+    choices: ['is1a', 'is1b', 'tk1a', 'tk1v']
+  http_pool_size:
+    description:
+      - Maximum number of keep-alive connections to the API.
+    required: false
+    default: 4
+  http_timeout:
+    description:
+      - Timeout in seconds for a single API request.
+    required: false
+    default: 60
+  http_retries:
+    description:
+      - Times to send a request again after the API answered 429 or 503,
+        or 500, 502 or 504 to a request without side effects. Waits grow
+        exponentially with jitter and honor C(Retry-After).
+    required: false
+    default: 5
+  http_rate_limit:
+    description:
+      - Requests per second allowed for the account. The budget is kept in
+        a locked file in the cache directory, so every fork and module run on
+        the controller shares it. C(0) disables the limit.
+    required: false
+    default: 10
+  http_burst:
+    description:
+      - Requests allowed at once before C(http_rate_limit) applies.
+        Defaults to C(http_rate_limit).
+    required: false
+    default: null
+  api_root:
+    description:
+      - Base URL of the API, such as a local fake for tests. Falls back to
+        the C(SACLOUD_API_ROOT) environment variable, then to the sacloud
+        endpoint.
+    required: false
+    default: null
+  agent:
+    description:
+      - Let a running sacloud agent (C(agent/sacloud_agent.py)) do the work
+        when one listens on C(agent_socket). The task then skips importing
+        saklient, authorizing and connecting to the API.
+    required: false
+    default: true
+  agent_socket:
+    description:
+      - Unix socket of the sacloud agent. Falls back to the
+        C(SACLOUD_AGENT_SOCKET) environment variable, then to
+        C(~/.cache/ansible-sacloud/agent.sock).
+    required: false
+    default: null
+  metrics:
+    description:
+      - Return C(sacloud_metrics) with the wall-clock time of each phase of
+        the run, API requests by method and endpoint, bytes transferred,
+        retries and wait poll counts.
+    required: false
+    default: false
+  cache_dir:
+    description:
+      - Directory for the local lookup cache shared by parallel runs.
+    required: false
+    default: ~/.cache/ansible-sacloud
+  cache_ttl:
+    description:
+      - Seconds cached icon and plan lookups stay valid. C(0) disables the cache.
+    required: false
+    default: 86400
+  cache_refresh:
+    description:
+      - Discard the cached lookups for this account and zone before running.
+      - Also fetch the unused router switch addresses again, which are
+        otherwise trusted for five minutes.
+    required: false
+    default: false
+  tag:
+    description:
+      - The tag every member carries. Members are found by it.
+    required: true
+  count:
+    description:
+      - Number of members to keep. C(0) destroys the group.
+    required: true
+  name:
+    description:
+      - Name of the members, with C({index}) replaced by their index or the
+        index appended. Defaults to C(tag) followed by the index.
+    required: false
+    default: null
+  cpu:
+    description:
+      - Number of virtual CPUs of new members.
+    required: false
+    default: 1
+  mem:
+    description:
+      - Memory in GB of new members.
+    required: false
+    default: 1
+  desc:
+    description:
+      - Description of new members.
+    required: false
+    default: null
+  icon:
+    description:
+      - Icon of new members.
+    required: false
+    default: null
+  tags:
+    description:
+      - More tags of new members.
+    required: false
+    default: null
+  disk:
+    description:
+      - Options of M(sacloud_disk) for the disk of each new member, such as
+        C(archive_resource_id), C(config_ipv4_address) and
+        C(config_ssh_key). The disk is named after the member, and
+        C(config_ipv4_address=auto) leases from C(router_resource_id).
+      - Without it, new members have no disk.
+    required: false
+    default: null
+  router_resource_id:
+    description:
+      - The router whose switch new members are connected to.
+    required: false
+    default: null
+  lb_resource_id:
+    description:
+      - The load balancer to add new members to and remove destroyed
+        members from, by the address of their disk.
+    required: false
+    default: null
+  virtual_ip:
+    description:
+      - The virtual ip of C(lb_resource_id) to change. Defaults to all.
+    required: false
+    default: null
+  lbserver:
+    description:
+      - C(port), C(protocol), C(path) and C(response) of the real servers
+        added, as the C(lbserver_*) options of M(sacloud_lb).
+    required: false
+    default: null
+  running:
+    description:
+      - Boot new members.
+    required: false
+    default: true
+  concurrency:
+    description:
+      - Maximum number of members created or destroyed at once.
+    required: false
+    default: 4
+'''
+
+EXAMPLES = '''
+# Keep five web servers behind a load balancer
+- sacloud_server_group:
+    access_token: _YOUR_ACCESS_TOKEN_HERE_
+    access_token_secret: _YOUR_ACCESS_TOKEN_SECRET_HERE_
+    tag: web
+    count: 5
+    name: "web{index}.example.com"
+    cpu: 1
+    mem: 1
+    disk:
+      archive_resource_id: _ARCHIVE_RESOURCE_ID_HERE_
+      config_ipv4_address: auto
+      config_ssh_key: "{{ lookup('file', '~/.ssh/id_rsa.pub') }}"
+    router_resource_id: _ROUTER_RESOURCE_ID_HERE_
+    lb_resource_id: _LB_RESOURCE_ID_HERE_
+  register: result
+'''
+
+try:
+    from saklient.cloud.api import API
+    HAS_SAKLIENT = True
+except ImportError:
+    HAS_SAKLIENT = False
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=server_group_argument_spec(),
+        supports_check_mode=True
+    )
+
+    # an agent on the controller does the work with a warm session
+    sacloud_agent_call(module, 'sacloud_server_group')
+
+    if not HAS_SAKLIENT:
+        module.fail_json(msg='Required module saklient not found')
+
+    run_server_group(module, sacloud_client(module))
+
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.sacloud.agent import sacloud_agent_call
+from ansible.module_utils.sacloud.client import sacloud_client
+from ansible.module_utils.sacloud.group import run_server_group, server_group_argument_spec
+if __name__ == '__main__':
+    main()
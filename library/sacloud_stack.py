@@ -0,0 +1,301 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: sacloud_stack
+short_description: Provision routers, servers, disks and load balancers as one stack.
+description:
+  - Bring a stack of routers, servers, disks and load balancers described
+    in one task to C(present), or remove it on C(absent).
+  - Every create, connect, boot and load balancer update is a node of a
+    dependency graph, and a node starts as soon as the nodes it needs ids
+    or addresses from are done, within the concurrency limit of its
+    resource type. Disk copies so start while servers are still being
+    created, and one slow server does not hold back the others.
+  - Resources are found by name, so running the stack again only changes
+    what differs from the description.
+  - Returns the timings of every node and the critical path, the chain of
+    nodes that made the stack take as long as it did.
+  - In check mode, nodes that need the ids of resources which would be
+    created are skipped.
+author:
+  - "Koji Nakayama (@knakayama)"
+requirements:
+  - "python >= 2.6"
+  - saklient
+options:
+  access_token:
+    description:
+      - The sacloud access token to use.
+    required: true
+    default: false
+    aliases: ['token']
+  access_token_secret:
+    description:
+      - The sacloud secret access token to use.
+    required: true
+    default: false
+    aliases: ['token_secret']
+  zone:
+    description:
+      - The sacloud zone to use.
+    required: false
+    default: is1a
+    choices: ['is1a', 'is1b', 'tk1a', 'tk1v']
+  http_pool_size:
+    description:
+      - Maximum number of keep-alive connections to the API.
+    required: false
+    default: 4
+  http_timeout:
+    description:
+      - Timeout in seconds for a single API request.
+    required: false
+    default: 60
+  http_retries:
+    description:
+      - Times to send a request again after the API answered 429 or 503,
+        or 500, 502 or 504 to a request without side effects. Waits grow
+        exponentially with jitter and honor C(Retry-After).
+    required: false
+    default: 5
+  http_rate_limit:
+    description:
+      - Requests per second allowed for the account. The budget is kept in
+        a locked file in the cache directory, so every fork and module run on
+        the controller shares it. C(0) disables the limit.
+    required: false
+    default: 10
+  http_burst:
+    description:
+      - Requests allowed at once before C(http_rate_limit) applies.
+        Defaults to C(http_rate_limit).
+    required: false
+    default: null
+  api_root:
+    description:
+      - Base URL of the API, such as a local fake for tests. Falls back to
+        the C(SACLOUD_API_ROOT) environment variable, then to the sacloud
+        endpoint.
+    required: false
+    default: null
+  agent:
+    description:
+      - Let a running sacloud agent (C(agent/sacloud_agent.py)) do the work
+        when one listens on C(agent_socket). The task then skips importing
+        saklient, authorizing and connecting to the API.
+    required: false
+    default: true
+  agent_socket:
+    description:
+      - Unix socket of the sacloud agent. Falls back to the
+        C(SACLOUD_AGENT_SOCKET) environment variable, then to
+        C(~/.cache/ansible-sacloud/agent.sock).
+    required: false
+    default: null
+  metrics:
+    description:
+      - Return C(sacloud_metrics) with the wall-clock time of each phase of
+        the run, API requests by method and endpoint, bytes transferred,
+        retries and wait poll counts.
+    required: false
+    default: false
+  cache_dir:
+    description:
+      - Directory for the local lookup cache shared by parallel runs.
+    required: false
+    default: ~/.cache/ansible-sacloud
+  cache_ttl:
+    description:
+      - Seconds cached icon and plan lookups stay valid. C(0) disables the cache.
+    required: false
+    default: 86400
+  cache_refresh:
+    description:
+      - Discard the cached lookups for this account and zone before running.
+      - Also fetch the unused router switch addresses again, which are
+        otherwise trusted for five minutes.
+    required: false
+    default: false
+  state_file:
+    description:
+      - Passed to every node of C(sacloud_server), C(sacloud_disk),
+        C(sacloud_router) and C(sacloud_lb). Their C(present) runs return
+        the result kept there when nothing changed since, after checking
+        the resource still exists.
+    required: false
+    default: null
+  state_refresh:
+    description:
+      - List every resource type in C(state_file) once before the first
+        node and drop the entries of resources that are gone.
+    required: false
+    default: false
+  routers:
+    description:
+      - Routers, each with the options of C(sacloud_router). C(name) is
+        required and unique within the stack.
+    required: false
+    default: null
+  servers:
+    description:
+      - Servers, each with the options of C(sacloud_server) and a unique
+        C(name).
+      - C(router) names a router of the stack to connect the server to.
+      - C(running), true by default, boots the server once its disks and
+        router are connected.
+    required: false
+    default: null
+  disks:
+    description:
+      - Disks, each with the options of C(sacloud_disk) and a unique C(name).
+      - C(router) names a router of the stack whose addresses
+        C(config_ipv4_address) comes from. C(server) names the server of
+        the stack to connect the disk to.
+    required: false
+    default: null
+  lbs:
+    description:
+      - Load balancers, each with the options of C(sacloud_lb) and a unique
+        C(name). C(router) names the router of the stack they are attached to.
+      - A server of C(virtual_ips) may be the name of a server of the stack,
+        which stands for the address of its disk. Real servers are added
+        once those servers are running.
+      - A C(virtual_ip) of C(virtual_ips) may be C(auto) to lease an
+        address of the router.
+    required: false
+    default: null
+  concurrency:
+    description:
+      - Nodes of each resource type run at once, by C(routers), C(servers),
+        C(disks) and C(lbs).
+    required: false
+    default: {routers: 2, servers: 4, disks: 4, lbs: 2}
+  state:
+    description:
+      - On C(present), create and connect what is missing.
+      - On C(absent), remove the load balancers, servers, disks and routers
+        of the stack that exist, servers before their disks and routers.
+    required: false
+    choices: [ 'present', 'absent' ]
+    default: 'present'
+'''
+
+EXAMPLES = '''
+# Two web servers behind a load balancer
+- sacloud_stack:
+    access_token: _YOUR_ACCESS_TOKEN_HERE_
+    access_token_secret: _YOUR_ACCESS_TOKEN_SECRET_HERE_
+    routers:
+      - name: web
+        band_width_mbps: 100
+        network_mask_len: 28
+    servers:
+      - name: web1
+        cpu: 1
+        mem: 1
+        router: web
+      - name: web2
+        cpu: 1
+        mem: 1
+        router: web
+    disks:
+      - name: web1 disk
+        archive_resource_id: _ARCHIVE_RESOURCE_ID_HERE_
+        config_ipv4_address: auto
+        config_ssh_key: "{{ lookup('file', 'keys/id_rsa.pub') }}"
+        router: web
+        server: web1
+      - name: web2 disk
+        archive_resource_id: _ARCHIVE_RESOURCE_ID_HERE_
+        config_ipv4_address: auto
+        config_ssh_key: "{{ lookup('file', 'keys/id_rsa.pub') }}"
+        router: web
+        server: web2
+    lbs:
+      - name: web lb
+        vrid: 1
+        real_ips:
+          - auto
+        router: web
+        virtual_ips:
+          - virtual_ip: auto
+            port: 80
+            servers:
+              - web1
+              - web2
+    concurrency:
+      disks: 2
+  register: stack
+
+- debug: msg="{{ item.node }} took {{ item.elapsed }}s"
+  with_items: "{{ stack.critical_path }}"
+
+# Remove it
+- sacloud_stack:
+    access_token: _YOUR_ACCESS_TOKEN_HERE_
+    access_token_secret: _YOUR_ACCESS_TOKEN_SECRET_HERE_
+    routers:
+      - name: web
+    servers:
+      - name: web1
+        router: web
+      - name: web2
+        router: web
+    disks:
+      - name: web1 disk
+        server: web1
+      - name: web2 disk
+        server: web2
+    lbs:
+      - name: web lb
+        router: web
+    state: absent
+'''
+
+try:
+    from saklient.cloud.api import API
+    HAS_SAKLIENT = True
+except ImportError:
+    HAS_SAKLIENT = False
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=stack_argument_spec(),
+        supports_check_mode=True
+    )
+
+    # an agent on the controller does the work with a warm session
+    sacloud_agent_call(module, 'sacloud_stack')
+
+    if not HAS_SAKLIENT:
+        module.fail_json(msg='Required module saklient not found')
+
+    run_stack(module, sacloud_client(module))
+
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.sacloud.agent import sacloud_agent_call
+from ansible.module_utils.sacloud.client import sacloud_client
+from ansible.module_utils.sacloud.stack import run_stack, stack_argument_spec
+if __name__ == '__main__':
+    main()
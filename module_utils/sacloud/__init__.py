@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+ZONES = ['is1a', 'is1b', 'tk1a', 'tk1v']
+
+
+def sacloud_argument_spec():
+    return dict(
+        access_token=dict(required=True, aliases=['token']),
+        access_token_secret=dict(required=True, aliases=['token_secret']),
+        zone=dict(required=False, default='is1a', choices=ZONES),
+        http_pool_size=dict(required=False, default=4, type='int'),
+        http_timeout=dict(required=False, default=60, type='int'),
+        http_retries=dict(required=False, default=5, type='int'),
+        http_rate_limit=dict(required=False, default=10, type='float'),
+        http_burst=dict(required=False, type='int'),
+        api_root=dict(required=False),
+        metrics=dict(required=False, default=False, type='bool'),
+        agent=dict(required=False, default=True, type='bool'),
+        agent_socket=dict(required=False),
+    )
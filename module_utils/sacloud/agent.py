@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import json
+import os
+import socket
+
+DEFAULT_AGENT_SOCKET = '~/.cache/ansible-sacloud/agent.sock'
+
+
+def agent_socket_path(params):
+    path = params.get('agent_socket') or os.environ.get('SACLOUD_AGENT_SOCKET') \
+            or DEFAULT_AGENT_SOCKET
+    return os.path.expanduser(path)
+
+
+def sacloud_agent_call(module, name):
+    """Have a sacloud agent on the controller run the module, if one is
+    listening on the agent socket.
+
+    Exits the module with the agent's result. Returns when there is no
+    agent, so the module can do the work itself.
+    """
+    if not module.params.get('agent'):
+        return
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(agent_socket_path(module.params))
+    except socket.error, e:
+        sock.close()
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return
+        module.fail_json(msg='Failed to connect to sacloud agent: %s' % e)
+
+    # From here on the agent may have changed resources, so a broken
+    # connection fails the task instead of running the module again.
+    try:
+        try:
+            send_message(sock, dict(module=name, params=module.params,
+                                    check_mode=module.check_mode))
+            response = recv_message(sock)
+        finally:
+            sock.close()
+    except (socket.error, ValueError), e:
+        module.fail_json(msg='Failed to talk to sacloud agent: %s' % e)
+
+    result = response['result']
+    if response['failed']:
+        module.fail_json(**result)
+    module.exit_json(**result)
+
+
+def send_message(sock, message):
+    sock.sendall(json.dumps(message).encode('utf-8'))
+    sock.shutdown(socket.SHUT_WR)
+
+
+def recv_message(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return json.loads(b''.join(chunks).decode('utf-8'))
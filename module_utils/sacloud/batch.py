@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import time
+
+from ansible.module_utils.sacloud import sacloud_argument_spec
+from ansible.module_utils.sacloud.cache import cache_argument_spec
+from ansible.module_utils.sacloud.client import clone_api
+from ansible.module_utils.sacloud.metrics import Metrics
+from ansible.module_utils.sacloud.operations import OPERATIONS, OperationModule, check_params, run_operation
+from ansible.module_utils.sacloud.dryrun import dry_run_argument_spec
+from ansible.module_utils.sacloud.state import sacloud_state_file, state_argument_spec
+
+# ${web.sacloud_server_resource_id} refers to a value returned by the step
+# registered as web. Ansible leaves ${} alone, unlike {{ }}.
+REFERENCE = re.compile(r'\$\{([A-Za-z_][\w.]*)\}')
+STEP_KEYS = ['name', 'register', 'ignore_errors']
+
+
+def batch_argument_spec():
+    argument_spec = sacloud_argument_spec()
+    argument_spec.update(cache_argument_spec())
+    argument_spec.update(state_argument_spec())
+    argument_spec.update(dry_run_argument_spec())
+    argument_spec.update(dict(
+        steps=dict(required=True, type='list'),
+    ))
+    return argument_spec
+
+
+class UnresolvedReference(ValueError):
+    pass
+
+
+class Batch():
+    """Run steps in the vocabulary of the sacloud modules one after the
+    other with one client, cache and connection pool."""
+
+    def __init__(self, module, saklient):
+        self._module = module
+        self._saklient = saklient
+        self._registered = {}
+        # every step runs with the connection and cache params of the batch
+        self._shared = dict((k, module.params[k]) for k in batch_argument_spec()
+                            if k != 'steps')
+
+    def run(self):
+        steps = [self._parse_step(index, step)
+                    for index, step in enumerate(self._module.params['steps'])]
+        if self._module.params['state_refresh']:
+            # one pass over the state file instead of one per step
+            sacloud_state_file(self._module).refresh(self._saklient)
+            self._shared['state_refresh'] = False
+
+        results = []
+        facts = {}
+        for step in steps:
+            result = self._run_step(step)
+            results.append(result)
+            if result['failed'] and not step['ignore_errors']:
+                self._fail(msg='Step %s failed: %s' % (step['name'], result.get('msg')),
+                            changed=any([x['changed'] for x in results]),
+                            steps=results)
+            facts.update(result.get('ansible_facts') or {})
+
+        self._success(changed=any([x['changed'] for x in results]),
+                        steps=results, ansible_facts=facts)
+
+    def _parse_step(self, index, step):
+        if not isinstance(step, dict):
+            self._fail(msg='Step %d is not a dict' % (index + 1))
+        modules = [x for x in step if x not in STEP_KEYS]
+        if len(modules) != 1 or modules[0] not in OPERATIONS:
+            self._fail(msg='Step %d needs one of %s'
+                        % (index + 1, ', '.join(sorted(OPERATIONS))))
+
+        args = step[modules[0]] or {}
+        shared = sorted(set(args) & set(self._shared))
+        if shared:
+            self._fail(msg='Step %d sets %s, which apply to the whole batch'
+                        % (index + 1, ', '.join(shared)))
+        return dict(name=step.get('name') or '%d (%s)' % (index + 1, modules[0]),
+                    register=step.get('register'),
+                    ignore_errors=self._module.boolean(step.get('ignore_errors', False)),
+                    operation=OPERATIONS[modules[0]],
+                    args=args)
+
+    def _run_step(self, step):
+        started = time.time()
+        failed, result = self._try_step(step)
+        if step['register']:
+            self._registered[step['register']] = result
+
+        result = dict(result, failed=failed)
+        result.setdefault('changed', False)
+        result.update(step=step['name'], module=step['operation'].name,
+                        elapsed=round(time.time() - started, 3))
+        return result
+
+    def _try_step(self, step):
+        try:
+            args = self._resolve(step['args'])
+        except UnresolvedReference, e:
+            if self._module.check_mode:
+                # made by an earlier step that check mode only pretends to run
+                return False, dict(skipped=True, msg=str(e))
+            return True, dict(msg=str(e))
+
+        # sacloud_facts and sacloud_wait take no cache or state params
+        argument_spec = step['operation'].argument_spec()
+        params = dict((k, v) for k, v in self._shared.items() if k in argument_spec)
+        params.update(args)
+        try:
+            params = check_params(step['operation'], params)
+        except ValueError, e:
+            return True, dict(msg=str(e))
+
+        # a fresh API per step: models keep query state and requests are
+        # counted per step
+        module = OperationModule(params, self._module.check_mode)
+        saklient = clone_api(self._saklient, Metrics())
+        try:
+            return run_operation(step['operation'], module, saklient)
+        except Exception, e:
+            return True, dict(msg='%s failed: %s' % (step['operation'].name, e))
+
+    def _resolve(self, value):
+        if isinstance(value, dict):
+            return dict((k, self._resolve(v)) for k, v in value.items())
+        elif isinstance(value, list):
+            return [self._resolve(x) for x in value]
+        elif not isinstance(value, basestring):
+            return value
+
+        match = REFERENCE.match(value)
+        if match and match.end() == len(value):
+            # a whole reference keeps the type of what it refers to
+            return self._lookup(match.group(1))
+        return REFERENCE.sub(lambda m: str(self._lookup(m.group(1))), value)
+
+    def _lookup(self, reference):
+        path = reference.split('.')
+        if path[0] not in self._registered:
+            raise UnresolvedReference('No step registered as %s' % path[0])
+
+        # values are looked up in the result, then in its ansible_facts
+        result = self._registered[path[0]]
+        for value in [result, result.get('ansible_facts') or {}]:
+            try:
+                for key in path[1:]:
+                    if isinstance(value, list):
+                        value = value[int(key)]
+                    else:
+                        value = value[key]
+            except (KeyError, IndexError, ValueError, TypeError):
+                continue
+            if value is not None:
+                return value
+        raise UnresolvedReference('%s returned no %s'
+                                    % (path[0], '.'.join(path[1:])))
+
+    def _fail(self, msg, **kwargs):
+        self._module.fail_json(msg=msg, **kwargs)
+
+    def _success(self, changed=True, **kwargs):
+        self._module.exit_json(changed=changed, **kwargs)
+
+
+def run_batch(module, saklient):
+    if module.params['dry_run']:
+        # the steps read one snapshot; none of them changes anything
+        module.check_mode = True
+    Batch(module, saklient).run()
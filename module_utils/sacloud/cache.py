@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+DEFAULT_CACHE_DIR = '~/.cache/ansible-sacloud'
+DEFAULT_CACHE_TTL = 86400
+
+
+def cache_argument_spec():
+    return dict(
+        cache_dir=dict(required=False, default=DEFAULT_CACHE_DIR),
+        cache_ttl=dict(required=False, default=DEFAULT_CACHE_TTL, type='int'),
+        cache_refresh=dict(required=False, default=False, type='bool'),
+    )
+
+
+def sacloud_cache(module, name, ttl=None):
+    """Return the cache called name for the module's account and zone,
+    keeping entries no longer than ttl if given."""
+    account = hashlib.sha1(module.params['access_token'].encode('utf-8')) \
+            .hexdigest()[:12]
+    path = os.path.join(os.path.expanduser(module.params['cache_dir']),
+                        '%s-%s-%s.json' % (account, module.params['zone'], name))
+
+    if ttl is None or module.params['cache_ttl'] < ttl:
+        ttl = module.params['cache_ttl']
+    cache = FileCache(path, ttl)
+    if module.params['cache_refresh']:
+        cache.invalidate()
+    return cache
+
+
+class FileCache():
+    """JSON file with expiring entries, shared by parallel module runs.
+
+    Writers take an exclusive flock on a side file and replace the data
+    file atomically, so readers never see a partial write. A cache whose
+    directory cannot be written to behaves like an empty one.
+    """
+
+    def __init__(self, path, ttl):
+        self._path = path
+        self._ttl = ttl
+
+    @property
+    def enabled(self):
+        return self._ttl > 0
+
+    @contextmanager
+    def lock(self):
+        fd = None
+        if self.enabled:
+            try:
+                self._makedirs()
+                fd = open(self._path + '.lock', 'a')
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except (IOError, OSError):
+                fd = None
+        try:
+            yield
+        finally:
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                fd.close()
+
+    def get(self, key):
+        entry = self._read().get(key)
+        if entry is None or entry['expires'] < time.time():
+            return None
+        return entry['value']
+
+    def set(self, key, value):
+        # callers doing read-modify-write must hold lock()
+        data = self._read()
+        data[key] = dict(value=value, expires=time.time() + self._ttl)
+        self._write(data)
+
+    def get_or_set(self, key, loader):
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        # Parallel runs missing the same key queue up here; only the first
+        # one calls the loader, the others read its result.
+        with self.lock():
+            value = self.get(key)
+            if value is None:
+                value = loader()
+                if value is not None:
+                    self.set(key, value)
+        return value
+
+    def invalidate(self, key=None):
+        with self.lock():
+            if key is None:
+                data = {}
+            else:
+                data = self._read()
+                data.pop(key, None)
+            self._write(data)
+
+    def _makedirs(self):
+        directory = os.path.dirname(self._path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+
+    def _read(self):
+        if not self.enabled:
+            return {}
+        try:
+            with open(self._path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write(self, data):
+        if not self.enabled:
+            return
+        try:
+            self._dump(data)
+        except (IOError, OSError):
+            pass
+
+    def _dump(self, data):
+        self._makedirs()
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self._path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, self._path)
+
+
+class FileStore(FileCache):
+    """FileCache for state that must not be lost.
+
+    Entries never expire, and failures to lock, read or write raise
+    instead of degrading to an empty store.
+    """
+
+    def __init__(self, path):
+        FileCache.__init__(self, path, ttl=None)
+
+    @property
+    def enabled(self):
+        return True
+
+    @contextmanager
+    def lock(self):
+        self._makedirs()
+        fd = open(self._path + '.lock', 'a')
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            fd.close()
+
+    def update(self, func, commit=True):
+        """Run func on the data under the lock and store what it changed,
+        unless commit is false. Returns the result of func."""
+        with self.lock():
+            data = self._read()
+            result = func(data)
+            if commit:
+                self._dump(data)
+            return result
+
+    def _read(self):
+        try:
+            with open(self._path) as f:
+                return json.load(f)
+        except IOError:
+            return {}
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+from ansible.module_utils.sacloud.metrics import sacloud_metrics
+
+# disk plan ids used by saklient's product.disk.hdd/ssd
+DISK_PLAN_IDS = {'hdd': '2', 'ssd': '4'}
+
+
+class PlanError(ValueError):
+    pass
+
+
+class PlanCatalog():
+    """Server, disk and router plans of a zone, fetched once per cache TTL.
+
+    Plans are resolved locally, so an unknown spec fails before anything
+    is written to the API.
+    """
+
+    def __init__(self, saklient, cache):
+        self._saklient = saklient
+        self._cache = cache
+        self._plans = None
+
+    def get_server_plan(self, cpu, mem):
+        plans = self._load()['server']
+        for plan in plans:
+            if plan['CPU'] == cpu and plan['MemoryMB'] == mem * 1024:
+                return self._create('ServerPlan', plan)
+
+        closest = sorted(plans, key=lambda x: (abs(x['CPU'] - cpu)
+                            + abs(x['MemoryMB'] / 1024 - mem)))[:3]
+        raise PlanError('No server plan with %d cpu and %d GB memory. '
+                        'Closest plans: %s'
+                        % (cpu, mem, ', '.join(['%d cpu/%d GB'
+                            % (x['CPU'], x['MemoryMB'] / 1024)
+                            for x in closest])))
+
+    def get_disk_plan(self, name):
+        for plan in self._load()['disk']:
+            if plan['ID'] == DISK_PLAN_IDS.get(name):
+                return self._create('DiskPlan', plan)
+        raise PlanError('No disk plan: %s' % name)
+
+    def get_router_plan(self, band_width_mbps):
+        plans = self._load()['router']
+        for plan in plans:
+            if plan['BandWidthMbps'] == band_width_mbps:
+                return self._create('RouterPlan', plan)
+        raise PlanError('No router plan with %d Mbps. Available plans: %s'
+                        % (band_width_mbps, ', '.join(['%d Mbps' % x['BandWidthMbps']
+                            for x in sorted(plans, key=lambda x: x['BandWidthMbps'])])))
+
+    def _load(self):
+        if self._plans is None:
+            with sacloud_metrics(self._saklient).phase('plan'):
+                self._plans = self._cache.get_or_set('plans', self._fetch)
+        return self._plans
+
+    def _fetch(self):
+        product = self._saklient.product
+        return dict(
+            server=[self._dump(x) for x in product.server.limit(1000).find()],
+            disk=[self._dump(x) for x in product.disk.limit(1000).find()],
+            router=[self._dump(x) for x in product.router.limit(1000).find()],
+        )
+
+    def _dump(self, plan):
+        data = plan.dump()
+        for key in ['CPU', 'MemoryMB', 'BandWidthMbps']:
+            if data.get(key) is not None:
+                data[key] = int(data[key])
+        return data
+
+    def _create(self, class_name, data):
+        from saklient.cloud.resources.resource import Resource
+        return Resource.create_with(class_name, self._saklient.client, data)
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import re
+import socket
+import threading
+import time
+from email.utils import mktime_tz, parsedate_tz
+
+try:
+    import httplib
+    from urllib import quote
+    from urlparse import urlparse
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import quote, urlparse
+
+try:
+    from saklient.cloud.api import API
+    from saklient.cloud.client import Client
+    from saklient.errors.exceptionfactory import ExceptionFactory
+except ImportError:
+    Client = object
+
+from ansible.module_utils.sacloud.metrics import Metrics
+from ansible.module_utils.sacloud.ratelimit import sacloud_rate_limiter
+from ansible.module_utils.sacloud.waiter import Backoff
+
+# Rejected before doing anything, so any request may be sent again
+RETRY_ANY = (429, 503)
+# May have been carried out, so only requests without side effects
+RETRY_IDEMPOTENT = (500, 502, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+MAX_RETRY_INTERVAL = 30
+
+
+class ConnectionPool():
+    """Keep-alive HTTP connections shared by all clients of a module run.
+
+    At most size connections are open per host; threads wanting more wait
+    until one is released. Every request is counted in metrics, or in the
+    metrics passed with it.
+
+    Requests take a token from limiter first, when given. Rate limited and
+    failed requests are sent again up to retries times with jittered
+    exponential backoff, waiting at least as long as Retry-After says.
+    """
+
+    def __init__(self, size=4, timeout=60, retries=0, limiter=None):
+        self._size = max(1, size)
+        self._timeout = timeout
+        self._retries = max(0, retries)
+        self._limiter = limiter
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self.metrics = Metrics()
+
+    def request(self, url, method, body, headers, metrics=None):
+        metrics = metrics or self.metrics
+        parsed = urlparse(url)
+        path = parsed.path
+        if parsed.query:
+            path += '?' + parsed.query
+
+        host = self._get_host(parsed.scheme, parsed.netloc)
+        backoff = Backoff(initial=1, factor=2, jitter=0.5)
+        attempt = 0
+        while True:
+            if self._limiter is not None:
+                with metrics.phase('throttle'):
+                    self._limiter.acquire()
+            status, data, retry_after = self._request(host, method, path,
+                                                        body, headers, metrics)
+            if attempt >= self._retries or not self._should_retry(method, status):
+                return status, data
+
+            attempt += 1
+            delay = backoff.next(MAX_RETRY_INTERVAL)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+                if status == 429 and self._limiter is not None:
+                    # every process of the account has to back off
+                    self._limiter.block(retry_after)
+            metrics.record_retry(method, path)
+            time.sleep(delay)
+
+    def _should_retry(self, method, status):
+        return status in RETRY_ANY \
+                or (status in RETRY_IDEMPOTENT and method in IDEMPOTENT_METHODS)
+
+    def _request(self, host, method, path, body, headers, metrics):
+        conn, reused = host.acquire()
+        written = False
+        try:
+            try:
+                conn.request(method, path, body, headers)
+                written = True
+                res = self._receive(conn)
+            except socket.timeout:
+                # the API may still be carrying the request out
+                raise
+            except (httplib.HTTPException, socket.error):
+                # the server may have closed an idle keep-alive connection;
+                # a request it may have read is only sent again when it has
+                # no side effects
+                conn.close()
+                if not reused or (written and method not in IDEMPOTENT_METHODS):
+                    raise
+                metrics.record_retry(method, path)
+                res = self._send(conn, method, path, body, headers)
+        except Exception:
+            conn.close()
+            raise
+        finally:
+            host.release(conn)
+        status, data, retry_after = res
+        metrics.record_request(method, path, len(body or ''), len(data))
+        return status, data, retry_after
+
+    def close(self):
+        with self._lock:
+            for host in self._hosts.values():
+                host.close()
+
+    def _send(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers)
+        return self._receive(conn)
+
+    def _receive(self, conn):
+        res = conn.getresponse()
+        return res.status, res.read(), _retry_after(res.getheader('Retry-After'))
+
+    def _get_host(self, scheme, netloc):
+        with self._lock:
+            if (scheme, netloc) not in self._hosts:
+                self._hosts[(scheme, netloc)] = _HostPool(scheme, netloc,
+                                                            self._size,
+                                                            self._timeout)
+            return self._hosts[(scheme, netloc)]
+
+
+def _retry_after(value):
+    """Seconds to wait from a Retry-After header, either delay-seconds or
+    an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0, mktime_tz(parsed) - time.time())
+
+
+class _HostPool():
+
+    def __init__(self, scheme, netloc, size, timeout):
+        if scheme == 'https':
+            self._factory = httplib.HTTPSConnection
+        else:
+            self._factory = httplib.HTTPConnection
+        self._netloc = netloc
+        self._timeout = timeout
+        self._slots = threading.Semaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def acquire(self):
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._factory(self._netloc, timeout=self._timeout), False
+
+    def release(self, conn):
+        with self._lock:
+            self._idle.append(conn)
+        self._slots.release()
+
+    def close(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+
+
+class PooledClient(Client):
+    """saklient client sending its requests through a ConnectionPool.
+
+    Requests are counted in the pool's metrics unless the client is given
+    metrics of its own, which its clones share.
+    """
+
+    def __init__(self, token, secret, pool, metrics=None):
+        super(PooledClient, self).__init__(token, secret)
+        self._pool = pool
+        self.metrics = metrics or pool.metrics
+
+    def clone_instance(self):
+        instance = self.__class__(self.config['token'], self.config['secret'],
+                                    self._pool, self.metrics)
+        instance.set_api_root(self.config['api_root'])
+        instance.set_api_root_suffix(self.config['api_root_suffix'])
+        return instance
+
+    def request(self, method, path, params={}):
+        method = method.upper()
+        url, body = self._build_request(method, path, params)
+        status, data = self._pool.request(url, method, body,
+                                            self._get_headers(method),
+                                            self.metrics)
+        return self._parse_response(status, data)
+
+    def _build_request(self, method, path, params):
+        # same URL layout as saklient.cloud.client.Client.request
+        if path[0] != '/':
+            path = '/' + path
+        body = json.dumps(params).encode('ascii')
+        if method == 'GET':
+            path += '?' + quote(body)
+            body = None
+        if path[0:4] != 'http':
+            url_root = self.config['api_root']
+            if self.config['api_root_suffix'] is not None:
+                if re.match('is1[v-z]', self.config['api_root_suffix']):
+                    url_root = re.sub('/cloud/$', '/cloud-test/', url_root)
+                url_root += self.config['api_root_suffix']
+                if url_root[-1:] != '/':
+                    url_root += '/'
+            path = url_root + 'api/cloud/1.1' + path
+        return path, body
+
+    def _get_headers(self, method):
+        return {
+            'Connection': 'keep-alive',
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Authorization': self.config['authorization'],
+            'User-Agent': 'ansible-sacloud saklient.python',
+            'X-Requested-With': 'XMLHttpRequest',
+            'X-Sakura-No-Authenticate-Header': '1',
+            'X-Sakura-HTTP-Method': method,
+            'X-Sakura-Request-Format': 'json',
+            'X-Sakura-Response-Format': 'json',
+            'X-Sakura-Error-Level': 'warning',
+        }
+
+    def _parse_response(self, status, data):
+        data = data.decode('utf-8', 'ignore')
+        if status >= 400:
+            try:
+                ret = json.loads(data)
+            except ValueError:
+                ret = None
+            if not isinstance(ret, dict):
+                ret = dict(error_code=None, error_msg=None)
+            raise ExceptionFactory.create(status, ret.get('error_code'),
+                                            ret.get('error_msg'))
+        return json.loads(data)
+
+
+def sacloud_client(module):
+    """Authorize against the module's zone over pooled connections."""
+    pool = ConnectionPool(module.params['http_pool_size'],
+                            module.params['http_timeout'],
+                            module.params['http_retries'],
+                            sacloud_rate_limiter(module))
+    try:
+        client = PooledClient(module.params['access_token'],
+                                module.params['access_token_secret'],
+                                pool)
+        saklient = API(client).in_zone(module.params['zone'])
+    except Exception, e:
+        module.fail_json(msg='Failed to access sacloud: %s' % e)
+
+    # in_zone() resets the API root, so a custom one is set afterwards
+    api_root = module.params.get('api_root') or os.environ.get('SACLOUD_API_ROOT')
+    if api_root:
+        if not api_root.endswith('/'):
+            api_root += '/'
+        saklient.client.set_api_root(api_root)
+    return saklient
+
+
+def clone_api(saklient, metrics=None):
+    """An API with models of its own over the same client and connection
+    pool. saklient models keep query state, so every worker thread that
+    looks resources up needs its own. Requests of the clone are counted in
+    metrics when given."""
+    client = saklient.client.clone_instance()
+    if metrics is not None:
+        client.metrics = metrics
+    return API(client)
@@ -0,0 +1,570 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from ansible.module_utils.sacloud import sacloud_argument_spec
+from ansible.module_utils.sacloud.client import clone_api
+from ansible.module_utils.sacloud.metrics import sacloud_metrics, with_metrics
+from ansible.module_utils.sacloud.cache import cache_argument_spec, sacloud_cache
+from ansible.module_utils.sacloud.catalog import DISK_PLAN_IDS, PlanCatalog
+from ansible.module_utils.sacloud.icon import IconResolver
+from ansible.module_utils.sacloud.ipam import AUTO_ADDRESS, sacloud_ipam
+from ansible.module_utils.sacloud.waiter import wait_for
+from ansible.module_utils.sacloud.reconcile import ImmutableFieldError, Reconciler, change_diff, create_diff, destroy_diff, sorted_list
+from ansible.module_utils.sacloud.dryrun import dry_run_argument_spec, dry_run_snapshot_cache, sacloud_dry_run
+from ansible.module_utils.sacloud.snapshot import find_resources
+from ansible.module_utils.sacloud.state import sacloud_state, state_argument_spec
+from ansible.module_utils.sacloud.pool import WorkerPool
+
+
+CONFIG_KEYS = ['config_host_name', 'config_password', 'config_ipv4_address',
+                'config_ssh_key', 'config_network_mask_len',
+                'config_default_route']
+
+
+def disk_argument_spec():
+    argument_spec = sacloud_argument_spec()
+    argument_spec.update(cache_argument_spec())
+    argument_spec.update(state_argument_spec())
+    argument_spec.update(dry_run_argument_spec())
+    argument_spec.update(dict(
+        disk_resource_id=dict(required=False, type='int', aliases=['disk_id']),
+        name=dict(required=False),
+        desc=dict(required=False),
+        tags=dict(required=False, type='list'),
+        icon=dict(required=False),
+        size_gib=dict(required=False, type='int', aliases=['disk_size']),
+        archive_resource_id=dict(required=False, type='int',
+                                    aliases=['archive_id']),
+        server_resource_id=dict(required=False, type='int',
+                                    aliases=['server_id']),
+        plan=dict(required=False, choices=['ssd', 'hdd']),
+        config_host_name=dict(required=False),
+        config_password=dict(required=False),
+        config_ipv4_address=dict(required=False),
+        config_ssh_key=dict(required=False),
+        config_network_mask_len=dict(required=False, type='int'),
+        config_default_route=dict(required=False),
+        router_resource_id=dict(required=False, type='int',
+                                    aliases=['router_id']),
+        disks=dict(required=False, type='list'),
+        copy_concurrency=dict(required=False, default=4, type='int'),
+        wait=dict(required=False, default=True, type='bool'),
+        state=dict(required=False, default='present',
+                    choices=['present', 'absent', 'connected', 'disconnected'])
+    ))
+    return argument_spec
+
+
+class Disk():
+
+    def __init__(self, module, saklient):
+        self._module = module
+        self._saklient = saklient
+        self._icon_resolver = IconResolver(saklient,
+                                        sacloud_cache(module, 'icons'))
+        self._plan_catalog = PlanCatalog(saklient,
+                                        sacloud_cache(module, 'plans'))
+        self._ipam = sacloud_ipam(module)
+        self._state = sacloud_state(module, 'sacloud_disk')
+        self._dry_run_cache = dry_run_snapshot_cache(module)
+
+    def _get_desc(self, desc):
+        if desc:
+            return self._str2triple_quoted_str(desc)
+        else:
+            return desc
+
+    def _str2triple_quoted_str(self, desc):
+        return '''%s''' % desc
+
+    # FIXME: don't work
+    def _get_tags(self, tags):
+        if tags:
+            return self._parse_tags(tags)
+        else:
+            return tags
+
+    def _parse_tags(self, tags):
+        return [''.join(['@', x]) for x in tags]
+
+    def _get_icon(self, icon):
+        if icon:
+            return self._get_icon_with_name_like(icon)
+        else:
+            return icon
+
+    def _get_icon_with_name_like(self, icon):
+        try:
+            return self._icon_resolver.resolve(icon)
+        except Exception, e:
+            self._fail(msg='Failed to find disk icon: %s' % e)
+
+    def _get_disk_by_id(self, disk_resource_id):
+        try:
+            return self._saklient.disk.get_by_id(str(disk_resource_id))
+        except Exception:
+            self._fail(msg='Failed to find disk: %d' % disk_resource_id)
+
+    def destroy(self, disk_resource_id):
+        _disk = self._get_disk_by_id(disk_resource_id)
+
+        if self._module.check_mode:
+            self._success(diff=destroy_diff(_disk))
+
+        try:
+            with self._phase('destroy'):
+                _disk.destroy()
+            self._ipam.release(self._get_owner(_disk.name))
+            self._state.forget(_disk.id)
+        except Exception, e:
+            self._fail(msg='Failed to destroy disk: %s' % e)
+        self._success(msg='Successfully destroy disk: %d' % int(_disk.id))
+
+    def _get_plan(self, plan):
+        # FIXME: hdd plan does not work
+        try:
+            return self._plan_catalog.get_disk_plan(plan)
+        except Exception, e:
+            self._fail(msg='Failed to find disk plan: %s' % e)
+
+    def _get_archive_by_id(self, archive_resource_id):
+        try:
+            return self._saklient.archive.get_by_id(str(archive_resource_id))
+        except Exception:
+            self._fail(msg='Failed to find disk source archive: %d'
+                        % archive_resource_id)
+
+    def present(self):
+        cached = self._state.replay(self._saklient)
+        if cached is not None:
+            self._success(changed=False, **cached)
+
+        if self._module.params['disk_resource_id']:
+            _disk = self._get_disk_by_id(self._module.params['disk_resource_id'])
+        else:
+            _disk = self._find_disk(self._module.params['name'] or 'default')
+
+        if _disk is None:
+            self.create()
+        self.update(_disk)
+
+    def _find_disk(self, name):
+        try:
+            _disks = find_resources(self._saklient.disk, name)
+        except Exception, e:
+            self._fail(msg='Failed to find disk: %s' % e)
+
+        if len(_disks) > 1:
+            self._fail(msg='Multiple disks named %s: %s'
+                        % (name, ', '.join([x.id for x in _disks])))
+        elif _disks:
+            return _disks[0]
+        return None
+
+    def update(self, _disk):
+        reconciler = self._get_reconciler(_disk, self._module.params)
+        try:
+            reconciler.check()
+        except ImmutableFieldError, e:
+            self._fail(msg='Failed to update disk: %s' % e)
+
+        if not reconciler.changed or self._module.check_mode:
+            self._success(changed=reconciler.changed, diff=reconciler.diff,
+                            ansible_facts=dict(sacloud_disk_resource_id=_disk.id))
+
+        try:
+            _disk = reconciler.apply()
+        except Exception, e:
+            self._fail(msg='Failed to update disk: %s' % e)
+        self._success(result='Successfully update disk: %d' % int(_disk.id),
+                        diff=reconciler.diff,
+                        ansible_facts=dict(sacloud_disk_resource_id=_disk.id))
+
+    def _get_reconciler(self, _disk, params):
+        reconciler = Reconciler(_disk)
+        reconciler.set('name', _disk.name, params['name'])
+        reconciler.set('desc', _disk.description,
+                        self._get_desc(params['desc']), attr='description')
+        reconciler.set('tags', _disk.tags, self._get_tags(params['tags']),
+                        key=sorted_list)
+        if params['icon']:
+            _icon = self._get_icon(params['icon'])
+            reconciler.set('icon', _disk.icon.id if _disk.icon else None,
+                            _icon.id, value=_icon)
+
+        plans = dict((v, k) for k, v in DISK_PLAN_IDS.items())
+        reconciler.immutable('plan', plans.get(_disk.plan.id if _disk.plan else None),
+                                params['plan'])
+        reconciler.immutable('size_gib', _disk.size_gib, params['size_gib'])
+        return reconciler
+
+    def create(self):
+        owner = None
+        if self._module.params['config_ipv4_address'] == AUTO_ADDRESS:
+            owner = self._get_owner(self._module.params['name'])
+        params = self._lease_addresses([dict(self._module.params)])[0]
+        _disk = self._saklient.disk.create()
+        self._set_params(_disk, params)
+        _disk.source = self._get_archive_by_id(params['archive_resource_id'])
+
+        facts = dict()
+        if params['config_ipv4_address']:
+            facts.update(sacloud_ipv4_address=params['config_ipv4_address'])
+
+        if self._module.check_mode:
+            self._success(diff=create_diff(dict(name=params['name'] or 'default',
+                                                desc=params['desc'], tags=params['tags'],
+                                                icon=params['icon'],
+                                                plan=params['plan'] or 'ssd',
+                                                size_gib=params['size_gib'] or 20,
+                                                archive_resource_id=params['archive_resource_id'],
+                                                config_ipv4_address=params['config_ipv4_address'])),
+                            ansible_facts=facts)
+
+        try:
+            with self._phase('save'):
+                _disk.save()
+            if self._module.params['wait']:
+                self._wait_for(_disk, owner=owner)
+        except Exception, e:
+            self._abandon(owner, 'Failed to create disk: %s' % e)
+
+        if self._config_param_exist(params):
+            try:
+                self._get_config(_disk, params).write()
+            except Exception, e:
+                self._abandon(owner, 'Failed to modify disk: %s' % e)
+
+        facts.update(sacloud_disk_resource_id=_disk.id)
+        self._success(result='Successfully add disk: %d' % int(_disk.id),
+                            ansible_facts=facts)
+
+    def create_many(self):
+        specs = self._get_disk_specs()
+        existing = self._get_disks_by_name([spec['name'] for spec in specs])
+        auto = set([spec['name'] for spec in specs
+                    if spec['config_ipv4_address'] == AUTO_ADDRESS])
+        # Only new disks get a config written, so only they lease addresses
+        self._lease_addresses([spec for spec in specs
+                                if spec['name'] not in existing])
+        # The archive, plans and icons are resolved and existing disks
+        # diffed here, so the workers only save, wait and write configs.
+        _archive = None
+        jobs = []
+        for spec in specs:
+            _disk = existing.get(spec['name'])
+            if _disk is None:
+                if _archive is None:
+                    _archive = self._get_archive_by_id(
+                                    self._module.params['archive_resource_id'])
+                _disk = self._saklient.disk.create()
+                self._set_params(_disk, spec)
+                _disk.source = _archive
+                jobs.append((spec, _disk, None))
+            else:
+                reconciler = self._get_reconciler(_disk, spec)
+                try:
+                    reconciler.check()
+                except ImmutableFieldError, e:
+                    self._fail(msg='Failed to update disk %s: %s' % (spec['name'], e))
+                jobs.append((spec, _disk, reconciler))
+
+        if self._module.check_mode:
+            disks = [self._get_disk_result(spec, reconciler)
+                        for spec, _disk, reconciler in jobs]
+            self._success(changed=any([x['changed'] for x in disks]), disks=disks)
+
+        pool = WorkerPool(self._module.params['copy_concurrency'])
+        disks = []
+        for result in pool.map(self._clone_disk, jobs):
+            spec, _disk, reconciler = result.item
+            disk = self._get_disk_result(spec, reconciler)
+            if result.failed:
+                disk.update(failed=True, msg='Failed to create disk: %s' % result.error)
+                if _disk.id:
+                    disk.update(sacloud_disk_resource_id=_disk.id)
+                if reconciler is None and spec['name'] in auto:
+                    # nothing uses the address leased for the new disk
+                    self._release(self._get_owner(spec['name']))
+            else:
+                disk.update(failed=False, **result.value)
+            disks.append(disk)
+
+        resource_ids = [x['sacloud_disk_resource_id']
+                        for x in disks if not x['failed']]
+        failures = len(disks) - len(resource_ids)
+        if failures:
+            self._fail(msg='Failed to create %d of %d disks'
+                        % (failures, len(disks)),
+                        disks=disks,
+                        sacloud_disk_resource_ids=resource_ids)
+        self._success(changed=any([x['changed'] for x in disks]),
+                        result='Successfully add %d disks' % len(resource_ids),
+                        disks=disks,
+                        sacloud_disk_resource_ids=resource_ids,
+                        ansible_facts=dict(sacloud_disk_resource_ids=resource_ids))
+
+    def _clone_disk(self, job):
+        # runs in a worker thread: raise instead of calling _fail
+        spec, _disk, reconciler = job
+        if reconciler is not None:
+            if reconciler.changed:
+                reconciler.apply()
+            return dict(sacloud_disk_resource_id=_disk.id)
+
+        started = time.time()
+        with self._phase('save'):
+            _disk.save()
+        if not self._module.params['wait']:
+            return dict(sacloud_disk_resource_id=_disk.id)
+
+        target = wait_for(clone_api(self._saklient), 'disk', _disk.id)
+        if target.failed:
+            raise Exception('copy failed: %s' % _disk.id)
+        elif not target.converged:
+            raise Exception('timeout waiting for copy: %s' % _disk.id)
+        copy_seconds = round(time.time() - started, 1)
+
+        if self._config_param_exist(spec):
+            self._get_config(_disk, spec).write()
+        return dict(sacloud_disk_resource_id=_disk.id, copy_seconds=copy_seconds)
+
+    def _get_disk_result(self, spec, reconciler):
+        if reconciler is None:
+            result = dict(name=spec['name'], changed=True)
+            if spec['config_ipv4_address']:
+                result.update(ipv4_address=spec['config_ipv4_address'])
+            return result
+        return dict(name=spec['name'], changed=reconciler.changed,
+                    diff=reconciler.diff)
+
+    def _get_disk_specs(self):
+        keys = ['desc', 'tags', 'icon', 'plan', 'size_gib'] + CONFIG_KEYS
+        defaults = dict((key, self._module.params[key]) for key in keys)
+
+        specs = []
+        names = set()
+        for disk in self._module.params['disks']:
+            if not disk.get('name'):
+                self._fail(msg='disks require name: %s' % disk)
+            if disk['name'] in names:
+                self._fail(msg='disks repeat name: %s' % disk['name'])
+            names.add(disk['name'])
+            spec = dict(defaults)
+            spec.update(disk)
+            if not self._module.params['wait'] and self._config_param_exist(spec):
+                self._fail(msg='config_* parameters require wait')
+            specs.append(spec)
+        return specs
+
+    def _lease_addresses(self, specs):
+        # All auto addresses are leased at once, so a failure leases none
+        auto_specs = [spec for spec in specs
+                        if spec['config_ipv4_address'] == AUTO_ADDRESS]
+        if not auto_specs:
+            return specs
+        router_resource_id = self._module.params['router_resource_id']
+        if not router_resource_id:
+            self._fail(msg='config_ipv4_address=auto requires router_resource_id')
+
+        try:
+            leases = self._ipam.lease_many(self._saklient, router_resource_id,
+                        [(self._get_owner(spec['name']), 1)
+                            for spec in auto_specs],
+                        commit=not self._module.check_mode)
+        except Exception, e:
+            self._fail(msg='Failed to lease ipv4 address: %s' % e)
+
+        for spec in auto_specs:
+            lease = leases[self._get_owner(spec['name'])]
+            spec['config_ipv4_address'] = lease['addresses'][0]
+            if not spec['config_network_mask_len']:
+                spec['config_network_mask_len'] = lease['network_mask_len']
+            if not spec['config_default_route']:
+                spec['config_default_route'] = lease['default_route']
+        return specs
+
+    def _get_owner(self, name):
+        return 'disk:%s' % (name or 'default')
+
+    def _get_disks_by_name(self, names):
+        # One paged listing instead of a lookup per name
+        try:
+            _disks = find_resources(self._saklient.disk)
+        except Exception, e:
+            self._fail(msg='Failed to find disks: %s' % e)
+
+        found = {}
+        for _disk in _disks:
+            if _disk.name not in names:
+                continue
+            if _disk.name in found:
+                self._fail(msg='Multiple disks named %s: %s, %s'
+                            % (_disk.name, found[_disk.name].id, _disk.id))
+            found[_disk.name] = _disk
+        return found
+
+    def _wait_for(self, _disk, state=None, owner=None):
+        target = wait_for(self._saklient, 'disk', _disk.id, state)
+        if target.failed:
+            self._abandon(owner, 'Failed to wait for disk copy: %d' % int(_disk.id))
+        elif not target.converged:
+            self._abandon(owner, 'Timeout waiting for disk copy to be %s: %d'
+                            % (target.state, int(_disk.id)))
+        return target.resource
+
+    def _abandon(self, owner, msg):
+        # the address leased for a disk that failed to come up is used by
+        # nothing, so it goes back to the subnet
+        if owner is not None:
+            self._release(owner)
+        self._fail(msg=msg)
+
+    def _release(self, owner):
+        try:
+            self._ipam.release(owner)
+        except Exception:
+            # the lease stays, which only costs an address
+            pass
+
+    def disconnect(self, disk_resource_id):
+        _disk = self._get_disk_by_id(disk_resource_id)
+
+        if self._module.check_mode:
+            connected = _disk.server.id if _disk.server is not None else None
+            self._success(changed=connected is not None,
+                            diff=change_diff('server', connected, None))
+
+        try:
+            with self._phase('disconnect'):
+                _disk.disconnect()
+        except Exception, e:
+            self._fail(msg='Failed to disconnect disk from server: %s' % e)
+        self._success(result='Successfully disconnect disk')
+
+    def connect(self, disk_resource_id, server_resource_id):
+        _server = self._get_server_by_id(server_resource_id)
+        _disk = self._get_disk_by_id(disk_resource_id)
+
+        if _disk.server is not None and _disk.server.id == str(server_resource_id):
+            self._success(changed=False, result='Already connected to server')
+        if self._module.check_mode:
+            self._success(diff=change_diff('server',
+                                            _disk.server.id if _disk.server is not None else None,
+                                            str(server_resource_id)))
+
+        try:
+            with self._phase('connect'):
+                _disk.connect_to(_server)
+        except Exception, e:
+            self._fail(msg='Failed to connect disk to server: %s' % e)
+        self._success(result='Successfully connect to server')
+
+    def _get_server_by_id(self, server_resource_id):
+        try:
+            return self._saklient.server.get_by_id(str(server_resource_id))
+        except Exception:
+            # FIXME: UnicodeEncodeError
+            #self._fail('Failed to find server: %s' % e)
+            self._fail(msg='Failed to find server: %d' % server_resource_id)
+
+    def _set_params(self, _disk, params):
+        _disk.name = params['name'] or 'default'
+        _disk.plan = self._get_plan(params['plan'] or 'ssd')
+        _disk.size_gib = params['size_gib'] or 20
+
+        if params['desc']:
+            _disk.description = self._get_desc(params['desc'])
+        if params['tags']:
+            _disk.tags = self._get_tags(params['tags'])
+        if params['icon']:
+            _disk.icon = self._get_icon(params['icon'])
+
+    def _config_param_exist(self, params):
+        return any([params[key] for key in CONFIG_KEYS])
+
+    def _get_config(self, _disk, params):
+        _disk_config = _disk.create_config()
+
+        if params['config_host_name']:
+            _disk_config.host_name = params['config_host_name']
+        if params['config_password']:
+            _disk_config.password = params['config_password']
+        if params['config_ipv4_address']:
+            _disk_config.ip_address = params['config_ipv4_address']
+        if params['config_ssh_key']:
+            _disk_config.ssh_key = params['config_ssh_key']
+        if params['config_network_mask_len']:
+            _disk_config.network_mask_len = params['config_network_mask_len']
+        if params['config_default_route']:
+            _disk_config.default_route = params['config_default_route']
+
+        return _disk_config
+
+    def _phase(self, name):
+        return sacloud_metrics(self._saklient).phase(name)
+
+    def _fail(self, msg, **kwargs):
+        kwargs = with_metrics(self._module, self._saklient, kwargs)
+        self._module.fail_json(msg=msg, **kwargs)
+
+    def _success(self, changed=True, **kwargs):
+        self._state.record(kwargs)
+        if changed and not self._module.check_mode:
+            # plans made from now on see the change
+            self._dry_run_cache.invalidate()
+        kwargs = with_metrics(self._module, self._saklient, kwargs)
+        self._module.exit_json(changed=changed, **kwargs)
+
+
+def run_disk(module, saklient):
+    saklient = sacloud_dry_run(module, saklient)
+    disk = Disk(module, saklient)
+
+    if module.params['state'] == 'connected':
+        if not module.params['disk_resource_id']:
+            module.fail_json(msg='missing required arguments: disk_resource_id')
+        elif not module.params['server_resource_id']:
+            module.fail_json(msg='missing required arguments: server_resource_id')
+        else:
+            disk.connect(module.params['disk_resource_id'], module.params['server_resource_id'])
+    elif module.params['state'] == 'disconnected':
+        if module.params['disk_resource_id']:
+            disk.disconnect(module.params['disk_resource_id'])
+        else:
+            module.fail_json(msg='missing required arguments: disk_resource_id')
+    elif module.params['state'] == 'absent':
+        if module.params['disk_resource_id']:
+            disk.destroy(module.params['disk_resource_id'])
+        else:
+            module.fail_json(msg='missing required arguments: disk_resource_id')
+    else:
+        if module.params['disk_resource_id']:
+            disk.present()
+        elif module.params['archive_resource_id']:
+            if not module.params['wait'] and disk._config_param_exist(module.params):
+                module.fail_json(msg='config_* parameters require wait')
+            if module.params['disks']:
+                disk.create_many()
+            else:
+                disk.present()
+        else:
+            module.fail_json(msg='missing required arguments: disk_resource_id')
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+from ansible.module_utils.sacloud.cache import sacloud_cache
+from ansible.module_utils.sacloud.client import Client
+from ansible.module_utils.sacloud.metrics import sacloud_metrics
+from ansible.module_utils.sacloud.snapshot import RESOURCE_MODELS, Snapshot
+
+# resource types a dry run reads from its snapshot, by their API path
+DRY_RUN_KINDS = ['servers', 'disks', 'routers', 'switches', 'appliances', 'archives']
+DRY_RUN_PATHS = dict((RESOURCE_MODELS[x][1], x) for x in DRY_RUN_KINDS)
+# root keys of single records
+DRY_RUN_ROOT_KEYS = dict(servers='Server', disks='Disk', routers='Internet',
+                        switches='Switch', appliances='Appliance',
+                        archives='Archive')
+# parallel tasks of one dry run share the snapshot this long
+DRY_RUN_SNAPSHOT_TTL = 300
+
+
+def dry_run_argument_spec():
+    return dict(
+        dry_run=dict(required=False, default=False, type='bool'),
+    )
+
+
+def dry_run_snapshot_cache(module):
+    return sacloud_cache(module, 'dry-run', DRY_RUN_SNAPSHOT_TTL)
+
+
+def sacloud_dry_run(module, saklient):
+    """Return the API the module runs with.
+
+    With dry_run, the module runs in check mode against a snapshot of the
+    zone: the first task lists every resource type once, and the tasks
+    after it find their resources in the cached snapshot instead of
+    requesting them one by one.
+    """
+    if not module.params.get('dry_run'):
+        return saklient
+    module.check_mode = True
+
+    def load():
+        snapshot = Snapshot(saklient, DRY_RUN_KINDS, concurrency=len(DRY_RUN_KINDS))
+        return snapshot.fetch().records
+    try:
+        with sacloud_metrics(saklient).phase('dry_run'):
+            records = dry_run_snapshot_cache(module).get_or_set('snapshot', load)
+    except Exception, e:
+        module.fail_json(msg='Failed to list resources for the dry run: %s' % e)
+    return saklient.__class__(DryRunClient(saklient.client, records))
+
+
+class DryRunError(Exception):
+    pass
+
+
+class DryRunClient(Client):
+    """saklient client reading resources from a snapshot.
+
+    Reads of the snapshot's resource types are answered from its records,
+    other reads go to the API, and writes are refused.
+    """
+
+    def __init__(self, client, records):
+        Client.__init__(self, client.config['token'], client.config['secret'])
+        self.config = client.config
+        self.metrics = getattr(client, 'metrics', None)
+        self._client = client
+        self._records = records
+
+    def clone_instance(self):
+        return DryRunClient(self._client.clone_instance(), self._records)
+
+    def request(self, method, path, params={}):
+        method = method.upper()
+        if method != 'GET':
+            raise DryRunError('A dry run does not %s %s' % (method, path))
+
+        parts = ('/' + path.lstrip('/')).split('/')
+        kind = DRY_RUN_PATHS.get('/'.join(parts[:2]))
+        filters = (params or {}).get('Filter') or {}
+        if kind is None or len(parts) > 3 \
+                or set(filters) - set(['Name', 'Tags.Name']):
+            return self._client.request(method, path, params)
+        if len(parts) == 3:
+            return self._get(kind, parts[2])
+        return self._find(kind, params or {})
+
+    def _get(self, kind, resource_id):
+        for record in self._records.get(kind, []):
+            if str(record['ID']) == str(resource_id):
+                return {DRY_RUN_ROOT_KEYS[kind]: record}
+        raise DryRunError('Not found: %s %s' % (kind, resource_id))
+
+    def _find(self, kind, params):
+        # the subset of list queries saklient models send: paging, names
+        # containing every given word, and tags
+        filters = params.get('Filter') or {}
+        words = (filters.get('Name') or '').lower().split()
+        tags = filters.get('Tags.Name') or []
+        records = [x for x in self._records.get(kind, [])
+                    if all([w in (x.get('Name') or '').lower() for w in words])
+                    and all([t in (x.get('Tags') or []) for t in tags])]
+
+        start = int(params.get('From') or 0)
+        count = params.get('Count')
+        page = records[start:start + int(count)] if count else records[start:]
+        return {RESOURCE_MODELS[kind][2]: page,
+                'Total': len(records), 'From': start, 'Count': len(page)}
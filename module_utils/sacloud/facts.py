@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+from ansible.module_utils.sacloud import sacloud_argument_spec
+from ansible.module_utils.sacloud.metrics import with_metrics
+from ansible.module_utils.sacloud.snapshot import PAGE_SIZE, RESOURCE_MODELS, Snapshot
+
+
+def facts_argument_spec():
+    argument_spec = sacloud_argument_spec()
+    argument_spec.update(dict(
+        resources=dict(required=False, type='list',
+                        default=sorted(RESOURCE_MODELS.keys())),
+        page_size=dict(required=False, default=PAGE_SIZE, type='int')
+    ))
+    return argument_spec
+
+
+class Facts():
+
+    def __init__(self, module, saklient):
+        self._module = module
+        self._saklient = saklient
+
+    def gather(self):
+        try:
+            snapshot = Snapshot(self._saklient,
+                                kinds=self._module.params['resources'],
+                                concurrency=self._module.params['http_pool_size'],
+                                page_size=self._module.params['page_size']).fetch()
+        except ValueError, e:
+            self._fail(msg=str(e))
+        except Exception, e:
+            self._fail(msg='Failed to fetch resources: %s' % e)
+
+        facts = snapshot.to_facts()
+        facts['zone'] = self._module.params['zone']
+        self._success(changed=False, ansible_facts=dict(sacloud_facts=facts))
+
+    def _fail(self, msg, **kwargs):
+        kwargs = with_metrics(self._module, self._saklient, kwargs)
+        self._module.fail_json(msg=msg, **kwargs)
+
+    def _success(self, changed=True, **kwargs):
+        kwargs = with_metrics(self._module, self._saklient, kwargs)
+        self._module.exit_json(changed=changed, **kwargs)
+
+
+def run_facts(module, saklient):
+    Facts(module, saklient).gather()
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import re
+
+from ansible.module_utils.sacloud import sacloud_argument_spec
+from ansible.module_utils.sacloud.cache import cache_argument_spec
+from ansible.module_utils.sacloud.client import clone_api
+from ansible.module_utils.sacloud.ipam import sacloud_ipam
+from ansible.module_utils.sacloud.metrics import Metrics
+from ansible.module_utils.sacloud.operations import OPERATIONS, OperationModule, check_params, run_operation
+from ansible.module_utils.sacloud.pool import WorkerPool
+from ansible.module_utils.sacloud.snapshot import find_resources
+
+# keys of the disk option set by the group instead
+GROUP_DISK_KEYS = ['name', 'disk_resource_id', 'server_resource_id',
+                    'router_resource_id', 'disks', 'state']
+# lbserver options, as the lbserver_* params of sacloud_lb
+GROUP_LBSERVER_KEYS = ['port', 'protocol', 'path', 'response']
+
+
+def server_group_argument_spec():
+    argument_spec = sacloud_argument_spec()
+    argument_spec.update(cache_argument_spec())
+    argument_spec.update(dict(
+        tag=dict(required=True),
+        count=dict(required=True, type='int'),
+        name=dict(required=False),
+        cpu=dict(required=False, type='int'),
+        mem=dict(required=False, type='int'),
+        desc=dict(required=False),
+        icon=dict(required=False),
+        tags=dict(required=False, type='list'),
+        disk=dict(required=False, type='dict'),
+        router_resource_id=dict(required=False, type='int'),
+        lb_resource_id=dict(required=False, type='int'),
+        virtual_ip=dict(required=False),
+        lbserver=dict(required=False, type='dict'),
+        running=dict(required=False, default=True, type='bool'),
+        concurrency=dict(required=False, default=4, type='int'),
+    ))
+    return argument_spec
+
+
+class GroupError(Exception):
+    pass
+
+
+class ServerGroup():
+    """Scale the servers carrying a tag to a count.
+
+    The members are listed with one query by tag. Missing members are
+    created in parallel, each with its disk copied from an archive,
+    connected to the router switch and booted, and the addresses of the
+    new members are added to the load balancer at once. Extra members,
+    those with the highest index first, are taken off the load balancer
+    and removed with their disks. A member that fails to come up is
+    removed again.
+    """
+
+    def __init__(self, module, saklient):
+        self._module = module
+        self._saklient = saklient
+        self._shared = dict((k, module.params[k]) for k in sacloud_argument_spec())
+        self._shared.update((k, module.params[k]) for k in cache_argument_spec())
+        self._name = module.params['name'] or '%s{index}' % module.params['tag']
+        self._ipam = sacloud_ipam(module)
+
+    def run(self):
+        params = self._module.params
+        if params['count'] < 0:
+            self._fail(msg='count must not be negative: %d' % params['count'])
+        for key in set(params['disk'] or {}) & set(GROUP_DISK_KEYS):
+            self._fail(msg='disk sets %s, which the group sets' % key)
+        for key in set(params['lbserver'] or {}) - set(GROUP_LBSERVER_KEYS):
+            self._fail(msg='Unsupported lbserver option: %s' % key)
+
+        members = self._get_members()
+        delta = params['count'] - len(members)
+        created, destroyed = [], []
+        if delta > 0:
+            created = self._create(self._get_new_names(members, delta))
+        elif delta < 0:
+            destroyed = self._destroy(self._get_extra_members(members, -delta))
+
+        gone = [x['sacloud_server_resource_id'] for x in destroyed]
+        members = sorted([x for x in members
+                            if x['sacloud_server_resource_id'] not in gone] + created,
+                            key=lambda x: self._get_index(x['name']))
+        ids = [x['sacloud_server_resource_id'] for x in members]
+        self._success(changed=bool(created or destroyed),
+                        members=members,
+                        created=[x['name'] for x in created],
+                        destroyed=[x['name'] for x in destroyed],
+                        ansible_facts=dict(sacloud_server_resource_ids=ids))
+
+    def _get_members(self):
+        # the sacloud modules store tags with a leading @
+        try:
+            _servers = find_resources(self._saklient.server,
+                                        tag='@%s' % self._module.params['tag'])
+        except Exception, e:
+            self._fail(msg='Failed to find group members: %s' % e)
+        return [dict(name=x.name, sacloud_server_resource_id=x.id,
+                        ipv4_address=self._get_address(x))
+                for x in _servers]
+
+    def _get_address(self, _server):
+        for _iface in _server.ifaces or []:
+            if _iface.ip_address or _iface.user_ip_address:
+                return _iface.ip_address or _iface.user_ip_address
+        # servers on a router switch usually get their address from the
+        # disk config only, which is what sacloud_disk leased for the disk
+        return self._get_leased_address(_server.name)
+
+    def _get_leased_address(self, name):
+        addresses = self._ipam.held('disk:%s' % self._get_disk_name(name))
+        return addresses[0] if addresses else None
+
+    def _get_disk_name(self, name):
+        return '%s disk' % name
+
+    def _format_name(self, index):
+        if '{index}' in self._name:
+            return self._name.replace('{index}', str(index))
+        return '%s%d' % (self._name, index)
+
+    def _get_index(self, name):
+        # members not named after the pattern sort last
+        pattern = re.escape(self._name).replace(re.escape('{index}'), '(\\d+)')
+        if '{index}' not in self._name:
+            pattern += '(\\d+)'
+        match = re.match('^%s$' % pattern, name or '')
+        if match:
+            return (0, int(match.group(1)), name)
+        return (1, 0, name)
+
+    def _get_new_names(self, members, count):
+        names = set([x['name'] for x in members])
+        new, index = [], 1
+        while len(new) < count:
+            if self._format_name(index) not in names:
+                new.append(self._format_name(index))
+            index += 1
+        return new
+
+    def _get_extra_members(self, members, count):
+        return sorted(members, key=lambda x: self._get_index(x['name']),
+                        reverse=True)[:count]
+
+    # scale out
+
+    def _create(self, names):
+        # sacloud_server would take over a server of the same name
+        self._check_names(names)
+        if self._module.check_mode:
+            return [dict(name=x, sacloud_server_resource_id=None, ipv4_address=None)
+                    for x in names]
+
+        pool = WorkerPool(self._module.params['concurrency'])
+        created, failed = [], []
+        for result in pool.map(self._create_member, names):
+            if result.failed:
+                failed.append('%s: %s' % (result.item, result.error))
+            else:
+                created.append(result.value)
+
+        # the members that came up serve even when others failed
+        addresses = [x['ipv4_address'] for x in created if x['ipv4_address']]
+        if self._module.params['lb_resource_id'] and addresses:
+            self._set_lbservers(addresses, 'present', created)
+        if failed:
+            self._fail(msg='Failed to create %d of %d members: %s'
+                        % (len(failed), len(names), '; '.join(failed)),
+                        created=[x['name'] for x in created])
+        return created
+
+    def _check_names(self, names):
+        try:
+            _servers = find_resources(self._saklient.server)
+        except Exception, e:
+            self._fail(msg='Failed to find servers: %s' % e)
+        clashes = sorted(set(names) & set([x.name for x in _servers]))
+        if clashes:
+            self._fail(msg='Servers not carrying %s are named %s'
+                        % (self._module.params['tag'], ', '.join(clashes)))
+
+    def _create_member(self, name):
+        built = {}
+        try:
+            return self._build_member(name, built)
+        except Exception, e:
+            # the group only keeps members that came up
+            try:
+                self._remove_member(built)
+            except GroupError, f:
+                raise GroupError('%s, and failed to remove it: %s' % (e, f))
+            raise
+
+    def _remove_member(self, built):
+        if built.get('disk_name') and not built.get('connected'):
+            # a disk failing to copy is there with no id returned
+            try:
+                _disks = find_resources(clone_api(self._saklient, Metrics()).disk,
+                                        built['disk_name'])
+            except Exception, e:
+                raise GroupError('Failed to find disk: %s' % e)
+            for _disk in _disks:
+                if _disk.name == built['disk_name']:
+                    self._run('sacloud_disk',
+                                dict(disk_resource_id=_disk.id, state='absent'))
+        if built.get('server'):
+            self._run('sacloud_server',
+                        dict(server_resource_ids=[built['server']],
+                            with_disks=True, state='absent'))
+
+    def _build_member(self, name, built):
+        params = self._module.params
+        tags = [params['tag']] + [x for x in params['tags'] or []
+                                    if x != params['tag']]
+        result = self._run('sacloud_server',
+                            dict(name=name, cpu=params['cpu'], mem=params['mem'],
+                                desc=params['desc'], icon=params['icon'],
+                                tags=tags, state='present'))
+        server_resource_id = self._get_fact(result, 'sacloud_server_resource_id')
+        built['server'] = server_resource_id
+        member = dict(name=name, sacloud_server_resource_id=server_resource_id,
+                        ipv4_address=None)
+
+        # interfaces and disks are only added to stopped servers
+        if params['router_resource_id']:
+            self._run('sacloud_router',
+                        dict(router_resource_id=params['router_resource_id'],
+                            server_resource_id=server_resource_id,
+                            state='connected'))
+        if params['disk'] is not None:
+            disk = dict(params['disk'], name=self._get_disk_name(name),
+                        state='present')
+            if params['router_resource_id']:
+                disk['router_resource_id'] = params['router_resource_id']
+            built['disk_name'] = disk['name']
+            result = self._run('sacloud_disk', disk)
+            built['disk'] = self._get_fact(result, 'sacloud_disk_resource_id')
+            member['ipv4_address'] = (result.get('ansible_facts') or {}) \
+                                        .get('sacloud_ipv4_address') \
+                                        or self._get_leased_address(name)
+            self._run('sacloud_disk',
+                        dict(disk_resource_id=built['disk'],
+                            server_resource_id=server_resource_id,
+                            state='connected'))
+            built['connected'] = True
+        if params['running']:
+            self._run('sacloud_server',
+                        dict(server_resource_id=server_resource_id,
+                            state='running'))
+        return member
+
+    # scale in
+
+    def _destroy(self, members):
+        if self._module.check_mode:
+            return members
+
+        addresses = [x['ipv4_address'] for x in members if x['ipv4_address']]
+        if self._module.params['lb_resource_id']:
+            unresolved = [x['name'] for x in members if not x['ipv4_address']]
+            if unresolved:
+                self._fail(msg='No ipv4 address found for %s to remove from the load balancer'
+                            % ', '.join(unresolved))
+            # no more traffic to the members before they go
+            self._set_lbservers(addresses, 'absent', [])
+        try:
+            self._run('sacloud_server',
+                        dict(server_resource_ids=[x['sacloud_server_resource_id']
+                                                    for x in members],
+                            with_disks=True,
+                            concurrency=self._module.params['concurrency'],
+                            state='absent'))
+        except GroupError, e:
+            self._fail(msg='Failed to destroy members: %s' % e)
+        return members
+
+    def _set_lbservers(self, addresses, state, created):
+        params = self._module.params
+        args = dict(lb_resource_id=params['lb_resource_id'],
+                    virtual_ip=params['virtual_ip'],
+                    lbserver_ips=addresses, lbserver_state=state,
+                    state='present')
+        for key, value in (params['lbserver'] or {}).items():
+            args['lbserver_%s' % key] = value
+        try:
+            self._run('sacloud_lb', args)
+        except GroupError, e:
+            self._fail(msg='Failed to update load balancer: %s' % e,
+                        created=[x['name'] for x in created])
+
+    # operations
+
+    def _run(self, name, args):
+        operation = OPERATIONS[name]
+        params = dict(self._shared)
+        params.update(args)
+        try:
+            params = check_params(operation, params)
+        except ValueError, e:
+            raise GroupError(str(e))
+
+        # a fresh API per operation: models keep query state
+        module = OperationModule(params, self._module.check_mode)
+        failed, result = run_operation(operation, module,
+                                        clone_api(self._saklient, Metrics()))
+        if failed:
+            raise GroupError(result.get('msg'))
+        return result
+
+    def _get_fact(self, result, name):
+        value = (result.get('ansible_facts') or {}).get(name)
+        if value is None:
+            raise GroupError('No %s returned' % name)
+        return value
+
+    def _fail(self, msg, **kwargs):
+        self._module.fail_json(msg=msg, **kwargs)
+
+    def _success(self, changed=True, **kwargs):
+        self._module.exit_json(changed=changed, **kwargs)
+
+
+def run_server_group(module, saklient):
+    ServerGroup(module, saklient).run()
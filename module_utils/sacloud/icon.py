@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+from ansible.module_utils.sacloud.metrics import sacloud_metrics
+
+
+class IconResolver():
+    """Resolve icon names to icons through a FileCache.
+
+    The icon catalogue rarely changes, so a name is looked up once per
+    cache TTL instead of once per created resource.
+    """
+
+    def __init__(self, saklient, cache):
+        self._saklient = saklient
+        self._cache = cache
+        self._icons = {}
+
+    def resolve(self, name):
+        if name not in self._icons:
+            with sacloud_metrics(self._saklient).phase('icon'):
+                data = self._cache.get_or_set(name, lambda: self._find(name))
+            if data is None:
+                raise LookupError('No icon matches %s' % name)
+            self._icons[name] = self._create_icon(data)
+        return self._icons[name]
+
+    def _find(self, name):
+        icons = self._saklient.icon \
+                .with_name_like(name) \
+                .limit(1) \
+                .find()
+        if not icons:
+            return None
+        return icons[0].dump()
+
+    def _create_icon(self, data):
+        from saklient.cloud.resources.icon import Icon
+        return Icon(self._saklient.client, data)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import time
+
+from ansible.module_utils.sacloud.cache import FileStore
+from ansible.module_utils.sacloud.metrics import sacloud_metrics
+
+
+AUTO_ADDRESS = 'auto'
+# Seconds the unused addresses of a subnet are trusted before they are
+# fetched from the API again
+IPAM_TTL = 300
+
+
+def sacloud_ipam(module):
+    """Return the address leases of the module's account and zone."""
+    account = hashlib.sha1(module.params['access_token'].encode('utf-8')) \
+            .hexdigest()[:12]
+    path = os.path.join(os.path.expanduser(module.params['cache_dir']),
+                        '%s-%s-ipam.json' % (account, module.params['zone']))
+    return AddressTable(path, refresh=module.params['cache_refresh'])
+
+
+class AddressError(Exception):
+    pass
+
+
+def _address_key(address):
+    return [int(x) for x in address.split('.')]
+
+
+class AddressTable(FileStore):
+    """Addresses of router switch subnets leased to their owners.
+
+    The unused addresses of a subnet are fetched from the API when the
+    router is first seen, and again once they are older than ttl or on
+    refresh, so addresses taken outside the table stop being handed out.
+    Leases are kept across fetches. Addresses are handed out and released
+    under the file lock, so parallel runs never lease the same address
+    twice. Owners are strings such as 'disk:<name>'; leasing again for an
+    owner returns the addresses it already holds.
+    """
+
+    def __init__(self, path, refresh=False, ttl=IPAM_TTL):
+        FileStore.__init__(self, path)
+        self._refresh = refresh
+        self._ttl = ttl
+        self._fetched = set()
+
+    def subnet(self, saklient, router_resource_id, refresh=False):
+        """Return the subnet of the router with its free addresses,
+        fetching the unused ones from the API first when refresh is true."""
+        def subnet(data):
+            _subnet = self._get_subnet(data, saklient, router_resource_id,
+                                        refresh)
+            return self._describe(_subnet, self._free(_subnet))
+        return self.update(subnet)
+
+    def lease(self, saklient, router_resource_id, owner, count=1,
+              commit=True):
+        """Lease count addresses of the router's subnet to owner."""
+        return self.lease_many(saklient, router_resource_id, [(owner, count)],
+                                commit)[owner]
+
+    def lease_many(self, saklient, router_resource_id, requests,
+                   commit=True):
+        """Lease addresses to each (owner, count) of requests at once.
+
+        Either every request is satisfied or none is. Returns the subnet
+        description with the addresses of each owner. Nothing is stored
+        when commit is false.
+        """
+        def lease(data):
+            _subnet = self._get_subnet(data, saklient, router_resource_id)
+            leases = _subnet['leases']
+            free = self._free(_subnet)
+            result = {}
+            for owner, count in requests:
+                held = leases.get(owner, [])
+                if len(held) < count:
+                    need = count - len(held)
+                    if len(free) < need:
+                        raise AddressError(
+                            'No free addresses left on router %s'
+                            % router_resource_id)
+                    held = held + free[:need]
+                    free = free[need:]
+                    leases[owner] = held
+                result[owner] = self._describe(_subnet, held[:count])
+            return result
+        return self.update(lease, commit)
+
+    def held(self, owner):
+        """Return the addresses leased to owner on any subnet."""
+        def held(data):
+            return sum([x['leases'].get(owner, []) for x in data.values()], [])
+        return self.update(held, commit=False)
+
+    def release(self, owner, commit=True):
+        """Return the addresses of owner to their subnets."""
+        def release(data):
+            released = []
+            for _subnet in data.values():
+                released.extend(_subnet['leases'].pop(owner, []))
+            return released
+        return self.update(release, commit)
+
+    def forget(self, router_resource_id):
+        """Drop the subnet of a destroyed router with all its leases."""
+        def forget(data):
+            return data.pop(str(router_resource_id), None) is not None
+        return self.update(forget)
+
+    def _get_subnet(self, data, saklient, router_resource_id, refresh=False):
+        key = str(router_resource_id)
+        _subnet = data.get(key)
+        if _subnet is None or refresh or self._is_stale(key, _subnet):
+            fetched = self._fetch(saklient, router_resource_id)
+            if _subnet is not None:
+                fetched['leases'] = _subnet['leases']
+            data[key] = fetched
+            self._fetched.add(key)
+        return data[key]
+
+    def _is_stale(self, key, _subnet):
+        if key in self._fetched:
+            return False
+        # cache_refresh fetches every subnet once per run
+        return self._refresh \
+                or _subnet.get('fetched', 0) + self._ttl <= time.time()
+
+    def _fetch(self, saklient, router_resource_id):
+        with sacloud_metrics(saklient).phase('ipam'):
+            _router = saklient.router.get_by_id(str(router_resource_id))
+            _swytch = _router.get_swytch()
+            _subnet = _swytch.dump()['Subnets'][0]
+            addresses = _swytch.collect_unused_ipv4_addresses() or []
+        return dict(
+                default_route=_subnet['DefaultRoute'],
+                network_mask_len=_subnet['NetworkMaskLen'],
+                addresses=sorted(addresses, key=_address_key),
+                leases={},
+                fetched=time.time()
+                )
+
+    def _free(self, _subnet):
+        leased = set()
+        for addresses in _subnet['leases'].values():
+            leased.update(addresses)
+        return [x for x in _subnet['addresses'] if x not in leased]
+
+    def _describe(self, _subnet, addresses):
+        return dict(
+                addresses=addresses,
+                default_route=_subnet['default_route'],
+                network_mask_len=_subnet['network_mask_len']
+                )
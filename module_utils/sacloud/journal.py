@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+from contextlib import contextmanager
+
+from ansible.module_utils.sacloud.cache import FileStore
+
+
+def sacloud_journal(module, name):
+    """Return the journal called name for the module's account and zone."""
+    account = hashlib.sha1(module.params['access_token'].encode('utf-8')) \
+            .hexdigest()[:12]
+    path = os.path.join(os.path.expanduser(module.params['cache_dir']),
+                        '%s-%s-%s.journal' % (account, module.params['zone'], name))
+    return Journal(path)
+
+
+class Journal(FileStore):
+    """Changes queued per resource by parallel module runs until a flush."""
+
+    def append(self, key, change):
+        def append(data):
+            data.setdefault(str(key), []).append(change)
+            return len(data[str(key)])
+        return self.update(append)
+
+    def keys(self):
+        return sorted(self._read().keys())
+
+    def pending(self, key):
+        return self._read().get(str(key), [])
+
+    @contextmanager
+    def drain(self, key):
+        """Yield the changes of key and drop them if the block succeeds.
+
+        The journal stays locked meanwhile, so changes appended by other
+        runs wait for the flush instead of being lost by it.
+        """
+        with self.lock():
+            yield self.pending(key)
+            data = self._read()
+            data.pop(str(key), None)
+            self._dump(data)
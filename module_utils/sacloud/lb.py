@@ -0,0 +1,635 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import copy
+
+from ansible.module_utils.sacloud import sacloud_argument_spec
+from ansible.module_utils.sacloud.metrics import sacloud_metrics, with_metrics
+from ansible.module_utils.sacloud.cache import cache_argument_spec, sacloud_cache
+from ansible.module_utils.sacloud.icon import IconResolver
+from ansible.module_utils.sacloud.ipam import AUTO_ADDRESS, sacloud_ipam
+from ansible.module_utils.sacloud.waiter import wait_for
+from ansible.module_utils.sacloud.reconcile import Reconciler, change_diff, create_diff, destroy_diff, sorted_list
+from ansible.module_utils.sacloud.dryrun import dry_run_argument_spec, dry_run_snapshot_cache, sacloud_dry_run
+from ansible.module_utils.sacloud.snapshot import find_resources
+from ansible.module_utils.sacloud.state import sacloud_state, state_argument_spec
+from ansible.module_utils.sacloud.journal import sacloud_journal
+
+
+def lb_argument_spec():
+    argument_spec = sacloud_argument_spec()
+    argument_spec.update(cache_argument_spec())
+    argument_spec.update(state_argument_spec())
+    argument_spec.update(dry_run_argument_spec())
+    argument_spec.update(dict(
+        router_resource_id=dict(required=False, type='int'),
+        lb_resource_id=dict(required=False, type='int'),
+        name=dict(required=False),
+        desc=dict(required=False),
+        tags=dict(required=False, type='list'),
+        icon=dict(required=False),
+        vrid=dict(required=False, type='int'),
+        real_ips=dict(required=False, type='list'),
+        high_spec=dict(required=False, default=False, type='bool'),
+        force=dict(required=False, default=False, type='bool'),
+        virtual_ip=dict(required=False),
+        port=dict(required=False, default=80, type='int'),
+        delay_loop=dict(required=False, default=10, type='int'),
+        lbserver_ips=dict(required=False, type='list'),
+        lbserver_port=dict(required=False, default=80, type='int'),
+        lbserver_protocol=dict(required=False, default='http',
+                                choices=['http', 'https', 'tcp', 'ping']),
+        lbserver_path=dict(required=False, default='/index.html'),
+        lbserver_response=dict(required=False, default=200, type='int'),
+        virtual_ips=dict(required=False, type='list'),
+        lbserver_state=dict(required=False,
+                            choices=['present', 'absent', 'enabled', 'disabled']),
+        defer=dict(required=False, default=False, type='bool'),
+        wait=dict(required=False, default=True, type='bool'),
+        state=dict(required=False, default='present',
+                    choices=['present', 'absent', 'stopped', 'running',
+                                'applied', 'flushed'])
+    ))
+    return argument_spec
+
+
+LB_MUTUALLY_EXCLUSIVE = [
+    ['virtual_ips', 'virtual_ip'],
+    ['virtual_ips', 'lbserver_ips'],
+    ['virtual_ips', 'lbserver_state']]
+
+
+class LoadBalancer():
+
+    def __init__(self, module, saklient):
+        self._module = module
+        self._saklient = saklient
+        self._icon_resolver = IconResolver(saklient,
+                                        sacloud_cache(module, 'icons'))
+        self._journal = sacloud_journal(module, 'lb')
+        self._ipam = sacloud_ipam(module)
+        self._leased = dict()
+        self._state = sacloud_state(module, 'sacloud_lb')
+        self._dry_run_cache = dry_run_snapshot_cache(module)
+
+    def _get_desc(self, desc):
+        if desc:
+            return self._str2triple_quoted_str(desc)
+        else:
+            return desc
+
+    def _str2triple_quoted_str(self, desc):
+        return '''%s''' % desc
+
+    def _get_tags(self, tags):
+        if tags:
+            return self._parse_tags(tags)
+        else:
+            return tags
+
+    def _parse_tags(self, tags):
+        return [''.join(['@', x]) for x in tags]
+
+    def _get_icon(self, icon):
+        if icon:
+            return self._get_icon_with_name_like(icon)
+        else:
+            return icon
+
+    def _get_icon_with_name_like(self, icon):
+        try:
+            return self._icon_resolver.resolve(icon)
+        except Exception, e:
+            self._fail(msg='Failed to find router icon: %s' % e)
+
+    def _get_swytch_by_id(self, router_resource_id):
+        return self._get_router_by_id(router_resource_id).get_swytch()
+
+    def _get_router_by_id(self, router_resource_id):
+        try:
+            return self._saklient.router.get_by_id(str(router_resource_id))
+        except Exception:
+            self._fail(msg='Failed to find router: %s' % router_resource_id)
+
+    def stop(self, lb_resource_id):
+        _lb = self._get_lb_by_id(lb_resource_id)
+
+        if _lb.status == 'down':
+            self._success(changed=False, result='The load balancer already stopped')
+        elif self._module.check_mode:
+            self._success(diff=change_diff('status', _lb.status, 'down'))
+
+        try:
+            with self._phase('power'):
+                if self._module.params['force']:
+                    _lb.stop()
+                else:
+                    _lb.shutdown()
+            if self._module.params['wait']:
+                self._wait_for(_lb, 'down')
+        except Exception, e:
+            self._fail(msg='Failed to stop load balancer: %s' % e)
+        self._success(result='Successfully stop load balancer')
+
+    def boot(self, lb_resource_id):
+        _lb = self._get_lb_by_id(lb_resource_id)
+
+        if _lb.status == 'up':
+            self._success(changed=False, result='The load balancer already running')
+        elif self._module.check_mode:
+            self._success(diff=change_diff('status', _lb.status, 'up'))
+        try:
+            with self._phase('power'):
+                _lb.boot()
+            if self._module.params['wait']:
+                self._wait_for(_lb, 'up')
+        except Exception, e:
+            self._fail(msg='Failed to boot load balancer: %s' % e)
+        self._success(result='Successfully boot load balancer')
+
+    def destroy(self, lb_resource_id):
+        _lb = self._get_lb_by_id(lb_resource_id)
+
+        if self._module.check_mode:
+            self._success(diff=destroy_diff(_lb))
+
+        try:
+            with self._phase('destroy'):
+                if _lb.status == 'up':
+                    _lb.stop()
+                    self._wait_for(_lb, 'down')
+                _lb.destroy()
+            self._ipam.release(self._get_owner(_lb.name))
+            self._state.forget(_lb.id)
+        except Exception, e:
+            self._fail(msg='Failed to destroy load balancer: %s' % e)
+        self._success(result='Successfully destroy load balancer: %d'
+                        % int(_lb.id))
+
+    def _wait_for(self, _lb, state=None):
+        target = wait_for(self._saklient, 'lb', _lb.id, state)
+        if target.failed:
+            self._fail(msg='Failed to wait for load balancer: %d' % int(_lb.id))
+        elif not target.converged:
+            self._fail(msg='Timeout waiting for load balancer to be %s: %d'
+                        % (target.state, int(_lb.id)))
+        return target.resource
+
+    def _get_lb_by_id(self, lb_resource_id):
+        try:
+            return self._saklient.appliance.get_by_id(str(lb_resource_id))
+        except Exception, e:
+            self._fail(msg='Failed to find load balancer: %s' % e)
+
+    def present(self):
+        cached = self._state.replay(self._saklient)
+        if cached is not None:
+            self._success(changed=False, **cached)
+
+        if self._module.params['lb_resource_id']:
+            _lb = self._get_lb_by_id(self._module.params['lb_resource_id'])
+        else:
+            _lb = self._find_lb(self._module.params['name'] or 'default')
+
+        self._lease_addresses(self._module.params['name']
+                                or (_lb and _lb.name))
+        if _lb is None:
+            for key in ['router_resource_id', 'vrid', 'real_ips', 'lbserver_ips']:
+                if key == 'lbserver_ips' and self._module.params['virtual_ips']:
+                    continue
+                if not self._module.params[key]:
+                    self._fail(msg='missing required arguments: %s' % key)
+            self.create(self._module.params['router_resource_id'],
+                        self._module.params['vrid'],
+                        self._module.params['real_ips'],
+                        self._module.params['high_spec'])
+        self.update(_lb)
+
+    def _lease_addresses(self, name):
+        # Replaces auto in virtual_ip and real_ips with leased addresses
+        params = self._module.params
+        real_ips = params['real_ips'] or []
+        count = len([x for x in real_ips if x == AUTO_ADDRESS])
+        if params['virtual_ip'] == AUTO_ADDRESS:
+            count += 1
+        if not count:
+            return
+        if not params['router_resource_id']:
+            self._fail(msg='auto addresses require router_resource_id')
+
+        try:
+            lease = self._ipam.lease(self._saklient, params['router_resource_id'],
+                                    self._get_owner(name), count,
+                                    commit=not self._module.check_mode)
+        except Exception, e:
+            self._fail(msg='Failed to lease ipv4 address: %s' % e)
+
+        addresses = list(lease['addresses'])
+        if params['virtual_ip'] == AUTO_ADDRESS:
+            params['virtual_ip'] = addresses.pop(0)
+            self._leased.update(sacloud_lb_virtual_ip=params['virtual_ip'])
+        if AUTO_ADDRESS in real_ips:
+            params['real_ips'] = [addresses.pop(0) if x == AUTO_ADDRESS else x
+                                    for x in real_ips]
+            self._leased.update(sacloud_lb_real_ips=params['real_ips'])
+
+    def _get_owner(self, name):
+        return 'lb:%s' % (name or 'default')
+
+    def _get_facts(self, _lb):
+        facts = dict(self._leased)
+        facts.update(sacloud_lb_resource_id=_lb.id)
+        return facts
+
+    def _find_lb(self, name):
+        try:
+            _lbs = [x for x in find_resources(self._saklient.appliance, name)
+                    if x.clazz == 'loadbalancer']
+        except Exception, e:
+            self._fail(msg='Failed to find load balancer: %s' % e)
+
+        if len(_lbs) > 1:
+            self._fail(msg='Multiple load balancers named %s: %s'
+                        % (name, ', '.join([x.id for x in _lbs])))
+        elif _lbs:
+            return _lbs[0]
+        return None
+
+    def update(self, _lb):
+        reconciler = self._get_reconciler(_lb)
+
+        if not reconciler.changed or self._module.check_mode:
+            self._success(changed=reconciler.changed, diff=reconciler.diff,
+                            ansible_facts=self._get_facts(_lb))
+
+        try:
+            _lb = reconciler.apply()
+            if 'virtual_ips' in reconciler.after:
+                with self._phase('apply'):
+                    _lb.apply()
+        except Exception, e:
+            self._fail(msg='Failed to update load balancer: %s' % e)
+        self._success(result='Successfully update load balancer: %d' % int(_lb.id),
+                        diff=reconciler.diff,
+                        ansible_facts=self._get_facts(_lb))
+
+    def _get_reconciler(self, _lb):
+        reconciler = Reconciler(_lb)
+        reconciler.set('name', _lb.name, self._module.params['name'])
+        reconciler.set('desc', _lb.description,
+                        self._get_desc(self._module.params['desc']),
+                        attr='description')
+        reconciler.set('tags', _lb.tags,
+                        self._get_tags(self._module.params['tags']),
+                        key=sorted_list)
+        if self._module.params['icon']:
+            _icon = self._get_icon(self._module.params['icon'])
+            reconciler.set('icon', _lb.icon.id if _lb.icon else None,
+                            _icon.id, value=_icon)
+
+        changes = self._get_changes()
+        if changes:
+            self._edit_virtual_ips(reconciler, _lb, changes)
+        return reconciler
+
+    def _edit_virtual_ips(self, reconciler, _lb, changes):
+        current = self._dump_virtual_ips(_lb)
+        virtual_ips = self._merge_changes(current, changes)
+        reconciler.edit('virtual_ips', current, virtual_ips,
+                        lambda: self._set_virtual_ips(_lb, virtual_ips))
+
+    def _get_changes(self):
+        params = self._module.params
+        if params['lbserver_state']:
+            server = self._get_lbserver_spec(None, params['lbserver_port'],
+                                            params['lbserver_protocol'],
+                                            params['lbserver_path'],
+                                            params['lbserver_response'], True)
+            del server['ip']
+            return [dict(type='servers', state=params['lbserver_state'],
+                            ips=params['lbserver_ips'],
+                            virtual_ip=params['virtual_ip'], server=server)]
+
+        virtual_ips = self._get_virtual_ip_specs()
+        if virtual_ips is None:
+            return []
+        return [dict(type='virtual_ips', virtual_ips=virtual_ips)]
+
+    def _merge_changes(self, virtual_ips, changes):
+        # changes are applied in order on a copy of the VIP specs
+        virtual_ips = copy.deepcopy(virtual_ips)
+        for change in changes:
+            if change['type'] == 'virtual_ips':
+                virtual_ips = copy.deepcopy(change['virtual_ips'])
+                continue
+
+            for vip in virtual_ips:
+                if change['virtual_ip'] and vip['virtual_ip'] != change['virtual_ip']:
+                    continue
+                servers = dict((x['ip'], x) for x in vip['servers'])
+                for ip in change['ips']:
+                    if change['state'] == 'present':
+                        servers[ip] = dict(change['server'], ip=ip)
+                    elif change['state'] == 'absent':
+                        servers.pop(ip, None)
+                    elif ip in servers:
+                        servers[ip]['enabled'] = change['state'] == 'enabled'
+                vip['servers'] = sorted(servers.values(), key=lambda x: x['ip'])
+        return virtual_ips
+
+    def defer(self, lb_resource_id):
+        for key in ['name', 'desc', 'tags', 'icon']:
+            if self._module.params[key] is not None:
+                self._fail(msg='defer only records virtual ip and real server changes')
+        if self._module.params['virtual_ip'] == AUTO_ADDRESS:
+            self._fail(msg='defer cannot lease addresses, virtual_ip must be given')
+
+        changes = self._get_changes()
+        pending = len(self._journal.pending(lb_resource_id))
+        if not changes or self._module.check_mode:
+            self._success(changed=bool(changes), pending=pending + len(changes),
+                            ansible_facts=dict(sacloud_lb_resource_id=str(lb_resource_id)))
+
+        try:
+            for change in changes:
+                pending = self._journal.append(lb_resource_id, change)
+        except Exception, e:
+            self._fail(msg='Failed to record load balancer change: %s' % e)
+        self._success(result='Deferred %d load balancer changes' % len(changes),
+                        pending=pending,
+                        ansible_facts=dict(sacloud_lb_resource_id=str(lb_resource_id)))
+
+    def flush(self, lb_resource_id=None):
+        if lb_resource_id:
+            keys = [str(lb_resource_id)]
+        else:
+            keys = self._journal.keys()
+
+        lbs = []
+        for key in keys:
+            try:
+                if self._module.check_mode:
+                    lbs.append(self._flush_lb(key, self._journal.pending(key)))
+                    continue
+                with self._journal.drain(key) as changes:
+                    lbs.append(self._flush_lb(key, changes))
+            except Exception, e:
+                self._fail(msg='Failed to flush load balancer %s: %s' % (key, e),
+                            lbs=lbs)
+        self._success(changed=any([x['changed'] for x in lbs]), lbs=lbs)
+
+    def _flush_lb(self, lb_resource_id, changes):
+        # one read, one save and one apply per appliance, however many
+        # changes were queued
+        result = dict(id=lb_resource_id, changes=len(changes), changed=False)
+        if not changes:
+            return result
+
+        _lb = self._saklient.appliance.get_by_id(str(lb_resource_id))
+        reconciler = Reconciler(_lb)
+        self._edit_virtual_ips(reconciler, _lb, changes)
+        result.update(changed=reconciler.changed, diff=reconciler.diff)
+
+        if reconciler.changed and not self._module.check_mode:
+            reconciler.apply()
+            with self._phase('apply'):
+                _lb.apply()
+        return result
+
+    def set_lbservers_enabled(self, _lb, ips, enabled):
+        """Enable or disable the real servers at ips on every virtual ip
+        and apply the change. Raises instead of failing the task."""
+        change = dict(type='servers', ips=ips, virtual_ip=None, server=None,
+                        state='enabled' if enabled else 'disabled')
+        reconciler = Reconciler(_lb)
+        self._edit_virtual_ips(reconciler, _lb, [change])
+        if reconciler.changed:
+            reconciler.apply()
+            with self._phase('apply'):
+                _lb.apply()
+        return reconciler.changed
+
+    def get_lbserver_health(self, _lb):
+        """Return the health check result of the real servers by address,
+        up only where every virtual ip sees the server up."""
+        # LoadBalancer.reload_status() of saklient breaks on virtual ips
+        # it does not know, so the status is read as is
+        with self._phase('health'):
+            result = self._saklient.client.request('GET', '/appliance/%s/status'
+                                                    % _lb.id)
+        health = {}
+        for vip in result.get('LoadBalancer') or []:
+            for server in vip.get('Servers') or []:
+                status = (server.get('Status') or 'down').lower()
+                if health.get(server.get('IPAddress'), 'up') == 'up':
+                    health[server.get('IPAddress')] = status
+        return health
+
+    def _get_virtual_ip_specs(self):
+        params = self._module.params
+        if params['virtual_ips'] is not None:
+            vips = params['virtual_ips']
+        elif params['virtual_ip']:
+            vips = [dict(virtual_ip=params['virtual_ip'],
+                        servers=params['lbserver_ips'] or [])]
+        else:
+            return None
+
+        specs = []
+        for vip in vips:
+            if not vip.get('virtual_ip'):
+                self._fail(msg='virtual_ips require virtual_ip: %s' % vip)
+            servers = []
+            for server in vip.get('servers') or []:
+                if not isinstance(server, dict):
+                    server = dict(ip=server)
+                servers.append(self._get_lbserver_spec(
+                                    server.get('ip'),
+                                    int(server.get('port', params['lbserver_port'])),
+                                    server.get('protocol', params['lbserver_protocol']),
+                                    server.get('path', params['lbserver_path']),
+                                    int(server.get('response', params['lbserver_response'])),
+                                    self._module.boolean(server.get('enabled', True))))
+            specs.append(dict(virtual_ip=vip['virtual_ip'],
+                                port=int(vip.get('port', params['port'])),
+                                delay_loop=int(vip.get('delay_loop', params['delay_loop'])),
+                                servers=sorted(servers, key=lambda x: x['ip'])))
+        return sorted(specs, key=lambda x: (x['virtual_ip'], x['port']))
+
+    def _get_lbserver_spec(self, ip, port, protocol, path, response, enabled):
+        # the path and the expected status only apply to http checks
+        if protocol not in ['http', 'https']:
+            path = None
+            response = None
+        return dict(ip=ip, port=port, protocol=protocol, path=path,
+                    response=response, enabled=enabled)
+
+    def _dump_virtual_ips(self, _lb):
+        vips = []
+        for vip in _lb.virtual_ips:
+            servers = [self._get_lbserver_spec(x.ip_address, x.port, x.protocol,
+                                                x.path_to_check,
+                                                x.response_expected,
+                                                x.enabled is not False)
+                        for x in vip.servers]
+            vips.append(dict(virtual_ip=vip.virtual_ip_address,
+                                port=vip.port,
+                                delay_loop=vip.delay_loop,
+                                servers=sorted(servers, key=lambda x: x['ip'])))
+        return sorted(vips, key=lambda x: (x['virtual_ip'], x['port']))
+
+    def _set_virtual_ips(self, _lb, specs):
+        # Only the VIPs and servers that differ are touched; the rest of
+        # the settings are written back as they were.
+        current = dict(((x.virtual_ip_address, x.port), x)
+                        for x in _lb.virtual_ips)
+        keys = [(x['virtual_ip'], x['port']) for x in specs]
+        for key, vip in current.items():
+            if key not in keys:
+                _lb.virtual_ips.remove(vip)
+
+        for spec in specs:
+            vip = current.get((spec['virtual_ip'], spec['port']))
+            if vip is None:
+                vip = _lb.add_virtual_ip()
+                vip.virtual_ip_address = spec['virtual_ip']
+                vip.port = spec['port']
+            if vip.delay_loop != spec['delay_loop']:
+                vip.delay_loop = spec['delay_loop']
+            self._set_lbservers(vip, spec['servers'])
+
+    def _set_lbservers(self, vip, specs):
+        ips = [x['ip'] for x in specs]
+        for lbserver in list(vip.servers):
+            if lbserver.ip_address not in ips:
+                vip.remove_server_by_address(lbserver.ip_address)
+
+        for spec in specs:
+            lbserver = vip.get_server_by_address(spec['ip'])
+            if lbserver is None:
+                lbserver = vip.add_server()
+                lbserver.ip_address = spec['ip']
+            for attr, key in [('port', 'port'), ('protocol', 'protocol'),
+                                ('path_to_check', 'path'),
+                                ('response_expected', 'response'),
+                                ('enabled', 'enabled')]:
+                if spec[key] is not None and getattr(lbserver, attr) != spec[key]:
+                    setattr(lbserver, attr, spec[key])
+
+    def create(self, router_resource_id, vrid, real_ips, high_spec):
+        swytch = self._get_swytch_by_id(router_resource_id)
+
+        if self._module.check_mode:
+            params = self._module.params
+            self._success(diff=create_diff(dict(name=params['name'] or 'default',
+                                                router_resource_id=router_resource_id,
+                                                vrid=vrid, real_ips=real_ips,
+                                                high_spec=high_spec,
+                                                virtual_ips=self._get_virtual_ip_specs())),
+                            ansible_facts=self._leased)
+
+        try:
+            _lb = self._saklient.appliance.create_load_balancer(swytch, vrid, real_ips, high_spec)
+        except Exception, e:
+            self._fail(msg='Failed to create load balancer object: %s' % e)
+
+        self._set_params(_lb, vrid)
+        try:
+            with self._phase('save'):
+                _lb.save()
+            if self._module.params['wait']:
+                self._wait_for(_lb)
+        except Exception, e:
+            self._fail(msg='Failed to create load balancer: %s' % e)
+        self._success(result='Successfully create load balancer: %s' % _lb.id,
+                            ansible_facts=self._get_facts(_lb))
+
+    def _set_params(self, _lb, vrid):
+        _lb.name = self._module.params['name'] or 'default'
+        _lb.vrid = vrid
+
+        if self._module.params['desc']:
+            _lb.description = self._get_desc(self._module.params['desc'])
+        if self._module.params['tags']:
+            _lb.tags = self._get_tags(self._module.params['tags'])
+        if self._module.params['icon']:
+            _lb.icon = self._get_icon(self._module.params['icon'])
+
+        virtual_ips = self._get_virtual_ip_specs()
+        if virtual_ips:
+            self._set_virtual_ips(_lb, virtual_ips)
+
+    def apply(self, lb_resource_id):
+        _lb = self._get_lb_by_id(lb_resource_id)
+
+        if self._module.check_mode:
+            self._success()
+
+        try:
+            with self._phase('apply'):
+                _lb.apply()
+        except Exception, e:
+            self._fail(msg='Failed to apply load balancer: %s' % e)
+        self._success(result='Successfully apply load balancer: %d'
+                        % int(_lb.id))
+
+    def _phase(self, name):
+        return sacloud_metrics(self._saklient).phase(name)
+
+    def _fail(self, msg, **kwargs):
+        kwargs = with_metrics(self._module, self._saklient, kwargs)
+        self._module.fail_json(msg=msg, **kwargs)
+
+    def _success(self, changed=True, **kwargs):
+        self._state.record(kwargs)
+        if changed and not self._module.check_mode:
+            # plans made from now on see the change
+            self._dry_run_cache.invalidate()
+        kwargs = with_metrics(self._module, self._saklient, kwargs)
+        self._module.exit_json(changed=changed, **kwargs)
+
+
+def run_lb(module, saklient):
+    saklient = sacloud_dry_run(module, saklient)
+    lb = LoadBalancer(module, saklient)
+
+    if module.params['state'] in ['absent', 'stopped', 'running', 'applied'] \
+            and not module.params['lb_resource_id']:
+        module.fail_json(msg='missing required arguments: lb_resource_id')
+
+    # TODO: more convinient way to handle args
+    if module.params['lbserver_state'] and not module.params['lbserver_ips']:
+        module.fail_json(msg='missing required arguments: lbserver_ips')
+
+    if module.params['state'] == 'present':
+        if module.params['defer']:
+            if not module.params['lb_resource_id']:
+                module.fail_json(msg='missing required arguments: lb_resource_id')
+            lb.defer(module.params['lb_resource_id'])
+        lb.present()
+    elif module.params['state'] == 'flushed':
+        lb.flush(module.params['lb_resource_id'])
+    elif module.params['state'] == 'absent':
+        lb.destroy(module.params['lb_resource_id'])
+    elif module.params['state'] == 'stopped':
+        lb.stop(module.params['lb_resource_id'])
+    elif module.params['state'] == 'running':
+        lb.boot(module.params['lb_resource_id'])
+    else:
+        lb.apply(module.params['lb_resource_id'])
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+
+def sacloud_metrics(saklient):
+    """Return the metrics shared by every client of the module run.
+
+    saklient may be the API, its client, or any model or resource
+    obtained from it.
+    """
+    client = getattr(saklient, 'client', saklient)
+    metrics = getattr(client, 'metrics', None)
+    if metrics is None:
+        # a plain saklient client: count nothing but keep callers simple
+        return Metrics()
+    return metrics
+
+
+def with_metrics(module, saklient, result):
+    """Add sacloud_metrics to a module result when metrics are enabled."""
+    if module.params.get('metrics') and saklient is not None:
+        result = dict(result)
+        result['sacloud_metrics'] = sacloud_metrics(saklient).to_dict()
+    return result
+
+
+def endpoint(method, path):
+    """'GET /server/:id' for 'GET /.../api/cloud/1.1/server/1123?...'."""
+    path = path.split('?', 1)[0]
+    if '/api/cloud/1.1' in path:
+        path = path.split('/api/cloud/1.1', 1)[1]
+    return '%s %s' % (method, re.sub(r'/\d+(?=/|$)', '/:id', path))
+
+
+class Metrics():
+    """Timings and API call counters of one module run.
+
+    Shared by all threads of the run. Phases running in parallel threads
+    add up, so their seconds may exceed the wall-clock time of the run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._phases = {}
+        self._requests = {}
+        self._retries = {}
+        self._polls = {}
+        self._bytes_sent = 0
+        self._bytes_received = 0
+
+    @contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - started
+            with self._lock:
+                phase = self._phases.setdefault(name, dict(seconds=0.0, count=0))
+                phase['seconds'] += seconds
+                phase['count'] += 1
+
+    def record_request(self, method, path, sent, received):
+        key = endpoint(method, path)
+        with self._lock:
+            self._requests[key] = self._requests.get(key, 0) + 1
+            self._bytes_sent += sent
+            self._bytes_received += received
+
+    def record_retry(self, method, path):
+        key = endpoint(method, path)
+        with self._lock:
+            self._retries[key] = self._retries.get(key, 0) + 1
+
+    def record_poll(self, kind):
+        with self._lock:
+            self._polls[kind] = self._polls.get(kind, 0) + 1
+
+    def to_dict(self):
+        with self._lock:
+            phases = dict((name, dict(seconds=round(x['seconds'], 3),
+                                        count=x['count']))
+                            for name, x in self._phases.items())
+            return dict(
+                    seconds=round(time.time() - self._started, 3),
+                    phases=phases,
+                    requests=dict(self._requests),
+                    requests_total=sum(self._requests.values()),
+                    bytes_sent=self._bytes_sent,
+                    bytes_received=self._bytes_received,
+                    retries=dict(self._retries),
+                    retries_total=sum(self._retries.values()),
+                    polls=dict(self._polls),
+                    )
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+from ansible.module_utils.sacloud.disk import disk_argument_spec, run_disk
+from ansible.module_utils.sacloud.facts import facts_argument_spec, run_facts
+from ansible.module_utils.sacloud.lb import LB_MUTUALLY_EXCLUSIVE, lb_argument_spec, run_lb
+from ansible.module_utils.sacloud.router import ROUTER_MUTUALLY_EXCLUSIVE, router_argument_spec, run_router
+from ansible.module_utils.sacloud.server import SERVER_MUTUALLY_EXCLUSIVE, run_server, server_argument_spec
+from ansible.module_utils.sacloud.wait import run_wait, wait_argument_spec
+
+BOOLEANS_TRUE = ['y', 'yes', 'on', '1', 'true', 't']
+BOOLEANS_FALSE = ['n', 'no', 'off', '0', 'false', 'f']
+
+
+class Operation():
+    """What a sacloud module does, runnable without AnsibleModule."""
+
+    def __init__(self, name, argument_spec, run, mutually_exclusive=None):
+        self.name = name
+        self.argument_spec = argument_spec
+        self.run = run
+        self.mutually_exclusive = mutually_exclusive or []
+
+
+OPERATIONS = dict((x.name, x) for x in [
+    Operation('sacloud_server', server_argument_spec, run_server,
+                SERVER_MUTUALLY_EXCLUSIVE),
+    Operation('sacloud_disk', disk_argument_spec, run_disk),
+    Operation('sacloud_router', router_argument_spec, run_router,
+                ROUTER_MUTUALLY_EXCLUSIVE),
+    Operation('sacloud_lb', lb_argument_spec, run_lb, LB_MUTUALLY_EXCLUSIVE),
+    Operation('sacloud_wait', wait_argument_spec, run_wait),
+    Operation('sacloud_facts', facts_argument_spec, run_facts),
+])
+
+
+class OperationExit(BaseException):
+    # like the SystemExit of AnsibleModule, it passes the modules'
+    # except Exception blocks
+
+    def __init__(self, failed, result):
+        BaseException.__init__(self, result.get('msg'))
+        self.failed = failed
+        self.result = result
+
+
+class OperationModule():
+    """What the operations use of AnsibleModule. exit_json and fail_json
+    raise OperationExit with the result instead of printing it."""
+
+    def __init__(self, params, check_mode=False):
+        self.params = params
+        self.check_mode = check_mode
+
+    def exit_json(self, **kwargs):
+        kwargs.setdefault('changed', False)
+        raise OperationExit(False, kwargs)
+
+    def fail_json(self, **kwargs):
+        kwargs['failed'] = True
+        raise OperationExit(True, kwargs)
+
+    def boolean(self, arg):
+        if arg is None or isinstance(arg, bool):
+            return arg
+        return str(arg).lower() in BOOLEANS_TRUE
+
+
+def run_operation(operation, module, saklient):
+    """Run operation and return (failed, result)."""
+    try:
+        operation.run(module, saklient)
+        module.fail_json(msg='%s returned no result' % operation.name)
+    except OperationExit, e:
+        return e.failed, e.result
+
+
+def check_params(operation, params):
+    """Check params against the operation's argument spec the way
+    AnsibleModule checks task arguments, returning them with aliases
+    resolved, values converted and defaults filled in. Raises ValueError."""
+    argument_spec = operation.argument_spec()
+    params = dict(params)
+
+    for name, spec in argument_spec.items():
+        for alias in spec.get('aliases', []):
+            if alias in params:
+                if name in params:
+                    raise ValueError('parameters are mutually exclusive: %s|%s'
+                                        % (name, alias))
+                params[name] = params.pop(alias)
+
+    unsupported = sorted(set(params) - set(argument_spec))
+    if unsupported:
+        raise ValueError('Unsupported parameters for %s: %s'
+                            % (operation.name, ', '.join(unsupported)))
+
+    for names in operation.mutually_exclusive:
+        if len([x for x in names if params.get(x) is not None]) > 1:
+            raise ValueError('parameters are mutually exclusive: %s'
+                                % '|'.join(names))
+
+    checked = {}
+    for name, spec in argument_spec.items():
+        value = params.get(name)
+        if value is None:
+            if spec.get('required'):
+                raise ValueError('missing required arguments: %s' % name)
+            checked[name] = spec.get('default')
+            continue
+        value = _convert(name, value, spec.get('type', 'str'))
+        if spec.get('choices') and value not in spec['choices']:
+            raise ValueError('value of %s must be one of: %s, got: %s'
+                                % (name, ', '.join(map(str, spec['choices'])), value))
+        checked[name] = value
+    return checked
+
+
+def _convert(name, value, type):
+    try:
+        if type == 'str':
+            return value if isinstance(value, basestring) else str(value)
+        elif type == 'int':
+            return int(value)
+        elif type == 'float':
+            return float(value)
+        elif type == 'bool':
+            if isinstance(value, bool):
+                return value
+            if str(value).lower() in BOOLEANS_TRUE:
+                return True
+            if str(value).lower() in BOOLEANS_FALSE:
+                return False
+            raise ValueError(value)
+        elif type == 'list':
+            if isinstance(value, list):
+                return value
+            if isinstance(value, basestring):
+                return value.split(',')
+            return [value]
+        elif type == 'dict':
+            if isinstance(value, dict):
+                return value
+            raise ValueError(value)
+    except (TypeError, ValueError):
+        raise ValueError('%s is not a valid %s: %s' % (name, type, value))
+    return value
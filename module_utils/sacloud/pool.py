@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class WorkerResult():
+
+    def __init__(self, item, value=None, error=None):
+        self.item = item
+        self.value = value
+        self.error = error
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+
+class WorkerPool():
+
+    def __init__(self, size):
+        self._size = max(1, int(size))
+
+    def map(self, func, items):
+        # func must raise instead of calling fail_json/exit_json, which
+        # would only terminate the worker thread.
+        items = list(items)
+        results = [None] * len(items)
+        jobs = queue.Queue()
+
+        for index, item in enumerate(items):
+            jobs.put((index, item))
+
+        def worker():
+            while True:
+                try:
+                    index, item = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results[index] = WorkerResult(item, value=func(item))
+                except Exception, e:
+                    results[index] = WorkerResult(item, error=e)
+
+        threads = [threading.Thread(target=worker)
+                    for _ in range(min(self._size, len(items)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import time
+
+from ansible.module_utils.sacloud.cache import DEFAULT_CACHE_DIR, FileStore
+
+
+def sacloud_rate_limiter(module):
+    """Return the request budget of the module's account, or None."""
+    rate = module.params.get('http_rate_limit')
+    if not rate or rate <= 0:
+        return None
+
+    # The API limits requests per account, so all zones share one bucket.
+    account = hashlib.sha1(module.params['access_token'].encode('utf-8')) \
+            .hexdigest()[:12]
+    cache_dir = module.params.get('cache_dir') or DEFAULT_CACHE_DIR
+    path = os.path.join(os.path.expanduser(cache_dir),
+                        '%s-ratelimit.json' % account)
+    return TokenBucket(path, rate, module.params.get('http_burst'))
+
+
+class TokenBucket(FileStore):
+    """Token bucket in a state file, shared by every process of an account.
+
+    Each request takes a token; tokens come back at rate per second up to
+    burst. Ansible forks run as separate processes on the controller, so
+    the bucket lives on disk under the file lock rather than in memory.
+    A process told to back off by the API blocks the bucket for everyone.
+    """
+
+    def __init__(self, path, rate, burst=None):
+        FileStore.__init__(self, path)
+        self._rate = float(rate)
+        self._burst = max(1.0, float(burst or rate))
+
+    def acquire(self):
+        """Take a token, sleeping until one is available. Returns the
+        seconds waited. A state file that cannot be used limits nothing."""
+        waited = 0.0
+        while True:
+            try:
+                delay = self.update(self._take)
+            except (IOError, OSError, ValueError):
+                return waited
+            if delay <= 0:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    def block(self, seconds):
+        """Hand out no tokens for the next seconds, then refill from empty
+        so the waiting processes do not all resume at once."""
+        def block(data):
+            until = max(data.get('blocked_until', 0), time.time() + seconds)
+            data.update(blocked_until=until, tokens=0.0, updated=until)
+        try:
+            self.update(block)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def _take(self, data):
+        now = time.time()
+        blocked = data.get('blocked_until', 0) - now
+        if blocked > 0:
+            return blocked
+
+        elapsed = max(0.0, now - data.get('updated', now))
+        tokens = min(self._burst,
+                     data.get('tokens', self._burst) + elapsed * self._rate)
+        data['updated'] = now
+        if tokens >= 1:
+            data['tokens'] = tokens - 1
+            return 0
+        data['tokens'] = tokens
+        return (1 - tokens) / self._rate
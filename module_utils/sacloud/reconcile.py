@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+from ansible.module_utils.sacloud.metrics import sacloud_metrics
+
+
+class ImmutableFieldError(ValueError):
+    pass
+
+
+def sorted_list(value):
+    return sorted(value or [])
+
+
+def create_diff(fields):
+    """Diff of creating a resource with fields, leaving out unset ones."""
+    return dict(before={},
+                after=dict((k, v) for k, v in fields.items() if v is not None))
+
+
+def destroy_diff(resource):
+    return dict(before=dict(id=resource.id, name=resource.name), after={})
+
+
+def change_diff(field, before, after):
+    return dict(before={field: before}, after={field: after})
+
+
+class Reconciler():
+    """Diff a fetched resource against the requested fields and write only
+    what differs.
+
+    Fields set to None are not managed. Attribute changes and in-place
+    edits are batched into a single save(); changes the API only takes
+    through their own call, such as plan changes, run after it. A
+    converged resource costs no write at all.
+    """
+
+    def __init__(self, resource):
+        self.resource = resource
+        self.before = {}
+        self.after = {}
+        self._attrs = []
+        self._edits = []
+        self._calls = []
+        self._immutable = []
+
+    def set(self, field, current, desired, attr=None, value=None, key=None):
+        if self._compare(field, current, desired, key):
+            if value is None:
+                value = desired
+            self._attrs.append((attr or field, value))
+
+    def edit(self, field, current, desired, func, key=None):
+        # func changes the resource in place before it is saved
+        if self._compare(field, current, desired, key):
+            self._edits.append(func)
+
+    def call(self, field, current, desired, func, key=None):
+        if self._compare(field, current, desired, key):
+            self._calls.append(func)
+
+    def immutable(self, field, current, desired, key=None):
+        if self._compare(field, current, desired, key):
+            self._immutable.append(field)
+
+    @property
+    def changed(self):
+        return bool(self.after)
+
+    @property
+    def diff(self):
+        return dict(before=self.before, after=self.after)
+
+    def check(self):
+        if self._immutable:
+            raise ImmutableFieldError('Cannot change %s of an existing resource'
+                                        % ', '.join(sorted(self._immutable)))
+
+    def apply(self):
+        """Write the differences and return the resource. Raises instead of
+        failing the module, so it can run in a worker thread."""
+        self.check()
+        with sacloud_metrics(self.resource).phase('update'):
+            for attr, value in self._attrs:
+                setattr(self.resource, attr, value)
+            for func in self._edits:
+                func()
+            if self._attrs or self._edits:
+                self.resource.save()
+            for func in self._calls:
+                func()
+        return self.resource
+
+    def _compare(self, field, current, desired, key):
+        if desired is None:
+            return False
+        key = key or (lambda x: x)
+        if key(current) == key(desired):
+            return False
+        self.before[field] = current
+        self.after[field] = desired
+        return True
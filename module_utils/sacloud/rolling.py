@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from ansible.module_utils.sacloud import sacloud_argument_spec
+from ansible.module_utils.sacloud.cache import cache_argument_spec
+from ansible.module_utils.sacloud.ipam import sacloud_ipam
+from ansible.module_utils.sacloud.lb import LoadBalancer
+from ansible.module_utils.sacloud.metrics import sacloud_metrics, with_metrics
+from ansible.module_utils.sacloud.pool import WorkerPool
+from ansible.module_utils.sacloud.snapshot import find_resources
+from ansible.module_utils.sacloud.waiter import Backoff, Waiter
+
+
+def rolling_restart_argument_spec():
+    argument_spec = sacloud_argument_spec()
+    argument_spec.update(cache_argument_spec())
+    argument_spec.update(dict(
+        tags=dict(required=True, type='list'),
+        lb_resource_id=dict(required=False, type='int'),
+        batch_size=dict(required=False, type='int'),
+        min_in_service=dict(required=False, type='int'),
+        force=dict(required=False, default=False, type='bool'),
+        health_timeout=dict(required=False, default=300, type='int'),
+    ))
+    return argument_spec
+
+
+class RestartError(Exception):
+    pass
+
+
+class RollingRestart():
+    """Restart the servers carrying every given tag in batches.
+
+    The real servers of a batch are disabled on the load balancer before
+    its servers are stopped, and enabled again once they are booted; the
+    next batch starts when their health checks pass. Batches are as large
+    as batch_size and min_in_service allow. Servers already stopped are
+    left stopped.
+    """
+
+    def __init__(self, module, saklient):
+        self._module = module
+        self._saklient = saklient
+        self._balancer = None
+        if module.params['lb_resource_id']:
+            self._balancer = LoadBalancer(module, saklient)
+        self._batches = []
+        self._ips = {}
+
+    def run(self):
+        _servers = self._get_servers()
+        stopped = [x for x in _servers if not x.is_up()]
+        running = [x for x in _servers if x.is_up()]
+        if self._balancer is not None:
+            self._resolve_ips(running)
+
+        health = self._get_health()
+        in_service = set([x.id for x in running
+                            if self._is_in_service(x, health)])
+        # servers out of service already cost no capacity, so they go first
+        queue = sorted(running, key=lambda x: (x.id in in_service, x.name))
+
+        while queue:
+            batch = self._next_batch(queue, in_service)
+            queue = queue[len(batch):]
+            for _server in batch:
+                in_service.discard(_server.id)
+
+            started = time.time()
+            if not self._module.check_mode:
+                try:
+                    self._restart(batch)
+                except RestartError, e:
+                    self._fail(msg='Failed to restart %s: %s'
+                                % (', '.join([x.name for x in batch]), e),
+                                batches=self._batches)
+            self._batches.append(dict(servers=[x.name for x in batch],
+                                        sacloud_server_resource_ids=[x.id for x in batch],
+                                        elapsed=round(time.time() - started, 1)))
+            in_service.update([x.id for x in batch])
+
+        self._success(changed=bool(self._batches), batches=self._batches,
+                        skipped=[x.name for x in stopped],
+                        sacloud_server_resource_ids=[x.id for x in _servers])
+
+    def _get_servers(self):
+        tags = self._module.params['tags']
+        try:
+            _servers = find_resources(self._saklient.server)
+        except Exception, e:
+            self._fail(msg='Failed to find servers: %s' % e)
+        # the sacloud modules store tags with a leading @
+        return [x for x in _servers
+                if set(tags) <= set([t.lstrip('@') for t in x.tags or []])]
+
+    def _get_lb(self):
+        try:
+            return self._saklient.appliance.get_by_id(
+                    str(self._module.params['lb_resource_id']))
+        except Exception, e:
+            raise RestartError('Failed to find load balancer: %s' % e)
+
+    def _get_health(self):
+        if self._balancer is None:
+            return {}
+        try:
+            return self._balancer.get_lbserver_health(self._get_lb())
+        except Exception, e:
+            self._fail(msg='Failed to read load balancer health: %s' % e)
+
+    def _resolve_ips(self, _servers):
+        # servers on a router switch usually get their address from the
+        # disk config only, which is what sacloud_disk leased for the disk
+        ipam = sacloud_ipam(self._module)
+        unresolved = []
+        for _server in _servers:
+            ips = [x.ip_address or x.user_ip_address for x in _server.ifaces or []
+                    if x.ip_address or x.user_ip_address]
+            if not ips:
+                try:
+                    for _disk in _server.find_disks():
+                        ips.extend(ipam.held('disk:%s' % (_disk.name or 'default')))
+                except Exception, e:
+                    self._fail(msg='Failed to find disks of %s: %s' % (_server.name, e))
+            if not ips:
+                unresolved.append(_server.name)
+            self._ips[_server.id] = ips
+        if unresolved:
+            # restarting them would not drain them from the load balancer
+            self._fail(msg='No ipv4 address found for %s to drain from the load balancer'
+                        % ', '.join(unresolved))
+
+    def _get_ips(self, _server):
+        return self._ips.get(_server.id, [])
+
+    def _is_in_service(self, _server, health):
+        if not _server.is_up():
+            return False
+        return all([health.get(ip, 'up') == 'up' for ip in self._get_ips(_server)])
+
+    def _next_batch(self, queue, in_service):
+        params = self._module.params
+        min_in_service = params['min_in_service'] or 0
+        size = params['batch_size']
+        if size is None:
+            size = len(queue) if params['min_in_service'] is not None else 1
+
+        batch = []
+        serving = len(in_service)
+        for _server in queue[:size]:
+            if _server.id in in_service:
+                if serving - 1 < min_in_service:
+                    break
+                serving -= 1
+            batch.append(_server)
+        if not batch:
+            self._fail(msg='Restarting %s would leave fewer than %d servers in service'
+                        % (queue[0].name, min_in_service),
+                        batches=self._batches)
+        return batch
+
+    def _restart(self, batch):
+        ips = sum([self._get_ips(x) for x in batch], [])
+        if self._balancer is not None and ips:
+            self._set_enabled(ips, False)
+
+        pool = WorkerPool(len(batch))
+        self._power(pool, batch, self._power_off, 'down')
+        self._power(pool, batch, self._power_on, 'up')
+
+        if self._balancer is not None and ips:
+            self._set_enabled(ips, True)
+            self._wait_for_health(ips)
+
+    def _power(self, pool, _servers, func, state):
+        for result in pool.map(func, _servers):
+            if result.failed:
+                raise RestartError('%s: %s' % (result.item.name, result.error))
+
+        waiter = Waiter(self._saklient)
+        for _server in _servers:
+            waiter.add('server', _server.id, state)
+        pending = waiter.wait()
+        if pending:
+            raise RestartError('Timeout waiting for servers to be %s: %s'
+                                % (state, ', '.join([x.resource_id for x in pending])))
+
+    def _power_off(self, _server):
+        with self._phase('power'):
+            if self._module.params['force']:
+                _server.stop()
+            else:
+                _server.shutdown()
+
+    def _power_on(self, _server):
+        with self._phase('power'):
+            _server.boot()
+
+    def _set_enabled(self, ips, enabled):
+        try:
+            self._balancer.set_lbservers_enabled(self._get_lb(), ips, enabled)
+        except RestartError:
+            raise
+        except Exception, e:
+            raise RestartError('Failed to %s real servers: %s'
+                                % ('enable' if enabled else 'disable', e))
+
+    def _wait_for_health(self, ips):
+        deadline = time.time() + self._module.params['health_timeout']
+        backoff = Backoff()
+        while True:
+            try:
+                health = self._balancer.get_lbserver_health(self._get_lb())
+            except RestartError:
+                raise
+            except Exception:
+                # a transient API error, asked again below
+                health = {}
+            failing = [ip for ip in ips if health.get(ip) != 'up']
+            if not failing:
+                return
+
+            delay = backoff.next(10)
+            if time.time() + delay > deadline:
+                raise RestartError('Timeout waiting for health checks of %s'
+                                    % ', '.join(failing))
+            time.sleep(delay)
+
+    def _phase(self, name):
+        return sacloud_metrics(self._saklient).phase(name)
+
+    def _fail(self, msg, **kwargs):
+        kwargs = with_metrics(self._module, self._saklient, kwargs)
+        self._module.fail_json(msg=msg, **kwargs)
+
+    def _success(self, changed=True, **kwargs):
+        kwargs = with_metrics(self._module, self._saklient, kwargs)
+        self._module.exit_json(changed=changed, **kwargs)
+
+
+def run_rolling_restart(module, saklient):
+    RollingRestart(module, saklient).run()
@@ -0,0 +1,467 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+from ansible.module_utils.sacloud import sacloud_argument_spec
+from ansible.module_utils.sacloud.client import clone_api
+from ansible.module_utils.sacloud.metrics import sacloud_metrics, with_metrics
+from ansible.module_utils.sacloud.cache import cache_argument_spec, sacloud_cache
+from ansible.module_utils.sacloud.catalog import PlanCatalog
+from ansible.module_utils.sacloud.icon import IconResolver
+from ansible.module_utils.sacloud.ipam import sacloud_ipam
+from ansible.module_utils.sacloud.waiter import wait_for
+from ansible.module_utils.sacloud.reconcile import ImmutableFieldError, Reconciler, change_diff, create_diff, destroy_diff
+from ansible.module_utils.sacloud.dryrun import dry_run_argument_spec, dry_run_snapshot_cache, sacloud_dry_run
+from ansible.module_utils.sacloud.snapshot import find_resources
+from ansible.module_utils.sacloud.state import sacloud_state, state_argument_spec
+from ansible.module_utils.sacloud.pool import WorkerPool
+
+
+def router_argument_spec():
+    argument_spec = sacloud_argument_spec()
+    argument_spec.update(cache_argument_spec())
+    argument_spec.update(state_argument_spec())
+    argument_spec.update(dry_run_argument_spec())
+    argument_spec.update(dict(
+        router_resource_id=dict(required=False, type='int'),
+        name=dict(required=False),
+        desc=dict(required=False),
+        tags=dict(required=False, type='list'),
+        icon=dict(required=False),
+        band_width_mbps=dict(required=False, type='int',
+                                   choices=[100, 500, 1000]),
+        network_mask_len=dict(required=False, type='int',
+                                    choices=[26, 27, 28]),
+        state=dict(required=False, default='present',
+                    choices=['present', 'absent', 'connected', 'disconnected']),
+        server_resource_id=dict(required=False, type='int'),
+        server_resource_ids=dict(required=False, type='list'),
+        iface_resource_id=dict(required=False, type='int'),
+        concurrency=dict(required=False, default=4, type='int'),
+        wait=dict(required=False, default=True, type='bool')
+    ))
+    return argument_spec
+
+
+ROUTER_MUTUALLY_EXCLUSIVE = [['server_resource_id', 'server_resource_ids']]
+
+
+class Router():
+
+    def __init__(self, module, saklient):
+        self._module = module
+        self._saklient = saklient
+        self._icon_resolver = IconResolver(saklient,
+                                        sacloud_cache(module, 'icons'))
+        self._plan_catalog = PlanCatalog(saklient,
+                                        sacloud_cache(module, 'plans'))
+        self._ipam = sacloud_ipam(module)
+        self._state = sacloud_state(module, 'sacloud_router')
+        self._dry_run_cache = dry_run_snapshot_cache(module)
+
+    def _get_desc(self, desc):
+        if desc:
+            return self._str2triple_quoted_str(desc)
+        else:
+            return desc
+
+    def _str2triple_quoted_str(self, desc):
+        return '''%s''' % desc
+
+    # FIXME: don't work
+    def _get_tags(self, tags):
+        if tags:
+            return self._parse_tags(tags)
+        else:
+            return tags
+
+    def _parse_tags(self, tags):
+        return [''.join(['@', x]) for x in tags]
+
+    def _get_icon(self, icon):
+        if icon:
+            return self._get_icon_with_name_like(icon)
+        else:
+            return icon
+
+    def _get_icon_with_name_like(self, icon):
+        try:
+            return self._icon_resolver.resolve(icon)
+        except Exception, e:
+            self._fail(msg='Failed to find router icon: %s' % e)
+
+    def _get_router_by_id(self, router_resource_id):
+        try:
+            return self._saklient.router.get_by_id(str(router_resource_id))
+        except Exception:
+            self._fail(msg='Failed to find router: %s' % router_resource_id)
+
+    def destroy(self):
+        _router = self._get_router_by_id(self._module.params['router_resource_id'])
+
+        if self._module.check_mode:
+            self._success(diff=destroy_diff(_router))
+        try:
+            with self._phase('destroy'):
+                _router.destroy()
+            self._ipam.forget(_router.id)
+            self._state.forget(_router.id)
+        except Exception, e:
+            self._fail(msg='Failed to destroy router: %s' % e)
+        self._success(result='Successfully destroy router: %d'
+                        % int(_router.id))
+
+    def create(self):
+        _router = self._saklient.router.create()
+        self._set_params(_router)
+
+        if self._module.check_mode:
+            params = self._module.params
+            self._success(diff=create_diff(dict(name=_router.name,
+                                                desc=params['desc'], tags=params['tags'],
+                                                icon=params['icon'],
+                                                band_width_mbps=_router.band_width_mbps,
+                                                network_mask_len=_router.network_mask_len)))
+
+        try:
+            with self._phase('save'):
+                _router.save()
+            if self._module.params['wait']:
+                _router = self._wait_for(_router)
+        except Exception, e:
+            self._fail(msg='Failed to create router: %s' % e)
+
+        if not self._module.params['wait']:
+            self._success(result='Successfully create router: %s'
+                                % _router.id,
+                                ansible_facts=dict(sacloud_router_resource_id=_router.id))
+        self._success(result='Successfully create router: %s'
+                            % _router.id,
+                            ansible_facts=self._get_facts(_router))
+
+    def _wait_for(self, _router, state=None):
+        target = wait_for(self._saklient, 'router', _router.id, state)
+        if target.failed:
+            self._fail(msg='Failed to wait for router: %d' % int(_router.id))
+        elif not target.converged:
+            self._fail(msg='Timeout waiting for router to be %s: %d'
+                        % (target.state, int(_router.id)))
+        return target.resource
+
+    def _get_facts(self, _router):
+        # the unused addresses as the API sees them now, less the leased
+        try:
+            _subnet = self._ipam.subnet(self._saklient, _router.id,
+                                        refresh=True)
+        except Exception, e:
+            self._fail(msg='Failed to collect unused ipv4 address: %s' % e)
+
+        return dict(
+                sacloud_router_resource_id=_router.id,
+                sacloud_default_route=_subnet['default_route'],
+                sacloud_ipv4_addresses=_subnet['addresses']
+                )
+
+    # TODO: implement iface.destroy
+    def disconnect(self, server_resource_id, iface_resource_id):
+        _iface = self._get_iface_by_id(server_resource_id, iface_resource_id)
+
+        if self._module.check_mode:
+            self._success(changed=_iface.swytch_id is not None,
+                            diff=change_diff('switch', _iface.swytch_id, None))
+
+        try:
+            with self._phase('disconnect'):
+                _iface.disconnect_from_swytch()
+        except Exception, e:
+            self._fail(msg='Failed to disconnect from sywitch: %s' % e)
+        self._success(result='Successfully disconnect from sywitch')
+
+    def _get_iface_by_id(self, server_resource_id, iface_resource_id):
+        for iface in self._get_ifaces_by_id(server_resource_id):
+            if iface.id == str(iface_resource_id):
+                return iface
+        self._fail(msg='Failed to find iface: %d' % iface_resource_id)
+
+    def _get_ifaces_by_id(self, server_resource_id):
+        _server = self._get_server_by_id(server_resource_id)
+
+        try:
+            return _server.get_ifaces()
+        except Exception:
+            # FIXME: UnicodeEncodeError
+            self._fail(msg='Failed to find server ifaces: %d' % server_resource_id)
+
+    def _get_server_by_id(self, server_resource_id):
+        try:
+            return self._saklient.server.get_by_id(str(server_resource_id))
+        except Exception:
+            # FIXME: UnicodeEncodeError
+            #self._fail('Failed to find server: %s' % e)
+            self._fail(msg='Failed to find server: %d' % server_resource_id)
+
+    # TODO: implement shared segment
+    def connect(self, router_resource_id, server_resource_id):
+        _router = self._get_router_by_id(router_resource_id)
+
+        if self._module.check_mode:
+            # adding the iface would already change the server
+            swytch_id = self._get_swytch_id(router_resource_id)
+            _server = self._get_server_by_id(server_resource_id)
+            connected = self._get_ifaces_on_swytch(_server, swytch_id)
+            self._success(changed=not connected,
+                            diff=change_diff('switch', swytch_id if connected else None,
+                                                swytch_id))
+
+        _iface = self._add_iface_by_id(server_resource_id)
+
+        try:
+            with self._phase('connect'):
+                _iface.connect_to_swytch(_router.get_swytch())
+        except Exception, e:
+            self._fail(msg='Failed to connect to sywitch: %s' % e)
+        self._success(result='Successfully connect to router %d' % int(_iface.id),
+                        ansible_facts=dict(sacloud_iface_resource_id=_iface.id))
+
+    def _add_iface_by_id(self, server_resource_id):
+        _server = self._get_server_by_id(server_resource_id)
+
+        try:
+            return _server.add_iface()
+        except Exception, e:
+            # FIXME: UnicodeEncodeError
+            #self._fail(msg='Failed to find server iface: %s' % e)
+            self._fail(msg='Failed to add server iface: %d' % server_resource_id)
+
+    def connect_many(self, router_resource_id, server_resource_ids):
+        # The switch is resolved once, the servers are handled in parallel
+        swytch_id = self._get_swytch_id(router_resource_id)
+        self._apply_many('connect', server_resource_ids,
+                         lambda x: self._connect_server(swytch_id, x))
+
+    def disconnect_many(self, router_resource_id, server_resource_ids):
+        swytch_id = self._get_swytch_id(router_resource_id)
+        self._apply_many('disconnect', server_resource_ids,
+                         lambda x: self._disconnect_server(swytch_id, x))
+
+    def _get_swytch_id(self, router_resource_id):
+        _router = self._get_router_by_id(router_resource_id)
+        try:
+            return _router.get_swytch().id
+        except Exception, e:
+            self._fail(msg='Failed to find router switch: %s' % e)
+
+    def _apply_many(self, action, server_resource_ids, func):
+        pool = WorkerPool(self._module.params['concurrency'])
+        with self._phase(action):
+            results = pool.map(func, server_resource_ids)
+
+        servers = []
+        for result in results:
+            server = dict(server_resource_id=str(result.item))
+            if result.failed:
+                server.update(failed=True, changed=False,
+                                msg='Failed to %s server: %s' % (action, result.error))
+            else:
+                server.update(failed=False, **result.value)
+            servers.append(server)
+
+        iface_resource_ids = dict((x['server_resource_id'], x['iface_resource_id'])
+                                    for x in servers if not x['failed'])
+        changed = any([x['changed'] for x in servers])
+        failures = len(servers) - len(iface_resource_ids)
+        if failures:
+            self._fail(msg='Failed to %s %d of %d servers'
+                        % (action, failures, len(servers)),
+                        changed=changed, servers=servers,
+                        sacloud_iface_resource_ids=iface_resource_ids)
+        self._success(changed=changed, servers=servers,
+                        ansible_facts=dict(sacloud_iface_resource_ids=iface_resource_ids))
+
+    def _get_ifaces_on_swytch(self, _server, swytch_id):
+        # The server record already carries its ifaces, indexed here by ID
+        ifaces = dict((x.id, x) for x in _server.get_ifaces())
+        return [ifaces[x] for x in sorted(ifaces)
+                if ifaces[x].swytch_id == swytch_id]
+
+    def _connect_server(self, swytch_id, server_resource_id):
+        # runs in a worker thread: raise instead of calling _fail
+        saklient = clone_api(self._saklient)
+        _server = saklient.server.get_by_id(str(server_resource_id))
+        connected = self._get_ifaces_on_swytch(_server, swytch_id)
+        if connected:
+            return dict(iface_resource_id=connected[0].id, changed=False)
+        if self._module.check_mode:
+            return dict(iface_resource_id=None, changed=True)
+
+        _iface = _server.add_iface()
+        _iface.connect_to_swytch_by_id(swytch_id)
+        return dict(iface_resource_id=_iface.id, changed=True)
+
+    def _disconnect_server(self, swytch_id, server_resource_id):
+        # runs in a worker thread: raise instead of calling _fail
+        saklient = clone_api(self._saklient)
+        _server = saklient.server.get_by_id(str(server_resource_id))
+        connected = self._get_ifaces_on_swytch(_server, swytch_id)
+        if not connected:
+            return dict(iface_resource_id=None, changed=False)
+
+        if not self._module.check_mode:
+            for _iface in connected:
+                _iface.disconnect_from_swytch()
+        return dict(iface_resource_id=connected[0].id, changed=True)
+
+    def present(self):
+        cached = self._state.replay(self._saklient)
+        if cached is not None:
+            self._success(changed=False, **cached)
+
+        if self._module.params['router_resource_id']:
+            _router = self._get_router_by_id(self._module.params['router_resource_id'])
+        else:
+            _router = self._find_router(self._module.params['name'] or 'default')
+
+        if _router is None:
+            self.create()
+        self.update(_router)
+
+    def _find_router(self, name):
+        try:
+            _routers = find_resources(self._saklient.router, name)
+        except Exception, e:
+            self._fail(msg='Failed to find router: %s' % e)
+
+        if len(_routers) > 1:
+            self._fail(msg='Multiple routers named %s: %s'
+                        % (name, ', '.join([x.id for x in _routers])))
+        elif _routers:
+            return _routers[0]
+        return None
+
+    def update(self, _router):
+        reconciler = self._get_reconciler(_router)
+        try:
+            reconciler.check()
+        except ImmutableFieldError, e:
+            self._fail(msg='Failed to update router: %s' % e)
+
+        if reconciler.changed and not self._module.check_mode:
+            try:
+                _router = reconciler.apply()
+            except Exception, e:
+                self._fail(msg='Failed to update router: %s' % e)
+
+        if not self._module.params['wait'] or self._module.check_mode:
+            self._success(changed=reconciler.changed, diff=reconciler.diff,
+                            ansible_facts=dict(sacloud_router_resource_id=_router.id))
+        self._success(changed=reconciler.changed, diff=reconciler.diff,
+                        ansible_facts=self._get_facts(_router))
+
+    def _get_reconciler(self, _router):
+        # routers have no tags or icon of their own
+        reconciler = Reconciler(_router)
+        reconciler.set('name', _router.name, self._module.params['name'])
+        reconciler.set('desc', _router.description,
+                        self._get_desc(self._module.params['desc']),
+                        attr='description')
+
+        band_width_mbps = self._module.params['band_width_mbps']
+        if band_width_mbps and band_width_mbps != _router.band_width_mbps:
+            self._get_plan(band_width_mbps)
+            reconciler.call('band_width_mbps', _router.band_width_mbps,
+                            band_width_mbps,
+                            lambda: _router.change_plan(band_width_mbps))
+        reconciler.immutable('network_mask_len', _router.network_mask_len,
+                                self._module.params['network_mask_len'])
+        return reconciler
+
+    def _set_params(self, _router):
+        _router.name = self._module.params['name'] or 'default'
+
+        if self._module.params['desc']:
+            _router.description = self._get_desc(self._module.params['desc'])
+        if self._module.params['tags']:
+            _router.tags = self._get_tags(self._module.params['tags'])
+        if self._module.params['icon']:
+            _router.icon = self._get_icon(self._module.params['icon'])
+
+        band_width_mbps = self._module.params['band_width_mbps'] or 100
+        self._get_plan(band_width_mbps)
+        _router.network_mask_len = self._module.params['network_mask_len'] or 28
+        _router.band_width_mbps = band_width_mbps
+
+    def _get_plan(self, band_width_mbps):
+        try:
+            return self._plan_catalog.get_router_plan(band_width_mbps)
+        except Exception, e:
+            self._fail(msg='Failed to find router plan: %s' % e)
+
+    def _phase(self, name):
+        return sacloud_metrics(self._saklient).phase(name)
+
+    def _fail(self, msg, **kwargs):
+        kwargs = with_metrics(self._module, self._saklient, kwargs)
+        self._module.fail_json(msg=msg, **kwargs)
+
+    def _success(self, changed=True, **kwargs):
+        self._state.record(kwargs)
+        if changed and not self._module.check_mode:
+            # plans made from now on see the change
+            self._dry_run_cache.invalidate()
+        kwargs = with_metrics(self._module, self._saklient, kwargs)
+        self._module.exit_json(changed=changed, **kwargs)
+
+
+def run_router(module, saklient):
+    saklient = sacloud_dry_run(module, saklient)
+    router = Router(module, saklient)
+
+    # TODO: more convinient way to handle args
+    if module.params['state'] in ['connected', 'disconnected'] \
+            and module.params['server_resource_ids']:
+        if not module.params['router_resource_id']:
+            module.fail_json(msg='missing required arguments: router_resource_id')
+        elif module.params['state'] == 'connected':
+            router.connect_many(module.params['router_resource_id'],
+                                module.params['server_resource_ids'])
+        else:
+            router.disconnect_many(module.params['router_resource_id'],
+                                    module.params['server_resource_ids'])
+    elif module.params['state'] == 'connected':
+        if not module.params['router_resource_id']:
+            module.fail_json(msg='missing required arguments: router_resource_id')
+        elif not module.params['server_resource_id']:
+            module.fail_json(msg='missing required arguments: server_resource_id')
+        else:
+            router.connect(module.params['router_resource_id'],
+                            module.params['server_resource_id'])
+    elif module.params['state'] == 'disconnected':
+        if not module.params['server_resource_id']:
+            module.fail_json(msg='missing required arguments: server_resource_id')
+        elif not module.params['iface_resource_id']:
+            module.fail_json(msg='missing required arguments: iface_resource_id')
+        else:
+            router.disconnect(module.params['server_resource_id'],
+                                module.params['iface_resource_id'])
+    elif module.params['state'] == 'absent':
+        if module.params['router_resource_id']:
+            router.destroy()
+        else:
+            module.fail_json(msg='missing required arguments: router_resource_id')
+    elif module.params['state'] == 'present':
+        router.present()
@@ -0,0 +1,558 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+from ansible.module_utils.sacloud import sacloud_argument_spec
+from ansible.module_utils.sacloud.metrics import sacloud_metrics, with_metrics
+from ansible.module_utils.sacloud.cache import cache_argument_spec, sacloud_cache
+from ansible.module_utils.sacloud.catalog import PlanCatalog
+from ansible.module_utils.sacloud.icon import IconResolver
+from ansible.module_utils.sacloud.ipam import sacloud_ipam
+from ansible.module_utils.sacloud.waiter import Waiter, wait_for
+from ansible.module_utils.sacloud.pool import WorkerPool
+from ansible.module_utils.sacloud.reconcile import Reconciler, change_diff, create_diff, destroy_diff, sorted_list
+from ansible.module_utils.sacloud.dryrun import dry_run_argument_spec, dry_run_snapshot_cache, sacloud_dry_run
+from ansible.module_utils.sacloud.snapshot import find_resources
+from ansible.module_utils.sacloud.state import sacloud_state, sacloud_state_file, state_argument_spec
+
+
+def server_argument_spec():
+    argument_spec = sacloud_argument_spec()
+    argument_spec.update(cache_argument_spec())
+    argument_spec.update(state_argument_spec())
+    argument_spec.update(dry_run_argument_spec())
+    argument_spec.update(dict(
+        server_resource_id=dict(required=False, type='int'),
+        server_resource_ids=dict(required=False, type='list'),
+        with_disks=dict(required=False, default=False, type='bool'),
+        cpu=dict(required=False, type='int'),
+        mem=dict(required=False, type='int'),
+        name=dict(required=False),
+        desc=dict(required=False),
+        tags=dict(required=False, type='list'),
+        icon=dict(required=False),
+        force=dict(required=False, default=False, type='bool'),
+        instances=dict(required=False, type='list'),
+        count=dict(required=False, type='int'),
+        start_index=dict(required=False, default=1, type='int'),
+        concurrency=dict(required=False, default=4, type='int'),
+        wait=dict(required=False, default=True, type='bool'),
+        state=dict(required=False, default='present',
+                    choices=['present', 'absent', 'stopped', 'running'])
+    ))
+    return argument_spec
+
+
+SERVER_MUTUALLY_EXCLUSIVE = [['instances', 'count'],
+                                ['server_resource_id', 'server_resource_ids']]
+
+
+class Server():
+
+    def __init__(self, module, saklient):
+        self._module = module
+        self._saklient = saklient
+        self._icon_resolver = IconResolver(saklient,
+                                        sacloud_cache(module, 'icons'))
+        self._plan_catalog = PlanCatalog(saklient,
+                                        sacloud_cache(module, 'plans'))
+        self._state = sacloud_state(module, 'sacloud_server')
+        self._ipam = sacloud_ipam(module)
+        self._dry_run_cache = dry_run_snapshot_cache(module)
+
+    def _get_plan_by_spec(self, cpu, mem):
+        try:
+            return self._plan_catalog.get_server_plan(cpu, mem)
+        except Exception, e:
+            self._fail(msg='Failed to find plan: %s' % e)
+
+    def _get_tags(self, tags):
+        if tags:
+            return self._parse_tags(tags)
+        else:
+            return tags
+
+    def _parse_tags(self, tags):
+        return [''.join(['@', x]) for x in tags]
+
+    def _get_desc(self, desc):
+        if desc:
+            return self._str2triple_quoted_str(desc)
+        else:
+            return desc
+
+    def _str2triple_quoted_str(self, desc):
+        return '''%s''' % desc
+
+    def _get_icon(self, icon):
+        if icon:
+            return self._get_icon_with_name_like(icon)
+        else:
+            return icon
+
+    def _get_icon_with_name_like(self, icon):
+        try:
+            return self._icon_resolver.resolve(icon)
+        except Exception, e:
+            self._fail(msg='Failed to find server icon: %s' % e)
+
+    def _get_server(self, server_resource_id):
+        try:
+            return self._saklient.server.get_by_id(str(server_resource_id))
+        except Exception:
+            self._fail(msg='Failed to find server: %d' % server_resource_id)
+
+    def _wait_for(self, _server, state=None):
+        target = wait_for(self._saklient, 'server', _server.id, state)
+        if target.failed:
+            self._fail(msg='Failed to wait for server: %d' % int(_server.id))
+        elif not target.converged:
+            self._fail(msg='Timeout waiting for server to be %s: %d'
+                        % (target.state, int(_server.id)))
+        return target.resource
+
+    def _get_servers(self, server_resource_ids):
+        # One filtered listing instead of a lookup per server
+        model = self._saklient.server
+        model.reset()
+        for server_resource_id in server_resource_ids:
+            model.filter_by('ID', str(server_resource_id), True)
+        try:
+            with self._phase('find'):
+                found = dict((str(x.id), x)
+                                for x in model.limit(len(server_resource_ids)).find())
+        except Exception, e:
+            self._fail(msg='Failed to find servers: %s' % e)
+
+        _servers = []
+        for server_resource_id in server_resource_ids:
+            if str(server_resource_id) not in found:
+                self._fail(msg='Failed to find server: %d' % int(server_resource_id))
+            _servers.append(found[str(server_resource_id)])
+        return _servers
+
+    def _get_disks_by_server(self, _servers):
+        if not self._module.params['with_disks']:
+            return {}
+        try:
+            _disks = find_resources(self._saklient.disk)
+        except Exception, e:
+            self._fail(msg='Failed to find disks: %s' % e)
+
+        server_ids = [_server.id for _server in _servers]
+        disks = {}
+        for _disk in _disks:
+            if _disk.server is not None and _disk.server.id in server_ids:
+                disks.setdefault(_disk.server.id, []).append(_disk)
+        return disks
+
+    def destroy(self):
+        params = self._module.params
+        _servers = self._get_servers(params['server_resource_ids']
+                                        or [params['server_resource_id']])
+        disks = self._get_disks_by_server(_servers)
+        instances = [dict(name=_server.name,
+                            sacloud_server_resource_id=_server.id,
+                            sacloud_disk_resource_ids=[x.id for x in
+                                                        disks.get(_server.id, [])])
+                        for _server in _servers]
+
+        if self._module.check_mode:
+            for _server, instance in zip(_servers, instances):
+                instance.update(changed=True, diff=destroy_diff(_server))
+            if params['server_resource_ids']:
+                self._success(instances=instances)
+            self._success(diff=instances[0]['diff'])
+
+        # Every server is stopped and waited for at once, then the servers
+        # are deleted together with their disks.
+        pool = WorkerPool(params['concurrency'])
+        jobs = self._stop_for_destroy(pool, _servers, instances)
+        results = pool.map(self._destroy_server,
+                            [(_server, disks.get(_server.id, []))
+                                for _server, instance in jobs])
+        for result, (_server, instance) in zip(results, jobs):
+            if result.failed:
+                instance.update(failed=True,
+                                msg='Failed to destroy server: %s' % result.error)
+            else:
+                instance.update(failed=False)
+                self._forget(_server, disks.get(_server.id, []))
+
+        failed = [x for x in instances if x['failed']]
+        server_ids = [x['sacloud_server_resource_id']
+                        for x in instances if not x['failed']]
+        disk_ids = sum([x['sacloud_disk_resource_ids']
+                        for x in instances if not x['failed']], [])
+        if failed:
+            self._fail(msg='Failed to destroy %d of %d servers: %s'
+                        % (len(failed), len(instances), failed[0]['msg']),
+                        changed=bool(server_ids),
+                        instances=instances,
+                        sacloud_server_resource_ids=server_ids,
+                        sacloud_disk_resource_ids=disk_ids)
+        if params['server_resource_ids']:
+            msg = 'Successfully destroy %d servers' % len(server_ids)
+        else:
+            msg = 'Successfully destroy server: %d' % int(server_ids[0])
+        self._success(msg=msg, instances=instances,
+                        sacloud_server_resource_ids=server_ids,
+                        sacloud_disk_resource_ids=disk_ids)
+
+    def _stop_for_destroy(self, pool, _servers, instances):
+        """Stop the running servers at once and return the servers that are
+        down with their instances."""
+        running = [_server for _server in _servers if _server.is_up()]
+        stopped = dict((_server.id, result) for _server, result in
+                        zip(running, pool.map(self._power_off, running)))
+
+        waiter = Waiter(self._saklient)
+        for _server in running:
+            if not stopped[_server.id].failed:
+                waiter.add('server', _server.id, 'down')
+        pending = [x.resource_id for x in waiter.wait()]
+
+        jobs = []
+        for _server, instance in zip(_servers, instances):
+            result = stopped.get(_server.id)
+            if result is not None and result.failed:
+                instance.update(failed=True,
+                                msg='Failed to stop server: %s' % result.error)
+            elif _server.id in pending:
+                instance.update(failed=True,
+                                msg='Timeout waiting for server to be down: %d'
+                                % int(_server.id))
+            else:
+                jobs.append((_server, instance))
+        return jobs
+
+    def _power_off(self, _server):
+        with self._phase('power'):
+            if self._module.params['force']:
+                _server.stop()
+            else:
+                _server.shutdown()
+
+    def _destroy_server(self, job):
+        _server, _disks = job
+        with self._phase('destroy'):
+            if _disks:
+                # the API deletes the disks listed in WithDisk along
+                self._saklient.client.request('DELETE', '/server/%s' % _server.id,
+                                                dict(WithDisk=[x.id for x in _disks]))
+            else:
+                _server.destroy()
+
+    def _forget(self, _server, _disks):
+        self._state.forget(_server.id)
+        state_file = sacloud_state_file(self._module)
+        for _disk in _disks:
+            state_file.forget('disks', _disk.id)
+            # the addresses sacloud_disk leased for the disk
+            self._ipam.release('disk:%s' % (_disk.name or 'default'))
+
+    def stop(self):
+        _server = self._get_server(self._module.params['server_resource_id'])
+
+        if _server.is_down():
+            self._success(changed=False,
+                            msg='The server already stopped: %d'
+                            % int(_server.id))
+        if self._module.check_mode:
+            self._success(diff=change_diff('status', 'up', 'down'))
+
+        try:
+            with self._phase('power'):
+                if self._module.params['force']:
+                    _server.stop()
+                else:
+                    _server.shutdown()
+            if self._module.params['wait']:
+                self._wait_for(_server, 'down')
+        except Exception, e:
+            self._fail(msg='Failed to stop server: %s' % e)
+
+        self._success(msg='Successfully stop server: %d'
+                        % int(_server.id))
+
+    def boot(self):
+        _server = self._get_server(self._module.params['server_resource_id'])
+
+        if _server.is_up():
+            self._success(changed=False,
+                            msg='The server already booted: %d'
+                            % int(_server.id))
+        if self._module.check_mode:
+            self._success(diff=change_diff('status', 'down', 'up'))
+
+        try:
+            with self._phase('power'):
+                _server.boot()
+            if self._module.params['wait']:
+                self._wait_for(_server, 'up')
+        except Exception, e:
+            self._fail(msg='Failed to boot server: %s' % e)
+
+        self._success(msg='Successfully boot server: %d'
+                        % int(_server.id))
+
+    def present(self):
+        cached = self._state.replay(self._saklient)
+        if cached is not None:
+            self._success(changed=False, **cached)
+
+        if self._module.params['server_resource_id']:
+            _server = self._get_server(self._module.params['server_resource_id'])
+        else:
+            _server = self._find_server(self._module.params['name'] or 'default')
+
+        if _server is None:
+            self.create()
+        self.update(_server)
+
+    def _find_server(self, name):
+        _servers = self._get_servers_by_name([name])
+        return _servers.get(name)
+
+    def _get_servers_by_name(self, names):
+        # One paged listing instead of a lookup per name
+        try:
+            _servers = find_resources(self._saklient.server)
+        except Exception, e:
+            self._fail(msg='Failed to find servers: %s' % e)
+
+        found = {}
+        for _server in _servers:
+            if _server.name not in names:
+                continue
+            if _server.name in found:
+                self._fail(msg='Multiple servers named %s: %s, %s'
+                            % (_server.name, found[_server.name].id, _server.id))
+            found[_server.name] = _server
+        return found
+
+    def update(self, _server):
+        reconciler = self._get_reconciler(_server, self._module.params)
+
+        if not reconciler.changed or self._module.check_mode:
+            self._success(changed=reconciler.changed, diff=reconciler.diff,
+                            ansible_facts=dict(sacloud_server_resource_id=_server.id))
+
+        try:
+            _server = reconciler.apply()
+        except Exception, e:
+            self._fail(msg='Failed to update server: %s' % e)
+        self._success(result='Successfully update server: %d' % int(_server.id),
+                        diff=reconciler.diff,
+                        ansible_facts=dict(sacloud_server_resource_id=_server.id))
+
+    def _get_reconciler(self, _server, params):
+        reconciler = Reconciler(_server)
+        reconciler.set('name', _server.name, params['name'])
+        reconciler.set('desc', _server.description,
+                        self._get_desc(params['desc']), attr='description')
+        reconciler.set('tags', _server.tags, self._get_tags(params['tags']),
+                        key=sorted_list)
+        if params['icon']:
+            _icon = self._get_icon(params['icon'])
+            reconciler.set('icon', _server.icon.id if _server.icon else None,
+                            _icon.id, value=_icon)
+
+        current = dict(cpu=_server.plan.cpu, mem=_server.plan.memory_gib)
+        desired = dict(cpu=params['cpu'] or current['cpu'],
+                        mem=params['mem'] or current['mem'])
+        if desired != current:
+            _plan = self._get_plan_by_spec(desired['cpu'], desired['mem'])
+            reconciler.call('plan', current, desired,
+                            lambda: _server.change_plan(_plan))
+        return reconciler
+
+    def create(self):
+        _server = self._saklient.server.create()
+        self._set_params(_server, self._module.params)
+
+        if self._module.check_mode:
+            self._success(diff=self._get_create_diff(self._module.params))
+
+        try:
+            with self._phase('save'):
+                _server.save()
+        except Exception, e:
+            self._fail(msg='Failed to create server: %s' % e)
+        self._success(result='Successfully add server: %d' % int(_server.id),
+                        ansible_facts=dict(sacloud_server_resource_id=_server.id))
+
+    def create_fleet(self):
+        specs = self._get_instance_specs()
+        existing = self._get_servers_by_name([spec['name'] for spec in specs])
+        # Plans and icons are resolved and existing servers diffed here so
+        # the workers only have to save.
+        jobs = []
+        for spec in specs:
+            _server = existing.get(spec['name'])
+            if _server is None:
+                _server = self._saklient.server.create()
+                self._set_params(_server, spec)
+                jobs.append((spec['name'], _server, None))
+            else:
+                jobs.append((spec['name'], _server,
+                            self._get_reconciler(_server, spec)))
+
+        if self._module.check_mode:
+            instances = [self._get_instance(name, reconciler)
+                            for name, _server, reconciler in jobs]
+            self._success(changed=any([x['changed'] for x in instances]),
+                            instances=instances)
+
+        pool = WorkerPool(self._module.params['concurrency'])
+        instances = []
+        for result in pool.map(self._save_server, jobs):
+            name, _server, reconciler = result.item
+            instance = self._get_instance(name, reconciler)
+            if result.failed:
+                instance.update(failed=True,
+                                msg='Failed to save server: %s' % result.error)
+            else:
+                instance.update(failed=False,
+                                sacloud_server_resource_id=result.value)
+            instances.append(instance)
+
+        resource_ids = [x['sacloud_server_resource_id']
+                        for x in instances if not x['failed']]
+        failures = len(instances) - len(resource_ids)
+        if failures:
+            self._fail(msg='Failed to save %d of %d servers'
+                        % (failures, len(instances)),
+                        instances=instances,
+                        sacloud_server_resource_ids=resource_ids)
+        self._success(changed=any([x['changed'] for x in instances]),
+                        result='Successfully save %d servers' % len(resource_ids),
+                        instances=instances,
+                        sacloud_server_resource_ids=resource_ids,
+                        ansible_facts=dict(sacloud_server_resource_ids=resource_ids))
+
+    def _get_instance(self, name, reconciler):
+        if reconciler is None:
+            return dict(name=name, changed=True)
+        return dict(name=name, changed=reconciler.changed, diff=reconciler.diff)
+
+    def _save_server(self, job):
+        name, _server, reconciler = job
+        if reconciler is None:
+            with self._phase('save'):
+                _server.save()
+        elif reconciler.changed:
+            _server = reconciler.apply()
+        return _server.id
+
+    def _get_instance_specs(self):
+        defaults = dict((key, self._module.params[key])
+                        for key in ['name', 'cpu', 'mem', 'desc', 'tags', 'icon'])
+        defaults['name'] = defaults['name'] or 'default'
+
+        specs = []
+        if self._module.params['instances']:
+            names = set()
+            for instance in self._module.params['instances']:
+                if not isinstance(instance, dict):
+                    self._fail(msg='instances require dicts: %s' % instance)
+                unknown = sorted(set(instance) - set(defaults))
+                if unknown:
+                    self._fail(msg='instances do not support %s: %s'
+                                % (', '.join(unknown), instance))
+                spec = dict(defaults)
+                spec.update(instance)
+                if spec['name'] in names:
+                    self._fail(msg='instances repeat name: %s' % spec['name'])
+                names.add(spec['name'])
+                for key in ['cpu', 'mem']:
+                    if spec[key] is not None:
+                        try:
+                            spec[key] = int(spec[key])
+                        except (TypeError, ValueError):
+                            self._fail(msg='instances require integer %s: %s'
+                                        % (key, instance))
+                specs.append(spec)
+        else:
+            start = self._module.params['start_index']
+            for index in range(start, start + self._module.params['count']):
+                spec = dict(defaults)
+                spec['name'] = self._format_name(defaults['name'], index)
+                specs.append(spec)
+        return specs
+
+    def _format_name(self, name, index):
+        if '{index}' in name:
+            return name.replace('{index}', str(index))
+        else:
+            return '%s%d' % (name, index)
+
+    def _get_create_diff(self, params):
+        return create_diff(dict(name=params['name'] or 'default',
+                                desc=params['desc'], tags=params['tags'],
+                                icon=params['icon'], cpu=params['cpu'] or 1,
+                                mem=params['mem'] or 1))
+
+    def _set_params(self, _server, params):
+        _server.name = params['name'] or 'default'
+        _server.plan = self._get_plan_by_spec(params['cpu'] or 1,
+                                                params['mem'] or 1)
+
+        if params['desc']:
+            _server.description = self._get_desc(params['desc'])
+        if params['tags']:
+            _server.tags = self._get_tags(params['tags'])
+        if params['icon']:
+            _server.icon = self._get_icon(params['icon'])
+
+    def _phase(self, name):
+        return sacloud_metrics(self._saklient).phase(name)
+
+    def _fail(self, msg, **kwargs):
+        kwargs = with_metrics(self._module, self._saklient, kwargs)
+        self._module.fail_json(msg=msg, **kwargs)
+
+    def _success(self, changed=True, **kwargs):
+        self._state.record(kwargs)
+        if changed and not self._module.check_mode:
+            # plans made from now on see the change
+            self._dry_run_cache.invalidate()
+        kwargs = with_metrics(self._module, self._saklient, kwargs)
+        self._module.exit_json(changed=changed, **kwargs)
+
+
+def run_server(module, saklient):
+    saklient = sacloud_dry_run(module, saklient)
+    server = Server(module, saklient)
+
+    many = module.params['state'] == 'absent' and module.params['server_resource_ids']
+    if module.params['state'] in ['absent', 'stopped', 'running'] \
+            and not module.params['server_resource_id'] and not many:
+        module.fail_json(msg='missing required arguments: server_resource_id')
+
+    if module.params['state'] == 'absent':
+        server.destroy()
+    elif module.params['state'] == 'stopped':
+        server.stop()
+    elif module.params['state'] == 'running':
+        server.boot()
+    else:
+        if module.params['instances'] or module.params['count']:
+            server.create_fleet()
+        else:
+            server.present()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+from ansible.module_utils.sacloud.metrics import sacloud_metrics
+from ansible.module_utils.sacloud.pool import WorkerPool
+
+# fact names and the API collections they are listed from: saklient
+# model, API path and root key of the list response
+RESOURCE_MODELS = {
+    'servers': ('server', '/server', 'Servers'),
+    'disks': ('disk', '/disk', 'Disks'),
+    'routers': ('router', '/internet', 'Internet'),
+    'switches': ('swytch', '/switch', 'Switches'),
+    'appliances': ('appliance', '/appliance', 'Appliances'),
+    'archives': ('archive', '/archive', 'Archives'),
+}
+
+PAGE_SIZE = 100
+
+
+def find_all(client, path, root_key, page_size=PAGE_SIZE, query=None):
+    """List the raw records of a collection, page_size records per API call."""
+    records = []
+    with sacloud_metrics(client).phase('find'):
+        while True:
+            params = dict(query or {})
+            params.update({'From': len(records), 'Count': page_size})
+            result = client.request('GET', path, params)
+            page = result.get(root_key) or []
+            records.extend(page)
+            total = result.get('Total')
+            if len(page) < page_size or (total is not None and len(records) >= total):
+                return records
+
+
+def find_resources(model, name=None, page_size=PAGE_SIZE, tag=None):
+    """List saklient resources of a model, only those named exactly name
+    and carrying tag if given. The API matches names by substring, so the
+    rest is dropped here."""
+    resources = []
+    offset = 0
+    with sacloud_metrics(model).phase('find'):
+        while True:
+            model.reset()
+            if name is not None:
+                model.with_name_like(name)
+            if tag is not None:
+                model.with_tag(tag)
+            page = model.offset(offset).limit(page_size).find()
+            offset += len(page)
+            resources.extend([x for x in page if name is None or x.name == name])
+            if len(page) < page_size \
+                    or (model.total is not None and offset >= model.total):
+                return resources
+
+
+class Snapshot():
+    """All resources of the given types in a zone, listed in bulk.
+
+    Each type is paged through with list calls instead of being fetched
+    one resource at a time, and the types are listed concurrently. The raw
+    API records are kept; resource() turns one into a saklient object.
+    """
+
+    def __init__(self, saklient, kinds=None, concurrency=1, page_size=PAGE_SIZE):
+        kinds = kinds or sorted(RESOURCE_MODELS.keys())
+        for kind in kinds:
+            if kind not in RESOURCE_MODELS:
+                raise ValueError('Unsupported resource type: %s' % kind)
+        self._saklient = saklient
+        self._concurrency = concurrency
+        self._page_size = page_size
+        self.kinds = kinds
+        self.records = {}
+
+    def fetch(self):
+        results = WorkerPool(self._concurrency).map(self._fetch, self.kinds)
+        for result in results:
+            if result.failed:
+                raise result.error
+            self.records[result.item] = result.value
+        return self
+
+    def get(self, kind, resource_id):
+        for record in self.records.get(kind, []):
+            if str(record.get('ID')) == str(resource_id):
+                return record
+        return None
+
+    def find_by_name(self, kind, name):
+        return [x for x in self.records.get(kind, []) if x.get('Name') == name]
+
+    def resource(self, kind, resource_id):
+        record = self.get(kind, resource_id)
+        if record is None:
+            return None
+        model = getattr(self._saklient, RESOURCE_MODELS[kind][0])
+        # the model picks the class, e.g. LoadBalancer for appliances
+        return model._create_resource_impl(record)
+
+    def to_facts(self):
+        facts = {}
+        for kind in self.kinds:
+            ids, names, tags = {}, {}, {}
+            for record in self.records.get(kind, []):
+                resource_id = str(record['ID'])
+                ids[resource_id] = record
+                names.setdefault(record.get('Name'), []).append(resource_id)
+                for tag in record.get('Tags') or []:
+                    tags.setdefault(tag, []).append(resource_id)
+            facts[kind] = dict(ids=ids, names=names, tags=tags)
+        return facts
+
+    def _fetch(self, kind):
+        model, path, root_key = RESOURCE_MODELS[kind]
+        return find_all(self._saklient.client, path, root_key, self._page_size)
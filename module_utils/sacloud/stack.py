@@ -0,0 +1,547 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+from ansible.module_utils.sacloud import sacloud_argument_spec
+from ansible.module_utils.sacloud.cache import cache_argument_spec
+from ansible.module_utils.sacloud.client import clone_api
+from ansible.module_utils.sacloud.ipam import AUTO_ADDRESS, sacloud_ipam
+from ansible.module_utils.sacloud.metrics import Metrics
+from ansible.module_utils.sacloud.operations import OPERATIONS, OperationModule, check_params, run_operation
+from ansible.module_utils.sacloud.snapshot import find_resources
+from ansible.module_utils.sacloud.state import sacloud_state_file, state_argument_spec
+
+KINDS = ['routers', 'servers', 'disks', 'lbs']
+# keys of a stack resource that tie it to others instead of going to its module
+LINK_KEYS = dict(routers=[], servers=['router', 'running'],
+                    disks=['server', 'router'], lbs=['router'])
+DEFAULT_CONCURRENCY = dict(routers=2, servers=4, disks=4, lbs=2)
+
+
+def stack_argument_spec():
+    argument_spec = sacloud_argument_spec()
+    argument_spec.update(cache_argument_spec())
+    argument_spec.update(state_argument_spec())
+    argument_spec.update(dict(
+        routers=dict(required=False, type='list'),
+        servers=dict(required=False, type='list'),
+        disks=dict(required=False, type='list'),
+        lbs=dict(required=False, type='list'),
+        concurrency=dict(required=False, type='dict'),
+        state=dict(required=False, default='present',
+                    choices=['present', 'absent'])
+    ))
+    return argument_spec
+
+
+class UnresolvedReference(ValueError):
+    pass
+
+
+class Node():
+    """One module operation of the stack, run once its dependencies are."""
+
+    def __init__(self, key, kind, operation, build, deps):
+        self.key = key
+        self.kind = kind
+        self.operation = OPERATIONS[operation]
+        # build returns the operation's params from the results so far
+        self.build = build
+        self.deps = deps
+        self.status = None
+        self.result = {}
+        self.started = None
+        self.finished = None
+
+    def fact(self, name):
+        value = (self.result.get('ansible_facts') or {}).get(name)
+        if value is None:
+            raise UnresolvedReference('%s returned no %s' % (self.key, name))
+        return value
+
+    def to_dict(self, origin):
+        result = dict(node=self.key, status=self.status,
+                        changed=self.result.get('changed', False))
+        if self.result.get('msg'):
+            result['msg'] = self.result['msg']
+        if self.started is not None:
+            result.update(started=round(self.started - origin, 3),
+                            finished=round(self.finished - origin, 3),
+                            elapsed=round(self.finished - self.started, 3))
+        return result
+
+
+class Stack():
+    """Provision routers, servers, disks and load balancers as a graph.
+
+    Every create, connect, boot and apply is a node depending only on the
+    nodes it needs ids or addresses from, so disk copies start while
+    servers are still being created. Ready nodes run at once, within the
+    concurrency limit of their resource type.
+    """
+
+    def __init__(self, module, saklient):
+        self._module = module
+        self._saklient = saklient
+        self._ipam = sacloud_ipam(module)
+        self._shared = dict((k, module.params[k]) for k in sacloud_argument_spec())
+        self._shared.update((k, module.params[k]) for k in cache_argument_spec())
+        self._shared.update((k, module.params[k]) for k in state_argument_spec())
+        self._resources = {}
+        self._nodes = []
+        self._lock = threading.Condition()
+
+    def run(self):
+        self._check_resources()
+        if self._module.params['state_refresh']:
+            # one pass over the state file instead of one per node
+            sacloud_state_file(self._module).refresh(self._saklient)
+            self._shared['state_refresh'] = False
+        if self._module.params['state'] == 'absent':
+            self._plan_absent()
+        else:
+            self._plan_present()
+
+        origin = time.time()
+        self._execute(self._get_concurrency())
+        finished = time.time()
+
+        nodes = [x.to_dict(origin) for x in self._nodes]
+        path = [x.to_dict(origin) for x in self._get_critical_path()]
+        result = dict(changed=any([x['changed'] for x in nodes]),
+                        nodes=nodes,
+                        critical_path=path,
+                        elapsed=round(finished - origin, 3))
+
+        failed = [x for x in self._nodes if x.status == 'failed']
+        if failed:
+            self._fail(msg='Failed: %s' % '; '.join(['%s: %s' % (x.key, x.result.get('msg'))
+                                                        for x in failed]),
+                        **result)
+        if self._module.params['state'] == 'present':
+            result['ansible_facts'] = dict(sacloud_stack=self._get_facts())
+        self._success(**result)
+
+    def _check_resources(self):
+        names = dict((kind, []) for kind in KINDS)
+        for kind in KINDS:
+            for item in self._module.params[kind] or []:
+                if not isinstance(item, dict) or not item.get('name'):
+                    self._fail(msg='Every item of %s needs a name' % kind)
+                if item['name'] in names[kind]:
+                    self._fail(msg='Duplicate name in %s: %s' % (kind, item['name']))
+                reserved = sorted(set(item) & (set(self._shared) | set(['state'])))
+                if reserved:
+                    self._fail(msg='%s %s sets %s, which apply to the whole stack'
+                                % (kind, item['name'], ', '.join(reserved)))
+                names[kind].append(item['name'])
+            self._resources[kind] = dict((x['name'], x)
+                                        for x in self._module.params[kind] or [])
+
+        for kind, link, target in [('servers', 'router', 'routers'),
+                                    ('disks', 'router', 'routers'),
+                                    ('disks', 'server', 'servers'),
+                                    ('lbs', 'router', 'routers')]:
+            for item in self._resources[kind].values():
+                if item.get(link) and item[link] not in self._resources[target]:
+                    self._fail(msg='%s %s refers to unknown %s %s'
+                                % (kind, item['name'], link, item[link]))
+
+    def _get_concurrency(self):
+        concurrency = dict(DEFAULT_CONCURRENCY)
+        for kind, limit in (self._module.params['concurrency'] or {}).items():
+            if kind not in concurrency:
+                self._fail(msg='Unsupported concurrency: %s' % kind)
+            concurrency[kind] = max(1, int(limit))
+        return concurrency
+
+    # present
+
+    def _plan_present(self):
+        for name, item in self._resources['routers'].items():
+            self._add('router %s' % name, 'routers', 'sacloud_router',
+                        self._module_params(item, 'routers'), [])
+
+        for name, item in self._resources['servers'].items():
+            self._add('server %s' % name, 'servers', 'sacloud_server',
+                        self._module_params(item, 'servers'), [])
+            if item.get('router'):
+                self._add('server %s connect' % name, 'servers', 'sacloud_router',
+                            self._connect_server_params(name, item['router']),
+                            ['router %s' % item['router'], 'server %s' % name])
+
+        for name, item in self._resources['disks'].items():
+            deps = []
+            if item.get('router'):
+                deps.append('router %s' % item['router'])
+            self._add('disk %s' % name, 'disks', 'sacloud_disk',
+                        self._disk_params(item), deps)
+            if item.get('server'):
+                self._add('disk %s connect' % name, 'disks', 'sacloud_disk',
+                            self._connect_disk_params(name, item['server']),
+                            ['disk %s' % name, 'server %s' % item['server']])
+
+        for name, item in self._resources['servers'].items():
+            if not self._module.boolean(item.get('running', True)):
+                continue
+            deps = ['server %s' % name]
+            deps.extend(['disk %s connect' % x['name']
+                            for x in self._resources['disks'].values()
+                            if x.get('server') == name])
+            if item.get('router'):
+                deps.append('server %s connect' % name)
+            self._add('server %s boot' % name, 'servers', 'sacloud_server',
+                        self._boot_params(name), deps)
+
+        existing = self._find_existing(['lbs'])
+        for name, item in self._resources['lbs'].items():
+            deps = []
+            if item.get('router'):
+                deps.append('router %s' % item['router'])
+            if not item.get('virtual_ips'):
+                self._add('lb %s' % name, 'lbs', 'sacloud_lb',
+                            self._lb_params(name, item), deps)
+                continue
+
+            # real servers are only added once they are up
+            servers = []
+            for server in self._get_real_servers(item):
+                servers.extend(self._get_address_deps(server))
+                if 'server %s boot' % server in self._get_keys():
+                    servers.append('server %s boot' % server)
+            if name in existing['lbs']:
+                self._add('lb %s' % name, 'lbs', 'sacloud_lb',
+                            self._lb_params(name, item, existing['lbs'][name]),
+                            deps + servers)
+            else:
+                self._add('lb %s' % name, 'lbs', 'sacloud_lb',
+                            self._lb_params(name, item, real_servers=False), deps)
+                self._add('lb %s apply' % name, 'lbs', 'sacloud_lb',
+                            self._lb_apply_params(name, item),
+                            ['lb %s' % name] + servers)
+
+    def _module_params(self, item, kind):
+        params = dict((k, v) for k, v in item.items() if k not in LINK_KEYS[kind])
+        params['state'] = 'present'
+        return lambda: params
+
+    def _connect_server_params(self, name, router):
+        return lambda: dict(
+                router_resource_id=self._get_node('router %s' % router)
+                                        .fact('sacloud_router_resource_id'),
+                server_resource_ids=[self._get_node('server %s' % name)
+                                        .fact('sacloud_server_resource_id')],
+                state='connected')
+
+    def _disk_params(self, item):
+        def build():
+            params = self._module_params(item, 'disks')()
+            if item.get('router'):
+                params['router_resource_id'] = \
+                        self._get_node('router %s' % item['router']) \
+                            .fact('sacloud_router_resource_id')
+            return params
+        return build
+
+    def _connect_disk_params(self, name, server):
+        return lambda: dict(
+                disk_resource_id=self._get_node('disk %s' % name)
+                                    .fact('sacloud_disk_resource_id'),
+                server_resource_id=self._get_node('server %s' % server)
+                                    .fact('sacloud_server_resource_id'),
+                state='connected')
+
+    def _boot_params(self, name):
+        return lambda: dict(
+                server_resource_id=self._get_node('server %s' % name)
+                                    .fact('sacloud_server_resource_id'),
+                state='running')
+
+    def _lb_params(self, name, item, lb_resource_id=None, real_servers=True):
+        def build():
+            params = dict((k, v) for k, v in item.items()
+                            if k not in LINK_KEYS['lbs'] + ['virtual_ips'])
+            if item.get('router'):
+                params['router_resource_id'] = \
+                        self._get_node('router %s' % item['router']) \
+                            .fact('sacloud_router_resource_id')
+            if lb_resource_id:
+                params['lb_resource_id'] = lb_resource_id
+            if item.get('virtual_ips'):
+                params['virtual_ips'] = self._get_virtual_ips(name, item, real_servers)
+            params['state'] = 'present'
+            return params
+        return build
+
+    def _lb_apply_params(self, name, item):
+        return lambda: dict(
+                lb_resource_id=self._get_node('lb %s' % name)
+                                .fact('sacloud_lb_resource_id'),
+                virtual_ips=self._get_virtual_ips(name, item, True),
+                state='present')
+
+    def _get_virtual_ips(self, name, item, real_servers):
+        addresses = self._lease_virtual_ips(name, item)
+        virtual_ips = []
+        for virtual_ip in item['virtual_ips']:
+            virtual_ip = dict(virtual_ip)
+            if virtual_ip.get('virtual_ip') == AUTO_ADDRESS:
+                virtual_ip['virtual_ip'] = addresses.pop(0)
+            if real_servers:
+                virtual_ip['servers'] = [self._resolve_real_server(x)
+                                            for x in virtual_ip.get('servers') or []]
+            else:
+                virtual_ip['servers'] = []
+            virtual_ips.append(virtual_ip)
+        return virtual_ips
+
+    def _lease_virtual_ips(self, name, item):
+        count = len([x for x in item['virtual_ips']
+                        if x.get('virtual_ip') == AUTO_ADDRESS])
+        if not count:
+            return []
+        if not item.get('router'):
+            raise ValueError('auto virtual_ip requires router')
+        # leased after the real_ips sacloud_lb leased to the same owner, so
+        # the load balancer releases them all when it is destroyed
+        real_ips = len([x for x in item.get('real_ips') or [] if x == AUTO_ADDRESS])
+        router_resource_id = self._get_node('router %s' % item['router']) \
+                                .fact('sacloud_router_resource_id')
+        lease = self._ipam.lease(self._saklient, router_resource_id,
+                                    'lb:%s' % name, real_ips + count,
+                                    commit=not self._module.check_mode)
+        return list(lease['addresses'][real_ips:])
+
+    def _get_real_servers(self, item):
+        # real servers may be given by the name of a server of the stack
+        names = []
+        for virtual_ip in item['virtual_ips']:
+            for server in virtual_ip.get('servers') or []:
+                name = server.get('ip') if isinstance(server, dict) else server
+                if name in self._resources['servers']:
+                    names.append(name)
+        return names
+
+    def _resolve_real_server(self, server):
+        if isinstance(server, dict):
+            if server.get('ip') in self._resources['servers']:
+                return dict(server, ip=self._get_address(server['ip']))
+            return server
+        if server in self._resources['servers']:
+            return self._get_address(server)
+        return server
+
+    def _get_address_disk(self, server):
+        for disk in self._resources['disks'].values():
+            if disk.get('server') == server and disk.get('config_ipv4_address'):
+                return disk
+        self._fail(msg='Server %s has no disk with config_ipv4_address' % server)
+
+    def _get_address_deps(self, server):
+        return ['disk %s' % self._get_address_disk(server)['name']]
+
+    def _get_address(self, server):
+        disk = self._get_address_disk(server)
+        if disk['config_ipv4_address'] != AUTO_ADDRESS:
+            return disk['config_ipv4_address']
+        facts = self._get_node('disk %s' % disk['name']).result.get('ansible_facts') or {}
+        if facts.get('sacloud_ipv4_address'):
+            return facts['sacloud_ipv4_address']
+        # an existing disk: the address sacloud_disk leased when creating it
+        router_resource_id = self._get_node('router %s' % disk['router']) \
+                                .fact('sacloud_router_resource_id')
+        lease = self._ipam.lease(self._saklient, router_resource_id,
+                                    'disk:%s' % disk['name'],
+                                    commit=not self._module.check_mode)
+        return lease['addresses'][0]
+
+    # absent
+
+    def _plan_absent(self):
+        existing = self._find_existing(KINDS)
+
+        for name in self._resources['lbs']:
+            if name in existing['lbs']:
+                self._add('lb %s destroy' % name, 'lbs', 'sacloud_lb',
+                            self._destroy_params('lb', existing['lbs'][name]), [])
+
+        for name in self._resources['servers']:
+            if name in existing['servers']:
+                self._add('server %s destroy' % name, 'servers', 'sacloud_server',
+                            self._destroy_params('server', existing['servers'][name]), [])
+
+        for name, item in self._resources['disks'].items():
+            if name in existing['disks']:
+                # disks are still connected until their server is gone
+                deps = [x for x in ['server %s destroy' % item.get('server')]
+                        if x in self._get_keys()]
+                self._add('disk %s destroy' % name, 'disks', 'sacloud_disk',
+                            self._destroy_params('disk', existing['disks'][name]), deps)
+
+        for name in self._resources['routers']:
+            if name in existing['routers']:
+                deps = ['%s %s destroy' % (kind[:-1], x['name'])
+                        for kind in ['servers', 'lbs']
+                        for x in self._resources[kind].values()
+                        if x.get('router') == name]
+                self._add('router %s destroy' % name, 'routers', 'sacloud_router',
+                            self._destroy_params('router', existing['routers'][name]),
+                            [x for x in deps if x in self._get_keys()])
+
+    def _find_existing(self, kinds):
+        models = dict(routers=self._saklient.router, servers=self._saklient.server,
+                        disks=self._saklient.disk, lbs=self._saklient.appliance)
+        existing = {}
+        for kind in kinds:
+            if not self._resources[kind]:
+                existing[kind] = {}
+                continue
+            try:
+                resources = find_resources(models[kind])
+            except Exception, e:
+                self._fail(msg='Failed to find %s: %s' % (kind, e))
+            existing[kind] = {}
+            for resource in resources:
+                if resource.name not in self._resources[kind]:
+                    continue
+                if resource.name in existing[kind]:
+                    self._fail(msg='Multiple %s named %s: %s, %s'
+                                % (kind, resource.name,
+                                    existing[kind][resource.name], resource.id))
+                existing[kind][resource.name] = resource.id
+        return existing
+
+    def _destroy_params(self, kind, resource_id):
+        params = {'%s_resource_id' % kind: resource_id, 'state': 'absent'}
+        return lambda: params
+
+    # execution
+
+    def _add(self, key, kind, operation, build, deps):
+        self._nodes.append(Node(key, kind, operation, build, deps))
+
+    def _get_keys(self):
+        return [x.key for x in self._nodes]
+
+    def _get_node(self, key):
+        for node in self._nodes:
+            if node.key == key:
+                return node
+        raise UnresolvedReference('No node %s' % key)
+
+    def _execute(self, concurrency):
+        running = dict((kind, 0) for kind in KINDS)
+        pending = list(self._nodes)
+
+        with self._lock:
+            while pending or sum(running.values()):
+                for node in list(pending):
+                    deps = [self._get_node(x) for x in node.deps]
+                    if [x for x in deps if x.status in ['failed', 'blocked']]:
+                        node.status = 'blocked'
+                        node.result = dict(msg='Not run, as a dependency failed')
+                        pending.remove(node)
+                    elif [x for x in deps if x.status is None]:
+                        continue
+                    elif running[node.kind] < concurrency[node.kind]:
+                        running[node.kind] += 1
+                        pending.remove(node)
+                        thread = threading.Thread(target=self._run_node,
+                                                    args=(node, running))
+                        thread.daemon = True
+                        thread.start()
+                if pending or sum(running.values()):
+                    self._lock.wait()
+
+    def _run_node(self, node, running):
+        node.started = time.time()
+        try:
+            status, result = self._try_node(node)
+        except Exception, e:
+            status, result = 'failed', dict(msg=str(e))
+        node.finished = time.time()
+
+        with self._lock:
+            node.status = status
+            node.result = result
+            running[node.kind] -= 1
+            self._lock.notify()
+
+    def _try_node(self, node):
+        try:
+            params = node.build()
+        except UnresolvedReference, e:
+            if self._module.check_mode:
+                # depends on a resource check mode only pretends to create
+                return 'skipped', dict(msg=str(e))
+            return 'failed', dict(msg=str(e))
+
+        params.update(self._shared)
+        params = check_params(node.operation, params)
+        module = OperationModule(params, self._module.check_mode)
+        failed, result = run_operation(node.operation, module,
+                                        clone_api(self._saklient, Metrics()))
+        return 'failed' if failed else 'ok', result
+
+    def _get_critical_path(self):
+        # walk back from the node finishing last through the dependency
+        # each node waited for longest
+        ran = [x for x in self._nodes if x.finished is not None]
+        if not ran:
+            return []
+        node = max(ran, key=lambda x: x.finished)
+        path = [node]
+        while True:
+            deps = [self._get_node(x) for x in node.deps]
+            deps = [x for x in deps if x.finished is not None]
+            if not deps:
+                break
+            node = max(deps, key=lambda x: x.finished)
+            path.insert(0, node)
+        return path
+
+    def _get_facts(self):
+        facts = dict(addresses={})
+        for kind, key, fact in [('routers', 'router %s', 'sacloud_router_resource_id'),
+                                ('servers', 'server %s', 'sacloud_server_resource_id'),
+                                ('disks', 'disk %s', 'sacloud_disk_resource_id'),
+                                ('lbs', 'lb %s', 'sacloud_lb_resource_id')]:
+            facts[kind] = {}
+            for name in self._resources[kind]:
+                value = (self._get_node(key % name).result.get('ansible_facts') or {}).get(fact)
+                if value is not None:
+                    facts[kind][name] = value
+        for disk in self._resources['disks'].values():
+            value = (self._get_node('disk %s' % disk['name']).result
+                        .get('ansible_facts') or {}).get('sacloud_ipv4_address')
+            if value and disk.get('server'):
+                facts['addresses'][disk['server']] = value
+        return facts
+
+    def _fail(self, msg, **kwargs):
+        self._module.fail_json(msg=msg, **kwargs)
+
+    def _success(self, changed=True, **kwargs):
+        self._module.exit_json(changed=changed, **kwargs)
+
+
+def run_stack(module, saklient):
+    Stack(module, saklient).run()
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import time
+
+from ansible.module_utils.sacloud import sacloud_argument_spec
+from ansible.module_utils.sacloud.cache import FileStore, cache_argument_spec
+from ansible.module_utils.sacloud.metrics import sacloud_metrics
+from ansible.module_utils.sacloud.snapshot import RESOURCE_MODELS, Snapshot
+
+# modules whose present results are kept: the resource type they manage,
+# its id parameter and the fact returning the id
+STATE_RESOURCES = {
+    'sacloud_server': ('servers', 'server_resource_id', 'sacloud_server_resource_id'),
+    'sacloud_disk': ('disks', 'disk_resource_id', 'sacloud_disk_resource_id'),
+    'sacloud_router': ('routers', 'router_resource_id', 'sacloud_router_resource_id'),
+    'sacloud_lb': ('appliances', 'lb_resource_id', 'sacloud_lb_resource_id'),
+}
+
+
+def state_argument_spec():
+    return dict(
+        state_file=dict(required=False),
+        state_refresh=dict(required=False, default=False, type='bool'),
+    )
+
+
+def sacloud_state_file(module):
+    """Return the state file of the task, disabled without state_file."""
+    path = module.params.get('state_file')
+    return StateFile(path and os.path.expanduser(path))
+
+
+def sacloud_state(module, name):
+    """Return the state of the task of the module called name."""
+    return TaskState(sacloud_state_file(module), module, name)
+
+
+def _hash(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode('utf-8')) \
+            .hexdigest()
+
+
+class StateFile(FileStore):
+    """Results of present tasks by a fingerprint of the task, with the
+    resource each one returned. Without a path, nothing is kept."""
+
+    @property
+    def enabled(self):
+        return self._path is not None
+
+    def get(self, key):
+        return self._read().get(key)
+
+    def set(self, key, entry):
+        def set(data):
+            data[key] = entry
+        self._update(set)
+
+    def forget(self, kind, resource_id):
+        """Drop the entries of a destroyed resource."""
+        def forget(data):
+            for key, entry in data.items():
+                if entry['kind'] == kind and entry['id'] == str(resource_id):
+                    del data[key]
+        self._update(forget)
+
+    def refresh(self, saklient):
+        """Drop the entries of every resource that is gone, listing each
+        resource type once."""
+        if not self.enabled:
+            return
+        kinds = sorted(set([x['kind'] for x in self._read().values()]))
+        if not kinds:
+            return
+        try:
+            snapshot = Snapshot(saklient, kinds, concurrency=len(kinds)).fetch()
+        except Exception:
+            # entries of resources that are gone only miss when replayed
+            return
+
+        def refresh(data):
+            for key, entry in data.items():
+                if entry['kind'] in kinds \
+                        and snapshot.get(entry['kind'], entry['id']) is None:
+                    del data[key]
+        self._update(refresh)
+
+    def _read(self):
+        if not self.enabled:
+            return {}
+        try:
+            return FileStore._read(self)
+        except ValueError:
+            # a damaged state file is started over
+            return {}
+
+    def _update(self, func):
+        if not self.enabled:
+            return
+        # a state file that cannot be written only costs a full run later
+        try:
+            self.update(func)
+        except (IOError, OSError):
+            pass
+
+
+class TaskState():
+    """The entry of one present task in the state file.
+
+    The fingerprint covers the module, account, zone and the name or id
+    the task looks its resource up by; the entry keeps the id it returned
+    and a hash of the other params. When a task runs again with the same
+    params and its resource still exists, the stored result is returned
+    instead of looking the resource up and comparing it with the params.
+    """
+
+    def __init__(self, state_file, module, name):
+        self._file = state_file
+        self._module = module
+        self._kind, self._id_param, self._id_fact = STATE_RESOURCES[name]
+        self._key = _hash(dict(module=name,
+                                account=_hash(module.params['access_token']),
+                                zone=module.params['zone'],
+                                name=module.params.get('name') or 'default',
+                                resource_id=module.params.get(self._id_param)))
+        ignored = set(sacloud_argument_spec()) | set(cache_argument_spec()) \
+                    | set(state_argument_spec())
+        self._spec = _hash(dict((k, v) for k, v in module.params.items()
+                                if k not in ignored))
+        self._recording = False
+
+    def replay(self, saklient):
+        """Return the stored result of the task if it still applies, and
+        have the result of this run recorded otherwise."""
+        if not self._file.enabled:
+            return None
+        self._recording = True
+        if self._module.params['state_refresh']:
+            self._file.refresh(saklient)
+            return None
+
+        entry = self._file.get(self._key)
+        if entry is None or entry['spec'] != self._spec:
+            return None
+        if not self._exists(saklient, entry['id']):
+            return None
+        return dict(entry['result'], cached=True)
+
+    def record(self, result):
+        """Keep the result of a present run for the next one."""
+        if not self._recording or self._module.check_mode or result.get('cached'):
+            return
+        resource_id = (result.get('ansible_facts') or {}).get(self._id_fact)
+        if resource_id is None:
+            return
+        self._file.set(self._key,
+                        dict(id=str(resource_id), kind=self._kind, spec=self._spec,
+                            result=dict((k, v) for k, v in result.items()
+                                        if k in ['ansible_facts', 'result']),
+                            updated=time.time()))
+
+    def forget(self, resource_id):
+        self._file.forget(self._kind, resource_id)
+
+    def _exists(self, saklient, resource_id):
+        path = RESOURCE_MODELS[self._kind][1]
+        try:
+            with sacloud_metrics(saklient).phase('state'):
+                saklient.client.request('GET', '%s/%s' % (path, resource_id))
+        except Exception:
+            # gone or unknown, so the task runs in full
+            return False
+        return True
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from ansible.module_utils.sacloud import sacloud_argument_spec
+from ansible.module_utils.sacloud.metrics import with_metrics
+from ansible.module_utils.sacloud.waiter import Waiter
+
+
+def wait_argument_spec():
+    argument_spec = sacloud_argument_spec()
+    argument_spec.update(dict(
+        resources=dict(required=True, type='list'),
+        timeout=dict(required=False, default=600, type='int'),
+        interval=dict(required=False, type='int')
+    ))
+    return argument_spec
+
+
+class Wait():
+
+    def __init__(self, module, saklient):
+        self._module = module
+        self._saklient = saklient
+
+    def wait(self):
+        waiter = Waiter(self._saklient,
+                        timeout=self._module.params['timeout'],
+                        interval=self._module.params['interval'])
+
+        for resource in self._module.params['resources']:
+            if 'type' not in resource or 'id' not in resource:
+                self._fail(msg='resources require type and id: %s' % resource)
+            try:
+                waiter.add(resource['type'], resource['id'], resource.get('state'))
+            except ValueError, e:
+                self._fail(msg=str(e))
+
+        started = time.time()
+        pending = waiter.wait()
+        elapsed = round(time.time() - started, 1)
+        resources = [x.to_dict() for x in waiter.targets]
+        stats = waiter.stats
+
+        failed = [x for x in waiter.targets if x.failed]
+        if failed:
+            self._fail(msg='Resources failed: %s'
+                        % ', '.join(['%s %s' % (x.kind, x.resource_id) for x in failed]),
+                        resources=resources, elapsed=elapsed, **stats)
+        if pending:
+            self._fail(msg='Timeout waiting for: %s'
+                        % ', '.join(['%s %s' % (x.kind, x.resource_id) for x in pending]),
+                        resources=resources, elapsed=elapsed, **stats)
+        self._success(changed=False, resources=resources, elapsed=elapsed,
+                        **stats)
+
+    def _fail(self, msg, **kwargs):
+        kwargs = with_metrics(self._module, self._saklient, kwargs)
+        self._module.fail_json(msg=msg, **kwargs)
+
+    def _success(self, changed=True, **kwargs):
+        kwargs = with_metrics(self._module, self._saklient, kwargs)
+        self._module.exit_json(changed=changed, **kwargs)
+
+
+def run_wait(module, saklient):
+    Wait(module, saklient).wait()
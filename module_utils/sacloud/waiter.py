@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import time
+
+from ansible.module_utils.sacloud.metrics import sacloud_metrics
+
+
+def _instance_status(_server):
+    if _server.instance is None or _server.instance.status is None:
+        return 'down'
+    return _server.instance.status
+
+
+def _appliance_status(_appliance):
+    return _appliance.status or 'down'
+
+
+def _availability(resource):
+    return resource.availability
+
+
+def _router_availability(_router):
+    # Routers have no availability of their own; they are usable once
+    # their switch has been attached.
+    if _router.swytch_id:
+        return 'available'
+    return 'migrating'
+
+
+class ResourceType():
+
+    def __init__(self, model, default_state, getters, timeout, max_interval):
+        self.model = model
+        self.default_state = default_state
+        self.getters = getters
+        # defaults taken from the saklient sleep_* helpers
+        self.timeout = timeout
+        # how slow polling may get while the resource is still pending
+        self.max_interval = max_interval
+
+
+RESOURCE_TYPES = {
+    'server': ResourceType('server', 'up',
+                            {'up': _instance_status, 'down': _instance_status},
+                            timeout=180, max_interval=10),
+    'disk': ResourceType('disk', 'available',
+                            {'available': _availability},
+                            timeout=3600, max_interval=30),
+    'router': ResourceType('router', 'available',
+                            {'available': _router_availability},
+                            timeout=120, max_interval=10),
+    'lb': ResourceType('appliance', 'available',
+                            {'available': _availability,
+                            'up': _appliance_status,
+                            'down': _appliance_status},
+                            timeout=600, max_interval=15),
+}
+
+FAILED_STATES = ['failed']
+
+
+class WaitTarget():
+
+    def __init__(self, kind, resource_id, state):
+        self.kind = kind
+        self.resource_id = str(resource_id)
+        self.state = state
+        self.current = None
+        # the last copy of the resource returned by the API
+        self.resource = None
+
+    @property
+    def converged(self):
+        return self.current == self.state
+
+    @property
+    def failed(self):
+        return self.current in FAILED_STATES
+
+    def to_dict(self):
+        return dict(type=self.kind, id=self.resource_id, state=self.state,
+                    current=self.current, converged=self.converged)
+
+
+class Backoff():
+
+    def __init__(self, initial=2, factor=1.5, jitter=0.2):
+        self._delay = initial
+        self._factor = factor
+        self._jitter = jitter
+
+    def next(self, max_interval):
+        delay = min(self._delay, max_interval)
+        self._delay = delay * self._factor
+        return delay * random.uniform(1 - self._jitter, 1 + self._jitter)
+
+
+class Waiter():
+    """Poll many resources with one filtered list call per resource type."""
+
+    def __init__(self, saklient, timeout=None, interval=None):
+        self._saklient = saklient
+        self._timeout = timeout
+        self._interval = interval
+        self.targets = []
+        self.stats = dict(polls=0, api_calls=0, api_calls_saved=0)
+
+    def add(self, kind, resource_id, state=None):
+        if kind not in RESOURCE_TYPES:
+            raise ValueError('Unsupported resource type: %s' % kind)
+        resource_type = RESOURCE_TYPES[kind]
+        state = state or resource_type.default_state
+        if state not in resource_type.getters:
+            raise ValueError('Unsupported state for %s: %s' % (kind, state))
+
+        target = WaitTarget(kind, resource_id, state)
+        self.targets.append(target)
+        return target
+
+    def wait(self):
+        with sacloud_metrics(self._saklient).phase('wait'):
+            return self._wait()
+
+    def _wait(self):
+        deadline = time.time() + self._get_timeout()
+        backoff = Backoff()
+        pending = list(self.targets)
+
+        while pending:
+            self._poll(pending)
+            pending = [x for x in pending if not (x.converged or x.failed)]
+            if not pending:
+                break
+
+            delay = backoff.next(self._get_max_interval(pending))
+            if time.time() + delay > deadline:
+                break
+            time.sleep(delay)
+
+        return pending
+
+    def _get_timeout(self):
+        if self._timeout:
+            return self._timeout
+        return max([RESOURCE_TYPES[x.kind].timeout for x in self.targets] or [0])
+
+    def _get_max_interval(self, pending):
+        max_interval = min([RESOURCE_TYPES[x.kind].max_interval for x in pending])
+        if self._interval:
+            return min(max_interval, self._interval)
+        return max_interval
+
+    def _poll(self, pending):
+        self.stats['polls'] += 1
+        by_kind = {}
+        for target in pending:
+            by_kind.setdefault(target.kind, []).append(target)
+
+        for kind, targets in by_kind.items():
+            resources = self._find(kind, [x.resource_id for x in targets])
+            self.stats['api_calls'] += 1
+            sacloud_metrics(self._saklient).record_poll(kind)
+            self.stats['api_calls_saved'] += len(targets) - 1
+
+            for target in targets:
+                resource = resources.get(target.resource_id)
+                if resource is None:
+                    # not visible yet or a transient API error
+                    target.current = None
+                    continue
+                target.resource = resource
+                target.current = RESOURCE_TYPES[kind].getters[target.state](resource)
+
+    def _find(self, kind, resource_ids):
+        model = getattr(self._saklient, RESOURCE_TYPES[kind].model)
+        model.reset()
+        for resource_id in resource_ids:
+            model.filter_by('ID', resource_id, True)
+
+        try:
+            resources = model.limit(len(resource_ids)).find()
+        except Exception:
+            return {}
+        return dict((str(x.id), x) for x in resources)
+
+
+def wait_for(saklient, kind, resource_id, state=None):
+    """Wait for a single resource and return its WaitTarget."""
+    waiter = Waiter(saklient)
+    target = waiter.add(kind, resource_id, state)
+    waiter.wait()
+    return target
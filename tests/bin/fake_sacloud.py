@@ -0,0 +1,872 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Koji Nakayama <knakayama.sh@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+"""Offline stand-in for the part of the sacloud API the modules use.
+
+Serves servers, disks, archives, icons, routers and their switches,
+interfaces, load balancers and plans from memory. Disk copies, boots,
+shutdowns and router and appliance creation take a configurable time,
+and latency, rate limits and failures can be injected:
+
+    $ ./bin/fake_sacloud.py --port 8080 --latency 0.05 --rate-limit 10
+    $ export SACLOUD_API_ROOT=http://127.0.0.1:8080/cloud/
+    $ export ACCESS_TOKEN=fake ACCESS_TOKEN_SECRET=fake
+    $ export ARCHIVE_RESOURCE_ID=112900000001
+    $ ansible-playbook -i ./bin/hosts.py site.yml --skip-tags http
+
+Request counts per endpoint are served at /_fake/stats, and a DELETE
+there resets them.
+"""
+
+import copy
+import itertools
+import json
+import optparse
+import random
+import re
+import sys
+import threading
+import time
+import urllib
+
+import BaseHTTPServer
+import SocketServer
+
+
+ARCHIVE_ID = '112900000001'
+
+API_PATH = re.compile(r'^/cloud/zone/(?P<zone>[^/]+)/api/cloud/1\.1(?P<path>/[^?]*)'
+                        r'(\?(?P<query>.*))?$')
+
+# path segment: (singular root key, plural root key)
+RESOURCES = {
+    'server': ('Server', 'Servers'),
+    'disk': ('Disk', 'Disks'),
+    'archive': ('Archive', 'Archives'),
+    'icon': ('Icon', 'Icons'),
+    'internet': ('Internet', 'Internet'),
+    'switch': ('Switch', 'Switches'),
+    'interface': ('Interface', 'Interfaces'),
+    'appliance': ('Appliance', 'Appliances'),
+}
+
+PRODUCTS = {
+    'server': ('ServerPlan', 'ServerPlans'),
+    'disk': ('DiskPlan', 'DiskPlans'),
+    'internet': ('InternetPlan', 'InternetPlans'),
+}
+
+ICONS = ['Ubuntu', 'CentOS', 'Debian', 'FreeBSD', 'Wall', 'DNS', 'WWW', 'Database']
+
+
+class ApiError(Exception):
+
+    def __init__(self, status, code, msg):
+        Exception.__init__(self, msg)
+        self.status = status
+        self.code = code
+
+
+def not_found(path):
+    return ApiError(404, 'not_found', 'Resource not found: %s' % path)
+
+
+def conflict(msg):
+    return ApiError(409, 'conflict', msg)
+
+
+def public(record):
+    """The record without the fake's own bookkeeping keys."""
+    if isinstance(record, dict):
+        return dict((k, public(v)) for k, v in record.items()
+                    if not k.startswith('_'))
+    if isinstance(record, list):
+        return [public(x) for x in record]
+    return record
+
+
+def reason(status):
+    if status == 429:
+        return 'Too Many Requests'
+    return BaseHTTPServer.BaseHTTPRequestHandler.responses.get(status, ('',))[0]
+
+
+def ip2int(address):
+    result = 0
+    for part in address.split('.'):
+        result = result * 256 + int(part)
+    return result
+
+
+def int2ip(value):
+    return '.'.join([str((value >> shift) & 255) for shift in (24, 16, 8, 0)])
+
+
+class Zone():
+    """The resources of one zone."""
+
+    def __init__(self, name):
+        self.name = name
+        self.records = dict((kind, {}) for kind in RESOURCES)
+        self.subnets = itertools.count(1)
+        for index, name in enumerate(ICONS):
+            icon_id = '1129000001%02d' % index
+            self.records['icon'][icon_id] = dict(
+                    ID=icon_id, Name=name, Scope='shared', Tags=[],
+                    URL='https://secure.sakura.ad.jp/cloud/icon/%s.png' % icon_id,
+                    Availability='available')
+        self.records['archive'][ARCHIVE_ID] = dict(
+                ID=ARCHIVE_ID, Name='Ubuntu Server 14.04.3 LTS 64bit',
+                Description='', Scope='shared', Tags=['distro-ubuntu'],
+                Icon=dict(ID='112900000100', Name='Ubuntu'), SizeMB=20480,
+                Plan=dict(ID='2', Name='hdd'), Availability='available',
+                ServiceClass='cloud/archive/20g')
+
+
+class FakeSacloud():
+    """In-memory sacloud API.
+
+    Every record may carry pending changes, a list of (due, changes),
+    which are applied when the record is next read after their due time.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.RLock()
+        self.ids = itertools.count(112000000001)
+        self.zones = {}
+        self.random = random.Random(options.seed)
+        self.stats = {}
+        self._tokens = float(options.burst or options.rate_limit)
+        self._refilled = time.time()
+        self._failure_match = re.compile(options.failure_match)
+
+    # -- request entry point -------------------------------------------------
+
+    def handle(self, method, url, headers, body):
+        """Return (status, headers, body) for a request."""
+        if url.startswith('/_fake/stats'):
+            return self._handle_stats(method)
+
+        match = API_PATH.match(url)
+        if not match:
+            return self._error(ApiError(404, 'not_found', 'Unknown path: %s' % url))
+        path = match.group('path').rstrip('/')
+        endpoint = '%s %s' % (method, re.sub(r'/\d+', '/:id', path))
+        self._count('requests', endpoint)
+
+        delay = self.options.latency
+        if self.options.jitter:
+            delay += self.random.uniform(0, self.options.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if not headers.get('Authorization'):
+            return self._error(ApiError(401, 'unauthorized', 'Authorization required'))
+
+        retry_after = self._throttle()
+        if retry_after:
+            self._count('throttled', endpoint)
+            return self._error(ApiError(429, 'too_many_requests',
+                                        'Too many requests'),
+                                {'Retry-After': str(retry_after)})
+
+        if self.options.failure_rate and self._failure_match.search(endpoint) \
+                and self.random.random() < self.options.failure_rate:
+            self._count('failed', endpoint)
+            return self._error(ApiError(503, 'service_unavailable',
+                                        'Injected failure'))
+
+        params = {}
+        try:
+            if method == 'GET' and match.group('query'):
+                params = json.loads(urllib.unquote(match.group('query')))
+            elif body:
+                params = json.loads(body)
+        except ValueError:
+            return self._error(ApiError(400, 'bad_request', 'Invalid JSON'))
+
+        try:
+            with self.lock:
+                zone = self._get_zone(match.group('zone'))
+                result = self._dispatch(zone, method, path.strip('/').split('/'),
+                                        params or {})
+        except ApiError, e:
+            return self._error(e)
+        result.setdefault('is_ok', True)
+        return 200, {}, json.dumps(public(result))
+
+    def _handle_stats(self, method):
+        with self.lock:
+            if method == 'DELETE':
+                self.stats = {}
+            return 200, {}, json.dumps(self.stats)
+
+    def _count(self, key, endpoint):
+        with self.lock:
+            counts = self.stats.setdefault(key, {})
+            counts[endpoint] = counts.get(endpoint, 0) + 1
+            self.stats['total_%s' % key] = self.stats.get('total_%s' % key, 0) + 1
+
+    def _throttle(self):
+        """Take a token from the bucket, or return seconds to wait for one."""
+        rate = self.options.rate_limit
+        if not rate:
+            return 0
+        with self.lock:
+            now = time.time()
+            burst = self.options.burst or rate
+            self._tokens = min(burst, self._tokens + (now - self._refilled) * rate)
+            self._refilled = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return max(1, int((1 - self._tokens) / rate + 0.999))
+
+    def _error(self, e, headers=None):
+        body = dict(is_fatal=True, status='%d %s' % (e.status, reason(e.status)),
+                    error_code=e.code, error_msg=str(e))
+        return e.status, headers or {}, json.dumps(body)
+
+    def _get_zone(self, name):
+        if name not in self.zones:
+            self.zones[name] = Zone(name)
+        return self.zones[name]
+
+    # -- routing -------------------------------------------------------------
+
+    def _dispatch(self, zone, method, parts, params):
+        kind = parts[0]
+        if kind == 'product':
+            return self._product(parts[1:], params)
+        if kind not in RESOURCES:
+            raise not_found('/'.join(parts))
+
+        if len(parts) == 1:
+            if method == 'GET':
+                return self._list(zone, kind, params)
+            elif method == 'POST':
+                return self._create(zone, kind, params)
+        elif len(parts) == 2:
+            if method == 'GET':
+                return self._wrap(kind, self._view(zone, kind,
+                                    self._get(zone, kind, parts[1])))
+            elif method == 'PUT':
+                return self._update(zone, kind, parts[1], params)
+            elif method == 'DELETE':
+                return self._delete(zone, kind, parts[1], params)
+        else:
+            handler = getattr(self, '_%s_%s' % (kind, parts[2]), None)
+            if handler is not None:
+                return handler(zone, method, parts[1], parts[3:], params)
+        raise ApiError(405, 'method_not_allowed',
+                        'Unsupported request: %s /%s' % (method, '/'.join(parts)))
+
+    def _wrap(self, kind, record):
+        return {RESOURCES[kind][0]: record, 'Success': True}
+
+    def _get(self, zone, kind, resource_id):
+        record = zone.records[kind].get(resource_id)
+        if record is None:
+            raise not_found('/%s/%s' % (kind, resource_id))
+        self._settle(record)
+        return record
+
+    def _list(self, zone, kind, params):
+        records = []
+        for resource_id in sorted(zone.records[kind]):
+            record = self._get(zone, kind, resource_id)
+            view = self._view(zone, kind, record)
+            if self._match(view, params.get('Filter') or {}):
+                records.append(view)
+        return self._page(RESOURCES[kind][1], records, params)
+
+    def _page(self, root_key, records, params):
+        start = int(params.get('From') or 0)
+        count = int(params.get('Count') or 0)
+        page = records[start:start + count] if count else records[start:]
+        return {root_key: page, 'Total': len(records), 'From': start,
+                'Count': len(page)}
+
+    def _match(self, record, filters):
+        for key, expected in filters.items():
+            value = record
+            for part in key.split('.'):
+                if isinstance(value, list):
+                    value = [x.get(part) if isinstance(x, dict) else x
+                                for x in value]
+                elif isinstance(value, dict):
+                    value = value.get(part)
+                else:
+                    value = None
+            if key == 'Tags.Name':
+                value = record.get('Tags') or []
+            if isinstance(expected, list):
+                if isinstance(value, list):
+                    if not all([x in value for x in expected]):
+                        return False
+                elif str(value) not in [str(x) for x in expected]:
+                    return False
+            elif key == 'Name':
+                name = (value or '').lower()
+                if not all([word in name for word in expected.lower().split()]):
+                    return False
+            elif str(value) != str(expected):
+                return False
+        return True
+
+    # -- state transitions ---------------------------------------------------
+
+    def _later(self, record, seconds, changes):
+        """Apply changes, a dict of dotted paths, after seconds."""
+        due = time.time() + max(0, seconds)
+        record.setdefault('_pending', []).append((due, changes))
+        self._settle(record)
+
+    def _settle(self, record):
+        now = time.time()
+        pending = record.get('_pending') or []
+        while pending and pending[0][0] <= now:
+            due, changes = pending.pop(0)
+            for path, value in changes.items():
+                target = record
+                keys = path.split('.')
+                for key in keys[:-1]:
+                    target = target.setdefault(key, {})
+                target[keys[-1]] = value
+
+    def _busy(self, record):
+        return bool(record.get('_pending'))
+
+    def _status(self, record):
+        return (record.get('Instance') or {}).get('Status')
+
+    # -- generic resources ---------------------------------------------------
+
+    def _create(self, zone, kind, params):
+        root_key = RESOURCES[kind][0]
+        if kind not in ('server', 'disk', 'internet', 'interface', 'appliance'):
+            raise ApiError(405, 'method_not_allowed', 'Cannot create %s' % kind)
+        record = copy.deepcopy(params.get(root_key) or {})
+        record['ID'] = str(next(self.ids))
+        record.setdefault('Name', '')
+        record.setdefault('Description', '')
+        record.setdefault('Tags', [])
+        record.setdefault('Icon', None)
+        record['Availability'] = 'available'
+        record['CreatedAt'] = time.strftime('%Y-%m-%dT%H:%M:%S+09:00')
+        getattr(self, '_create_%s' % kind)(zone, record)
+        zone.records[kind][record['ID']] = record
+        return self._wrap(kind, self._view(zone, kind, record))
+
+    def _update(self, zone, kind, resource_id, params):
+        record = self._get(zone, kind, resource_id)
+        changes = params.get(RESOURCES[kind][0]) or {}
+        for key in ['Name', 'Description', 'Tags', 'Icon', 'Settings',
+                    'UserIPAddress']:
+            if key in changes:
+                record[key] = copy.deepcopy(changes[key])
+        return self._wrap(kind, self._view(zone, kind, record))
+
+    def _delete(self, zone, kind, resource_id, params):
+        record = self._get(zone, kind, resource_id)
+        handler = getattr(self, '_delete_%s' % kind, None)
+        if handler is None:
+            raise ApiError(405, 'method_not_allowed', 'Cannot delete %s' % kind)
+        handler(zone, record, params)
+        del zone.records[kind][resource_id]
+        return self._wrap(kind, self._view(zone, kind, record))
+
+    def _view(self, zone, kind, record):
+        handler = getattr(self, '_view_%s' % kind, None)
+        if handler is None:
+            return record
+        return handler(zone, record)
+
+    # -- servers -------------------------------------------------------------
+
+    def _create_server(self, zone, record):
+        plan_id = str((record.get('ServerPlan') or {}).get('ID') or '1001')
+        record['ServerPlan'] = self._get_plan('server', plan_id)
+        record['Instance'] = dict(Status='down')
+
+    def _view_server(self, zone, record):
+        view = dict(record)
+        view['Interfaces'] = [self._view_interface(zone, x)
+                                for x in self._server_interfaces(zone, record['ID'])]
+        view['Disks'] = [dict(ID=x['ID'], Name=x['Name'])
+                            for x in self._server_disks(zone, record['ID'])]
+        return view
+
+    def _server_interfaces(self, zone, server_id):
+        return [zone.records['interface'][x]
+                for x in sorted(zone.records['interface'])
+                if (zone.records['interface'][x].get('Server') or {}).get('ID')
+                    == server_id]
+
+    def _server_disks(self, zone, server_id):
+        return [zone.records['disk'][x] for x in sorted(zone.records['disk'])
+                if (zone.records['disk'][x].get('Server') or {}).get('ID')
+                    == server_id]
+
+    def _server_power(self, zone, method, server_id, rest, params):
+        record = self._get(zone, 'server', server_id)
+        self._power(record, method, params, 'server')
+        return {'Success': True}
+
+    def _appliance_power(self, zone, method, appliance_id, rest, params):
+        record = self._get(zone, 'appliance', appliance_id)
+        self._power(record, method, params, 'appliance')
+        return {'Success': True}
+
+    def _power(self, record, method, params, kind):
+        if self._busy(record):
+            raise conflict('The %s is busy: %s' % (kind, record['ID']))
+        if method == 'PUT':
+            if self._status(record) == 'up':
+                raise conflict('The %s is already running: %s'
+                                % (kind, record['ID']))
+            self._later(record, self.options.boot_seconds,
+                        {'Instance.Status': 'up'})
+        elif method == 'DELETE':
+            if self._status(record) != 'up':
+                raise conflict('The %s is already stopped: %s'
+                                % (kind, record['ID']))
+            seconds = self.options.shutdown_seconds
+            if params.get('Force'):
+                seconds = 0
+            self._later(record, seconds, {'Instance.Status': 'down'})
+        else:
+            raise ApiError(405, 'method_not_allowed', 'Unsupported power request')
+
+    def _server_reset(self, zone, method, server_id, rest, params):
+        self._get(zone, 'server', server_id)
+        return {'Success': True}
+
+    def _server_to(self, zone, method, server_id, rest, params):
+        # PUT /server/:id/to/plan/:plan_id gives the server a new ID
+        record = self._get(zone, 'server', server_id)
+        if method != 'PUT' or rest[:1] != ['plan'] or len(rest) != 2:
+            raise ApiError(405, 'method_not_allowed', 'Unsupported request')
+        if self._status(record) != 'down':
+            raise conflict('Stop the server to change its plan: %s' % server_id)
+        plan = self._get_plan('server', rest[1])
+        del zone.records['server'][server_id]
+        record['ID'] = str(next(self.ids))
+        record['ServerPlan'] = plan
+        zone.records['server'][record['ID']] = record
+        for kind in ['interface', 'disk']:
+            for other in zone.records[kind].values():
+                if (other.get('Server') or {}).get('ID') == server_id:
+                    other['Server'] = dict(ID=record['ID'], Name=record['Name'])
+        return self._wrap('server', self._view(zone, 'server', record))
+
+    def _delete_server(self, zone, record, params):
+        if self._status(record) != 'down' or self._busy(record):
+            raise conflict('The server is still running: %s' % record['ID'])
+        with_disk = [str(x) for x in params.get('WithDisk') or []]
+        for disk in self._server_disks(zone, record['ID']):
+            if disk['ID'] in with_disk:
+                del zone.records['disk'][disk['ID']]
+            else:
+                disk['Server'] = None
+        for iface in self._server_interfaces(zone, record['ID']):
+            del zone.records['interface'][iface['ID']]
+
+    # -- disks ---------------------------------------------------------------
+
+    def _create_disk(self, zone, record):
+        plan_id = str((record.get('Plan') or {}).get('ID') or '4')
+        record['Plan'] = self._get_plan('disk', plan_id)
+        record.setdefault('SizeMB', 20480)
+        record['Server'] = None
+        source = record.get('SourceArchive') or record.get('SourceDisk')
+        if not source:
+            return
+        source_kind = 'archive' if record.get('SourceArchive') else 'disk'
+        self._get(zone, source_kind, str(source.get('ID')))
+
+        record['Availability'] = 'migrating'
+        record['MigratedMB'] = 0
+        if self.random.random() < self.options.copy_failure_rate:
+            result = 'failed'
+        else:
+            result = 'available'
+        self._later(record, self.options.copy_seconds,
+                    dict(Availability=result, MigratedMB=record['SizeMB']))
+
+    def _disk_config(self, zone, method, disk_id, rest, params):
+        record = self._get(zone, 'disk', disk_id)
+        if method != 'PUT':
+            raise ApiError(405, 'method_not_allowed', 'Unsupported request')
+        if record['Availability'] != 'available':
+            raise conflict('The disk is not available: %s' % disk_id)
+        record['_config'] = copy.deepcopy(params)
+        return {'Success': True}
+
+    def _disk_to(self, zone, method, disk_id, rest, params):
+        record = self._get(zone, 'disk', disk_id)
+        if rest[:1] != ['server']:
+            raise ApiError(405, 'method_not_allowed', 'Unsupported request')
+        if method == 'PUT':
+            server = self._get(zone, 'server', rest[1])
+            if self._status(server) != 'down':
+                raise conflict('Stop the server to connect a disk: %s' % rest[1])
+            record['Server'] = dict(ID=server['ID'], Name=server['Name'])
+        elif method == 'DELETE':
+            server_id = (record.get('Server') or {}).get('ID')
+            if server_id in zone.records['server'] and \
+                    self._status(zone.records['server'][server_id]) != 'down':
+                raise conflict('Stop the server to disconnect a disk: %s'
+                                % server_id)
+            record['Server'] = None
+        return {'Success': True}
+
+    def _delete_disk(self, zone, record, params):
+        if self._busy(record):
+            raise conflict('The disk is being copied: %s' % record['ID'])
+
+    # -- routers and switches ------------------------------------------------
+
+    def _create_internet(self, zone, record):
+        mask_len = int(record.get('NetworkMaskLen') or 28)
+        band_width = int(record.get('BandWidthMbps') or 100)
+        self._get_plan('internet', str(band_width))
+        record['NetworkMaskLen'] = mask_len
+        record['BandWidthMbps'] = band_width
+
+        network = ip2int('10.0.0.0') + next(zone.subnets) * 256
+        size = 2 ** (32 - mask_len)
+        subnet = dict(ID=str(next(self.ids)), NetworkAddress=int2ip(network),
+                        NetworkMaskLen=mask_len, DefaultRoute=int2ip(network + 1),
+                        IPAddresses=dict(Min=int2ip(network + 4),
+                                        Max=int2ip(network + size - 2)))
+        switch = dict(ID=str(next(self.ids)), Name=record['Name'],
+                        Description='', Tags=[], Icon=None, ServerCount=0,
+                        ApplianceCount=0, Subnets=[subnet], IPv6Nets=[],
+                        Bridge=None, Availability='available',
+                        UserSubnet=dict(DefaultRoute=subnet['DefaultRoute'],
+                                        NetworkMaskLen=mask_len))
+        zone.records['switch'][switch['ID']] = switch
+        self._link_router(zone, record, switch['ID'])
+
+        # like the API, the router shows its switch once it is usable
+        record['Switch'] = None
+        record['Availability'] = 'migrating'
+        self._later(record, self.options.create_seconds,
+                    {'Availability': 'available',
+                        'Switch': dict(ID=switch['ID'])})
+
+    def _link_router(self, zone, record, switch_id):
+        switch = zone.records['switch'][switch_id]
+        switch['Internet'] = dict(ID=record['ID'], Name=record['Name'],
+                                    BandWidthMbps=record['BandWidthMbps'])
+        for subnet in switch['Subnets']:
+            subnet['Internet'] = dict(switch['Internet'])
+
+    def _view_internet(self, zone, record):
+        view = dict(record)
+        switch = zone.records['switch'].get((record.get('Switch') or {}).get('ID'))
+        if switch is not None:
+            view['Switch'] = dict(ID=switch['ID'], Name=switch['Name'],
+                                    Subnets=switch['Subnets'],
+                                    IPv6Nets=switch['IPv6Nets'])
+        return view
+
+    def _internet_bandwidth(self, zone, method, router_id, rest, params):
+        # changing the band width gives the router a new ID
+        record = self._get(zone, 'internet', router_id)
+        if method != 'PUT':
+            raise ApiError(405, 'method_not_allowed', 'Unsupported request')
+        if self._busy(record):
+            raise conflict('The router is busy: %s' % router_id)
+        band_width = int((params.get('Internet') or {}).get('BandWidthMbps') or 0)
+        self._get_plan('internet', str(band_width))
+        del zone.records['internet'][router_id]
+        record['ID'] = str(next(self.ids))
+        record['BandWidthMbps'] = band_width
+        zone.records['internet'][record['ID']] = record
+        self._link_router(zone, record, record['Switch']['ID'])
+        return self._wrap('internet', self._view(zone, 'internet', record))
+
+    def _delete_internet(self, zone, record, params):
+        if self._busy(record):
+            raise conflict('The router is busy: %s' % record['ID'])
+        switch_id = record['Switch']['ID']
+        if [x for x in zone.records['interface'].values()
+                if (x.get('Switch') or {}).get('ID') == switch_id]:
+            raise conflict('The router switch is still in use: %s' % record['ID'])
+        zone.records['switch'].pop(switch_id, None)
+
+    def _view_switch(self, zone, record):
+        view = dict(record)
+        ifaces = [x for x in zone.records['interface'].values()
+                    if (x.get('Switch') or {}).get('ID') == record['ID']]
+        view['ServerCount'] = len([x for x in ifaces if x.get('Server')])
+        view['ApplianceCount'] = len(set([x['_appliance'] for x in ifaces
+                                            if x.get('_appliance')]))
+        return view
+
+    # -- interfaces ----------------------------------------------------------
+
+    def _create_interface(self, zone, record):
+        server_id = str((record.get('Server') or {}).get('ID'))
+        server = self._get(zone, 'server', server_id)
+        if self._status(server) != 'down':
+            raise conflict('Stop the server to add an interface: %s' % server_id)
+        record['Server'] = dict(ID=server['ID'], Name=server['Name'])
+        record['Switch'] = None
+        record['MACAddress'] = '9c:a3:ba:%02x:%02x:%02x' % (
+                (int(record['ID']) >> 16) & 255,
+                (int(record['ID']) >> 8) & 255, int(record['ID']) & 255)
+        record['IPAddress'] = None
+        record['UserIPAddress'] = None
+
+    def _view_interface(self, zone, record):
+        view = dict(record)
+        switch = zone.records['switch'].get((record.get('Switch') or {}).get('ID'))
+        if switch is not None:
+            view['Switch'] = dict(ID=switch['ID'], Name=switch['Name'],
+                                    Scope='user', Subnet=switch['Subnets'][0])
+        server_id = (record.get('Server') or {}).get('ID')
+        if switch is not None and server_id and not view.get('UserIPAddress'):
+            # the address written to a disk of the server by a disk config
+            for disk in self._server_disks(zone, server_id):
+                address = (disk.get('_config') or {}).get('UserIPAddress')
+                if address:
+                    view['UserIPAddress'] = address
+                    break
+        return view
+
+    def _interface_to(self, zone, method, iface_id, rest, params):
+        record = self._get(zone, 'interface', iface_id)
+        if rest[:1] != ['switch']:
+            raise ApiError(405, 'method_not_allowed', 'Unsupported request')
+        if method == 'PUT':
+            if rest[1:] == ['shared']:
+                record['Switch'] = dict(ID='shared')
+            else:
+                self._get(zone, 'switch', rest[1])
+                record['Switch'] = dict(ID=rest[1])
+        elif method == 'DELETE':
+            record['Switch'] = None
+        return {'Success': True}
+
+    def _delete_interface(self, zone, record, params):
+        pass
+
+    # -- appliances ----------------------------------------------------------
+
+    def _create_appliance(self, zone, record):
+        remark = record.get('Remark') or {}
+        switch_id = str((remark.get('Switch') or {}).get('ID'))
+        self._get(zone, 'switch', switch_id)
+        record.setdefault('Class', 'loadbalancer')
+        record.setdefault('Settings', {})
+        record['Instance'] = dict(Status='down')
+        for server in remark.get('Servers') or []:
+            iface_id = str(next(self.ids))
+            zone.records['interface'][iface_id] = dict(
+                    ID=iface_id, Server=None, Switch=dict(ID=switch_id),
+                    IPAddress=None, UserIPAddress=server.get('IPAddress'),
+                    _appliance=record['ID'])
+
+        # load balancers boot on their own once created
+        record['Availability'] = 'migrating'
+        self._later(record, self.options.create_seconds,
+                    dict(Availability='available'))
+        self._later(record, self.options.create_seconds + self.options.boot_seconds,
+                    {'Instance.Status': 'up'})
+
+    def _appliance_config(self, zone, method, appliance_id, rest, params):
+        record = self._get(zone, 'appliance', appliance_id)
+        if method != 'PUT':
+            raise ApiError(405, 'method_not_allowed', 'Unsupported request')
+        if record['Availability'] != 'available':
+            raise conflict('The appliance is not available: %s' % appliance_id)
+        record['_applied'] = copy.deepcopy(record.get('Settings'))
+        return {'Success': True}
+
+    def _appliance_status(self, zone, method, appliance_id, rest, params):
+        # real servers pass their health check while enabled and served by
+        # a running server
+        record = self._get(zone, 'appliance', appliance_id)
+        applied = record.get('_applied') or {}
+        running = set()
+        for iface in zone.records['interface'].values():
+            server = zone.records['server'].get((iface.get('Server') or {}).get('ID'))
+            if server is None:
+                continue
+            self._settle(server)
+            if self._status(server) == 'up':
+                running.add(self._view_interface(zone, iface).get('UserIPAddress'))
+
+        vips = []
+        for vip in applied.get('LoadBalancer') or []:
+            servers = [dict(IPAddress=x.get('IPAddress'), Port=x.get('Port'),
+                            ActiveConn='0',
+                            Status='UP' if str(x.get('Enabled')) != 'False'
+                                        and x.get('IPAddress') in running
+                                        else 'DOWN')
+                        for x in vip.get('Servers') or []]
+            vips.append(dict(VirtualIPAddress=vip.get('VirtualIPAddress'),
+                                Port=vip.get('Port'), CPS='0', Servers=servers))
+        return {'LoadBalancer': vips}
+
+    def _delete_appliance(self, zone, record, params):
+        if self._status(record) == 'up' or self._busy(record):
+            raise conflict('The appliance is still running: %s' % record['ID'])
+        for iface_id, iface in zone.records['interface'].items():
+            if iface.get('_appliance') == record['ID']:
+                del zone.records['interface'][iface_id]
+
+    # -- plans ---------------------------------------------------------------
+
+    def _plans(self, kind):
+        if kind == 'server':
+            return [dict(ID=str(mem * 1000 + cpu), Name='%dcore %dGB' % (cpu, mem),
+                            CPU=cpu, MemoryMB=mem * 1024,
+                            ServiceClass='cloud/plan/fixed',
+                            Availability='available')
+                    for cpu in (1, 2, 3, 4, 5, 6, 8, 10, 12)
+                    for mem in (1, 2, 3, 4, 5, 6, 8, 12, 16, 24, 32, 48)]
+        elif kind == 'disk':
+            return [dict(ID='2', Name='hdd', StorageClass='iscsi1204',
+                            Availability='available'),
+                    dict(ID='4', Name='ssd', StorageClass='iscsi1204',
+                            Availability='available')]
+        return [dict(ID=str(x), Name='%dMbps' % x, BandWidthMbps=x,
+                        ServiceClass='cloud/internet/router/%dm' % x,
+                        Availability='available')
+                for x in (100, 250, 500, 1000)]
+
+    def _get_plan(self, kind, plan_id):
+        for plan in self._plans(kind):
+            if plan['ID'] == str(plan_id):
+                return plan
+        raise not_found('/product/%s/%s' % (kind, plan_id))
+
+    def _product(self, parts, params):
+        if not parts or parts[0] not in PRODUCTS:
+            raise not_found('/product/%s' % '/'.join(parts))
+        one, many = PRODUCTS[parts[0]]
+        if len(parts) == 2:
+            return {one: self._get_plan(parts[0], parts[1])}
+        plans = [x for x in self._plans(parts[0])
+                    if self._match(x, params.get('Filter') or {})]
+        return self._page(many, plans, params)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        # saklient tunnels the method in a header as well
+        method = self.headers.get('X-Sakura-HTTP-Method', method).upper()
+        status, headers, data = self.server.api.handle(method, self.path,
+                                                        self.headers, body)
+        self.send_response(status, reason(status))
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, api, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.api = api
+        self.verbose = verbose
+
+
+def parse_args(argv):
+    parser = optparse.OptionParser(usage='%prog [options]',
+                                    description='Serve a fake sacloud API.')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=8080)
+    parser.add_option('--latency', type='float', default=0.0,
+                        help='Seconds added to every request')
+    parser.add_option('--jitter', type='float', default=0.0,
+                        help='Up to this many random seconds added on top')
+    parser.add_option('--rate-limit', type='float', default=0.0,
+                        help='Requests per second before answering 429, 0 for none')
+    parser.add_option('--burst', type='int', default=0,
+                        help='Requests allowed at once, defaults to the rate limit')
+    parser.add_option('--failure-rate', type='float', default=0.0,
+                        help='Share of requests answered with 503')
+    parser.add_option('--failure-match', default='.',
+                        help='Only fail requests whose "METHOD /path" matches')
+    parser.add_option('--copy-seconds', type='float', default=3.0,
+                        help='Seconds a disk copy from an archive takes')
+    parser.add_option('--copy-failure-rate', type='float', default=0.0,
+                        help='Share of disk copies ending up failed')
+    parser.add_option('--boot-seconds', type='float', default=1.0)
+    parser.add_option('--shutdown-seconds', type='float', default=1.0,
+                        help='Seconds a graceful shutdown takes, forced is instant')
+    parser.add_option('--create-seconds', type='float', default=1.0,
+                        help='Seconds routers and load balancers take to be created')
+    parser.add_option('--seed', type='int', default=None,
+                        help='Seed for latency jitter and injected failures')
+    parser.add_option('-v', '--verbose', action='store_true', default=False)
+    options, args = parser.parse_args(argv)
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv if argv is not None else sys.argv[1:])
+    server = Server((options.host, options.port), FakeSacloud(options),
+                    options.verbose)
+    host, port = server.server_address[:2]
+    print 'export SACLOUD_API_ROOT=http://%s:%d/cloud/' % (host, port)
+    print 'export ARCHIVE_RESOURCE_ID=%s' % ARCHIVE_ID
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()